@@ -1,9 +1,9 @@
 
-from openai import AzureOpenAI
-import requests
 import aiohttp
 import datetime
 import asyncio
+from collections import Counter
+from BatchStatusPoller import BatchStatusPoller, BATCH_TERMINAL_STATUSES
 
 class AOAIHandler:
     def __init__(self, config, batch=False):
@@ -11,20 +11,93 @@ class AOAIHandler:
         self.model = config["aoai_deployment_name"]
         self.batch_endpoint = config["batch_job_endpoint"]
         self.completion_window = config["completion_window"]
-        self.aoai_client = self.init_client(config)
+        self.max_connections = int(config.get("max_connections", 100))
+        #Uploaded files are named with this prefix so the orphan sweeper can tell them from other applications' files
+        self.upload_file_prefix = config.get("upload_file_prefix", "batch-accelerator/")
+        #The openai clients, and the openai package itself, are only loaded once a call needs them
+        self.aoai_client = None
+        self.async_client = None
+        self.client_loader = None
+        #Shared state table of tracked batch jobs, kept up to date by the status poller
         self.batch_status = {}
+        self.poller = BatchStatusPoller(self.load_clients, self.batch_status,
+                                        int(config.get("poll_min_interval", 5)), int(config.get("poll_max_interval", 300)))
         self.azure_endpoint = config['aoai_endpoint']
         self.api_version = config['aoai_api_version']
         self.api_key = config["aoai_key"]
+        #Pooled HTTP sessions shared by every request for the life of the process
+        self.session = None
+        self.http_session = None
+        #Calls made by this handler, by operation; status polling is counted by the poller
+        self.api_calls = Counter()
     def init_client(self,config):
+        from openai import AzureOpenAI
         client = AzureOpenAI(
             azure_endpoint = config['aoai_endpoint'], 
             api_key=config['aoai_key'],  
             api_version=config['aoai_api_version']
         )
         return client
-    async def upload_batch_input_file_async(self,input_file_name, input_file_path, session):
+    def init_async_client(self,config):
+        from openai import AsyncAzureOpenAI
+        client = AsyncAzureOpenAI(
+            azure_endpoint = config['aoai_endpoint'], 
+            api_key=config['aoai_key'],  
+            api_version=config['aoai_api_version'],
+            max_retries=3
+        )
+        return client
+    def get_client(self):
+        if self.aoai_client is None:
+            self.aoai_client = self.init_client(self.config_data)
+        return self.aoai_client
+    def get_async_client(self):
+        if self.async_client is None:
+            self.async_client = self.init_async_client(self.config_data)
+        return self.async_client
+    def start_loading_clients(self):
+        #Creates the async client on a worker thread so importing openai doesn't stall the event loop
+        if self.async_client is None and self.client_loader is None:
+            self.client_loader = asyncio.ensure_future(asyncio.to_thread(self.get_async_client))
+    async def load_clients(self):
+        if self.async_client is None:
+            self.start_loading_clients()
+            try:
+                await self.client_loader
+            except Exception:
+                #A later call tries again rather than getting the same failure
+                self.client_loader = None
+                raise
+        return self.async_client
+    async def get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+    def get_http_session(self):
+        if self.http_session is None:
+            import requests
+            self.http_session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.max_connections)
+            self.http_session.mount("https://", adapter)
+        return self.http_session
+    async def close(self):
+        await self.poller.stop()
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        if self.client_loader is not None:
+            await asyncio.gather(self.client_loader, return_exceptions=True)
+        if self.async_client is not None:
+            await self.async_client.close()
+        if self.http_session is not None:
+            self.http_session.close()
+            self.http_session = None
+    async def upload_batch_input_file_async(self,input_file_name, input_file_path, session=None):
+        #The upload goes through aiohttp, so the openai client loads while it is in flight
+        self.start_loading_clients()
         try:
+            if session is None:
+                session = await self.get_session()
             url = f"{self.azure_endpoint}openai/files/import?api-version={self.api_version}"
             headers = {
             "Content-Type": "application/json",
@@ -33,9 +106,10 @@ class AOAIHandler:
             # Define the payload
             payload = {
                 "purpose": "batch",
-                "filename": input_file_name,
+                "filename": self.get_upload_file_name(input_file_name),
                 "content_url": input_file_path
             }
+            self.api_calls["files_import"] += 1
             async with session.post(url, headers=headers, json=payload) as response:
                 return await response.json()
         except Exception as e:
@@ -51,11 +125,11 @@ class AOAIHandler:
             # Define the payload
             payload = {
                 "purpose": "batch",
-                "filename": input_file_name,
+                "filename": self.get_upload_file_name(input_file_name),
                 "content_url": input_file_path
             }
         
-            return requests.request("POST", url, headers=headers, json=payload)
+            return self.get_http_session().post(url, headers=headers, json=payload)
         except Exception as e:
             print(f"An exception occurred while uploading the file: {e}")
             return False
@@ -63,22 +137,44 @@ class AOAIHandler:
         deletion_status = False
         try:
             # Attempt to delete the file
-            response = self.aoai_client.files.delete(file_id)
+            response = self.get_client().files.delete(file_id)
             print(f"File {file_id} deleted from client successfully.")
             deletion_status = True
         except Exception as e:
             # Handle any exceptions that occur
             print(f"An error occurred while deleting file {file_id}: {e}")
         return deletion_status
+    async def delete_single_async(self, file_id):
+        deletion_status = False
+        try:
+            self.api_calls["files_delete"] += 1
+            async_client = await self.load_clients()
+            response = await async_client.files.delete(file_id)
+            print(f"File {file_id} deleted from client successfully.")
+            deletion_status = True
+        except Exception as e:
+            print(f"An error occurred while deleting file {file_id}: {e}")
+        return deletion_status
+    async def get_file_content_async(self, file_id):
+        self.api_calls["files_content"] += 1
+        async_client = await self.load_clients()
+        file_content = await async_client.files.content(file_id)
+        return file_content.text
+    async def stream_file_content_async(self, file_id, chunk_size=4194304):
+        self.api_calls["files_content"] += 1
+        async_client = await self.load_clients()
+        async with async_client.files.with_streaming_response.content(file_id) as response:
+            async for chunk in response.iter_bytes(chunk_size):
+                yield chunk
     def delete_all_files(self):
         deletion_status = {}
-        file_objects = self.aoai_client.files.list().data
+        file_objects = self.get_client().files.list().data
         # Extracting the ids using a list comprehension
         file_ids = [file_object.id for file_object in file_objects] 
         for file_id in file_ids:
             try:
                 # Attempt to delete the file
-                response = self.aoai_client.files.delete(file_id)
+                response = self.get_client().files.delete(file_id)
                 print(f"File {file_id} deleted successfully.")
                 deletion_status[file_id] = True
             except Exception as e:
@@ -87,44 +183,114 @@ class AOAIHandler:
                 deletion_status[file_id] = False
     
         return deletion_status
+    async def list_files_async(self, purpose=None, page_size=100):
+        self.api_calls["files_list"] += 1
+        async_client = await self.load_clients()
+        if purpose is None:
+            page = await async_client.files.list(limit=page_size)
+        else:
+            page = await async_client.files.list(purpose=purpose, limit=page_size)
+        while True:
+            for file_object in page.data:
+                yield file_object
+            if not page.has_next_page():
+                break
+            self.api_calls["files_list"] += 1
+            page = await page.get_next_page()
+    def get_upload_file_name(self, input_file_name):
+        return self.upload_file_prefix + input_file_name.lstrip("/")
+    def is_uploaded_file(self, file_object):
+        #Without a prefix no file can be told apart as one of ours
+        return self.upload_file_prefix != "" and (getattr(file_object, "filename", None) or "").startswith(self.upload_file_prefix)
+    async def get_batch_file_ids(self, input_file_ids=(), max_pages=50):
+        #Returns the input files of batch jobs that haven't reached a terminal state, which are still in use,
+        #and the output and error files of the batch jobs that ran on one of input_file_ids
+        active_file_ids = set()
+        result_file_ids = set()
+        self.api_calls["batches_list"] += 1
+        async_client = await self.load_clients()
+        page = await async_client.batches.list(limit=100)
+        for page_number in range(max_pages):
+            for batch in page.data:
+                if batch.status not in BATCH_TERMINAL_STATUSES:
+                    active_file_ids.add(batch.input_file_id)
+                if batch.input_file_id in input_file_ids:
+                    result_file_ids.update(file_id for file_id in (batch.output_file_id, batch.error_file_id) if file_id is not None)
+            if not page.has_next_page():
+                break
+            self.api_calls["batches_list"] += 1
+            page = await page.get_next_page()
+        return active_file_ids, result_file_ids
     def create_batch_job(self,file_id):
         # Submit a batch job with the file
-        batch_response = self.aoai_client.batches.create(
+        batch_response = self.get_client().batches.create(
             input_file_id=file_id,
             endpoint=self.batch_endpoint,
             completion_window=self.completion_window,
         )
         # Save batch ID for later use
-        batch_id = batch_response.id
-        self.batch_status[batch_id] = "Submitted"
+        self.poller.track_batch(batch_response.id, batch_response)
         return batch_response
+    async def create_batch_job_async(self,file_id):
+        self.api_calls["batches_create"] += 1
+        async_client = await self.load_clients()
+        batch_response = await async_client.batches.create(
+            input_file_id=file_id,
+            endpoint=self.batch_endpoint,
+            completion_window=self.completion_window,
+        )
+        self.poller.track_batch(batch_response.id, batch_response)
+        return batch_response
+    async def cancel_batch_job_async(self, batch_id):
+        try:
+            self.api_calls["batches_cancel"] += 1
+            async_client = await self.load_clients()
+            await async_client.batches.cancel(batch_id)
+            print(f"Batch job {batch_id} canceled.")
+            return True
+        except Exception as e:
+            print(f"An error occurred while canceling batch job {batch_id}: {e}")
+            return False
+    def get_batch_status(self, batch_id):
+        entry = self.batch_status.get(batch_id)
+        return entry["status"] if entry is not None else None
+    async def find_batch_for_input_file(self, file_id, max_pages=10):
+        #Looks for a batch job already created from an uploaded file so it is not submitted a second time
+        try:
+            self.api_calls["batches_list"] += 1
+            async_client = await self.load_clients()
+            page = await async_client.batches.list(limit=100)
+            for page_number in range(max_pages):
+                for batch in page.data:
+                    #A completed batch is reattached to; one that failed, was cancelled or expired is not
+                    if batch.input_file_id == file_id and (batch.status == "completed" or batch.status not in BATCH_TERMINAL_STATUSES):
+                        return batch.id
+                if not page.has_next_page():
+                    break
+                self.api_calls["batches_list"] += 1
+                page = await page.get_next_page()
+        except Exception as e:
+            print(f"An error occurred while looking up batch jobs for file {file_id}: {e}")
+        return None
     async def wait_for_file_upload(self, file_id):
-        status = "pending"
-        while True:
-            file_response = self.aoai_client.files.retrieve(file_id)
-            status = file_response.status
-            if status == "error":
-                print(f"{datetime.datetime.now()} Error occurred while processing file {file_id}")
-                break
-            elif status == "processed":
-                print(f"{datetime.datetime.now()} File {file_id} processed successfully.")
-                break
-            else:
-                print(f"{datetime.datetime.now()} File Id: {file_id}, Status: {status}")
-            await asyncio.sleep(5)
+        file_response = await self.poller.wait_for_file(file_id)
+        if file_response.status == "error":
+            print(f"{datetime.datetime.now()} Error occurred while processing file {file_id}")
+        else:
+            print(f"{datetime.datetime.now()} File {file_id} processed successfully.")
         return file_response
     async def wait_for_batch_job(self, batch_id):
-        # Wait until the uploaded file is in processed state
-        status = "validating"
-        while status not in ("completed", "failed", "canceled"):
-            batch_response = self.aoai_client.batches.retrieve(batch_id)
-            status = batch_response.status
-            print(f"{datetime.datetime.now()} Batch Id: {batch_id},  Status: {status}")
-            await asyncio.sleep(10)
+        # Wait until the batch job reaches a terminal state
+        batch_response = await self.poller.wait_for_batch(batch_id)
+        status = batch_response.status
         if status == "failed":
             print(f"Batch job {batch_id} failed.")
-        elif status == "canceled":
+        elif status in ("cancelled", "canceled"):
             print(f"Batch job {batch_id} was canceled.")
+        elif status == "expired":
+            print(f"Batch job {batch_id} expired.")
         else:
             print(f"Batch job {batch_id} completed successfully.")
-        return batch_response
\ No newline at end of file
+        return batch_response
+    def get_stats(self):
+        return {"api_calls": dict(self.api_calls), "polling": self.poller.get_stats()}
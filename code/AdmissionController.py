@@ -0,0 +1,112 @@
+import asyncio
+import datetime
+import heapq
+import itertools
+import time
+
+#Batch error codes returned when a deployment's enqueued-token quota is exhausted
+QUOTA_ERROR_CODES = ("token_limit_exceeded", "quota_exceeded", "insufficient_quota")
+
+class AdmissionController:
+    #Keeps the tokens enqueued on the deployment within its batch quota. Jobs wait for budget before upload
+    #and release it once their batch reaches a terminal state. Waiting jobs are admitted shortest first
+    #("sjf") or in arrival order ("fifo"); only the job at the head is considered. Under sjf a job that has waited
+    #longer than max_wait seconds is moved to the head, so a steady stream of small jobs can't hold back a large one forever.
+    def __init__(self, max_enqueued_tokens, order="sjf", retry_interval=60, max_retries=10, max_wait=3600):
+        self.max_enqueued_tokens = int(max_enqueued_tokens)
+        self.order = order
+        self.retry_interval = retry_interval
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self.enqueued_tokens = 0
+        self.admitted = {}
+        self.waiters = []
+        self.sequence = itertools.count()
+        self.admitted_count = 0
+        self.quota_failures = 0
+        self.promoted_count = 0
+    def is_enabled(self):
+        return self.max_enqueued_tokens > 0
+    def get_priority(self, tokens):
+        return tokens if self.order == "sjf" else 0
+    async def acquire(self, key, tokens):
+        if key in self.admitted:
+            return
+        if len(self.waiters) == 0 and self.fits(tokens):
+            self.admit(key, tokens)
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (self.get_priority(tokens), next(self.sequence), key, tokens, future, time.monotonic()))
+        #A short job may go straight ahead of a longer one that is still waiting for room
+        self.admit_waiters()
+        if future.done():
+            return
+        print(f"{datetime.datetime.now()} Waiting for {tokens} tokens of enqueued quota for {key} "
+              f"({self.enqueued_tokens}/{self.max_enqueued_tokens} in use)")
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self.remove_waiter(future)
+            else:
+                self.release(key)
+            raise
+    def reserve(self, key, tokens):
+        #Jobs already running on the service count against the quota whether or not it has room
+        if key not in self.admitted:
+            self.admit(key, tokens)
+    def release(self, key):
+        tokens = self.admitted.pop(key, None)
+        if tokens is not None:
+            self.enqueued_tokens -= tokens
+            self.admit_waiters()
+    def fits(self, tokens):
+        #A job larger than the whole budget is admitted on its own rather than never
+        return self.enqueued_tokens + tokens <= self.max_enqueued_tokens or len(self.admitted) == 0
+    def admit(self, key, tokens):
+        self.admitted[key] = tokens
+        self.enqueued_tokens += tokens
+        self.admitted_count += 1
+    def promote_waiters(self):
+        #Jobs that waited past max_wait go ahead of every job that hasn't, in arrival order
+        if self.max_wait <= 0 or self.order != "sjf":
+            return
+        deadline = time.monotonic() - self.max_wait
+        promoted = False
+        for index, (priority, sequence, key, tokens, future, enqueued_time) in enumerate(self.waiters):
+            if priority >= 0 and enqueued_time <= deadline and not future.done():
+                self.waiters[index] = (-1, sequence, key, tokens, future, enqueued_time)
+                self.promoted_count += 1
+                promoted = True
+        if promoted:
+            heapq.heapify(self.waiters)
+    def admit_waiters(self):
+        self.promote_waiters()
+        while len(self.waiters) > 0:
+            priority, sequence, key, tokens, future, enqueued_time = self.waiters[0]
+            if future.done():
+                heapq.heappop(self.waiters)
+                continue
+            if not self.fits(tokens):
+                break
+            heapq.heappop(self.waiters)
+            self.admit(key, tokens)
+            future.set_result(True)
+    def remove_waiter(self, future):
+        self.waiters = [waiter for waiter in self.waiters if waiter[4] is not future]
+        heapq.heapify(self.waiters)
+        self.admit_waiters()
+    def is_quota_error(self, error_codes):
+        return any(code in QUOTA_ERROR_CODES for code in error_codes)
+    def get_retry_delay(self, attempt):
+        return min(self.retry_interval * (2 ** attempt), self.retry_interval * 10)
+    def get_stats(self):
+        return {
+            "enqueued_tokens": self.enqueued_tokens,
+            "max_enqueued_tokens": self.max_enqueued_tokens,
+            "admitted_jobs": len(self.admitted),
+            "waiting_jobs": len(self.waiters),
+            "admitted_total": self.admitted_count,
+            "quota_failures": self.quota_failures,
+            "promoted_jobs": self.promoted_count
+        }
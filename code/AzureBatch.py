@@ -1,13 +1,21 @@
 import os
 import json
 from Utilities import Utils
+from BatchComponents import BatchComponents
+from JobScheduler import JobScheduler
+from TokenCounter import TokenCounter
 import asyncio
-import aiohttp
+import contextlib
+import tempfile
+import time
+from DeploymentRouter import DeploymentRouter, Deployment
+from Metrics import Metrics
+from UsageTracker import UsageTracker
 class AzureBatch:
     def __init__(self, aoai_client, input_storage_handler, 
                  error_storage_handler, processed_storage_handler, batch_path,
-                input_directory_client, local_download_path, output_directory, error_directory,
-                count_tokens=False):
+                 input_directory_client, local_download_path, output_directory, error_directory,
+                 count_tokens=False, stats_interval=60, stream_results=True, staging_directory="_staging", components=None):
         self.aoai_client = aoai_client
         self.input_storage_handler = input_storage_handler
         self.error_storage_handler = error_storage_handler
@@ -18,192 +26,1335 @@ class AzureBatch:
         self.output_directory = output_directory
         self.error_directory = error_directory
         self.count_tokens = count_tokens
+        self.stats_interval = stats_interval
+        self.stream_results = stream_results
+        self.staging_directory = staging_directory
+        if components is None:
+            components = BatchComponents()
+        self.token_counter = components.token_counter
+        if count_tokens and self.token_counter is None:
+            self.token_counter = TokenCounter()
+        #Token counts taken before upload, reused as the file's admission estimate
+        self.file_token_counts = {}
+        #Staged valid lines of files filtered by input validation; they are submitted in place of the file
+        self.validated_files = {}
+        #Whether a submitted file runs realtime, decided when it was queued
+        self.realtime_decisions = {}
+        self.admission_controller = components.admission_controller
+        self.deployment_router = components.deployment_router
+        if self.deployment_router is None:
+            self.deployment_router = DeploymentRouter([Deployment(aoai_client.model, aoai_client, self.admission_controller)])
+        self.request_retrier = components.request_retrier
+        self.realtime_executor = components.realtime_executor
+        self.file_claimer = components.file_claimer
+        self.file_cleaner = components.file_cleaner
+        self.result_store = components.result_store
+        self.input_validator = components.input_validator
+        self.file_sharder = components.file_sharder
+        self.file_packer = components.file_packer
+        #Input files that are part of a pack currently being processed
+        self.packed_files = set()
+        self.job_ledger = components.job_ledger
+        self.result_cache = components.result_cache
+        self.metrics = components.metrics or Metrics()
+        self.usage_tracker = components.usage_tracker or UsageTracker()
+        self.metrics.add_source("deployments", self.deployment_router.get_stats)
+        self.metrics.add_source("api", lambda: {deployment.name: deployment.client.get_stats()
+                                                for deployment in self.deployment_router.deployments})
+        if self.file_claimer is not None:
+            self.metrics.add_source("claims", self.file_claimer.get_stats)
+        self.metrics.add_source("usage", self.usage_tracker.get_stats)
+        if self.file_cleaner is not None:
+            self.metrics.add_source("cleanup", self.file_cleaner.get_stats)
+        self.scheduler = None
+        self.shutdown_event = asyncio.Event()
 
     async def process_all_files(self,files,micro_batch_size):
-        tasks = []
-        current_tasks = 0
-        async with aiohttp.ClientSession() as session:
-            for file in files:
-                tasks.append(self.process_file(file, session))
-                current_tasks += 1
-                if current_tasks == micro_batch_size:
-                    await asyncio.gather(*tasks)
-                    tasks = []
-                    current_tasks = 0
-            #Process any remaining tasks
-            if len(tasks) > 0:
-                await asyncio.gather(*tasks)
+        #micro_batch_size is the number of in-flight slots; a slot is refilled as soon as its file finishes
+        async with self.run_scheduler(micro_batch_size) as scheduler:
+            await self.submit_files(scheduler, files)
+            await self.wait_for_shutdown(scheduler.join())
+        return scheduler.get_stats()
+
+    async def process_continuous(self, list_files, micro_batch_size, poll_interval=60):
+        #Newly discovered files join the running queue instead of waiting for the current snapshot to finish.
+        #list_files is a coroutine function returning the files found since its previous call.
+        async with self.run_scheduler(micro_batch_size) as scheduler:
+            while not self.shutdown_event.is_set():
+                files = await list_files()
+                if self.file_claimer is not None:
+                    #Files other workers held are offered again so they are taken over if that worker stopped
+                    files = files + [file for file in self.file_claimer.get_deferred_files() if file not in files]
+                added = await self.submit_files(scheduler, files)
+                if added > 0:
+                    print(f"{added} new file(s) added to the queue")
+                elif scheduler.get_stats()["active_slots"] == 0:
+                    print(f"No files found. Sleeping for {poll_interval} seconds")
+                await self.wait_for_shutdown(asyncio.sleep(poll_interval))
+
+    @contextlib.asynccontextmanager
+    async def run_scheduler(self, micro_batch_size):
+        #Starts the scheduler and the background tasks that run alongside it, queues the jobs left in the ledger,
+        #and stops them all again when the caller is done submitting
+        session = await self.aoai_client.get_session()
+        scheduler = self.create_scheduler(session, micro_batch_size)
+        scheduler.start()
+        stats_task = asyncio.create_task(scheduler.report_stats(self.stats_interval))
+        claims_task = self.start_claim_renewal()
+        metrics_task = self.metrics.start()
+        usage_task = self.usage_tracker.start()
+        if self.file_cleaner is not None:
+            self.file_cleaner.start()
+        try:
+            self.resume_jobs(scheduler)
+            yield scheduler
+        finally:
+            stats_task.cancel()
+            if claims_task is not None:
+                claims_task.cancel()
+            for task in (metrics_task, usage_task):
+                if task is not None:
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+            await scheduler.stop()
+
+    async def wait_for_shutdown(self, awaitable):
+        #Returns when the awaitable completes or a shutdown is requested, whichever comes first
+        task = asyncio.ensure_future(awaitable)
+        shutdown_task = asyncio.create_task(self.shutdown_event.wait())
+        await asyncio.wait([task, shutdown_task], return_when=asyncio.FIRST_COMPLETED)
+        for pending_task in (task, shutdown_task):
+            pending_task.cancel()
+
+    def request_shutdown(self):
+        #Stop admitting work; in-flight batch jobs keep running in the service and are resumed from the ledger
+        print("Shutdown requested. No new files will be started.")
+        if self.scheduler is not None:
+            self.scheduler.stop_admitting()
+        self.shutdown_event.set()
+
+    async def close(self):
+        #Queued deletes need the AOAI clients, so they are drained before the clients are closed
+        if self.file_cleaner is not None:
+            await self.file_cleaner.stop()
+        await self.deployment_router.close()
+        if self.job_ledger is not None:
+            self.job_ledger.close()
+        if self.result_cache is not None:
+            self.result_cache.cache_store.close()
+        if self.token_counter is not None:
+            self.token_counter.close()
+        if self.input_validator is not None:
+            self.input_validator.close()
+        for storage_handler in (self.input_storage_handler, self.error_storage_handler, self.processed_storage_handler):
+            await storage_handler.close()
+
+    def filter_input_files(self, files):
+        #Shards and other intermediate files live in the staging directory and are never picked up as input
+        staging_prefix = self.staging_directory.strip("/") + "/"
+        return [file for file in files if not file.lstrip("/").startswith(staging_prefix) and file not in self.packed_files]
+
+    async def submit_files(self, scheduler, files, allow_packing=True):
+        files = [file for file in self.filter_input_files(files) if not scheduler.is_pending(file)]
+        added = 0
+        if self.is_realtime_enabled():
+            #Small and urgent files, including those flagged urgent in their metadata, are never packed and start
+            #ahead of any batch work. The decision is kept so the file's metadata isn't read again when it starts.
+            decisions = await asyncio.gather(*[asyncio.to_thread(self.realtime_executor.should_run, file) for file in files])
+            self.realtime_decisions.update(zip(files, decisions))
+            realtime_files = set(file for file, decision in zip(files, decisions) if decision)
+            for file in realtime_files:
+                if scheduler.submit(file, priority=-1):
+                    added += 1
+            files = [file for file in files if file not in realtime_files]
+        packs = []
+        if allow_packing and self.file_packer is not None and self.file_packer.is_enabled():
+            packs, files = await asyncio.to_thread(self.file_packer.create_packs, files)
+        #Sizes may have to be fetched from storage, so they are read off the event loop
+        priorities = await asyncio.to_thread(self.get_priorities, [pack["files"] for pack in packs] + [[file] for file in files])
+        for pack, priority in zip(packs, priorities):
+            if scheduler.submit(pack["pack_file"], pack, priority):
+                self.packed_files.update(pack["files"])
+                added += len(pack["files"])
+        for file, priority in zip(files, priorities[len(packs):]):
+            if scheduler.submit(file, priority=priority):
+                added += 1
+        return added
+
+    def get_priorities(self, file_groups):
+        #With shortest-job-first admission the scheduler starts the smallest queued work first
+        if not self.is_admission_enabled() or self.admission_controller.order != "sjf":
+            return [0] * len(file_groups)
+        return [sum(self.input_storage_handler.get_file_size_by_path(file) for file in files) for files in file_groups]
+
+    def is_admission_enabled(self):
+        return self.admission_controller is not None and self.admission_controller.is_enabled()
+
+    def is_realtime_enabled(self):
+        return self.realtime_executor is not None and self.realtime_executor.is_enabled()
+
+    async def should_run_realtime(self, file, ledger_entry):
+        #A file already running as a batch job stays on the batch path
+        decision = self.realtime_decisions.pop(file, None)
+        if ledger_entry is not None:
+            return ledger_entry["kind"] == "realtime"
+        if decision is not None:
+            return decision
+        return self.is_realtime_enabled() and await asyncio.to_thread(self.realtime_executor.should_run, file)
+
+    def start_claim_renewal(self):
+        if self.file_claimer is None:
+            return None
+        return asyncio.create_task(self.file_claimer.renew_claims())
+
+    def create_scheduler(self, session, max_concurrency):
+        async def process(item):
+            #Every stage timed while the item is processed is attributed to it, including its shards and retries
+            self.metrics.start_file(item["pack_file"] if isinstance(item, dict) else item)
+            self.usage_tracker.start_file()
+            try:
+                if self.file_claimer is not None:
+                    return await self.process_claimed(item, session)
+                if isinstance(item, dict):
+                    return await self.process_pack(item, session)
+                return await self.process_file(item, session)
+            finally:
+                self.metrics.finish_file()
+        self.scheduler = JobScheduler(process, max_concurrency)
+        self.metrics.add_source("scheduler", self.scheduler.get_stats)
+        return self.scheduler
+
+    async def process_claimed(self, item, session):
+        #Only files this worker holds a claim on are processed; the claims are released once the work is done
+        files = item["files"] if isinstance(item, dict) else [item]
+        claimed_files = [file for file in files if await self.file_claimer.claim_async(file)]
+        try:
+            if isinstance(item, dict):
+                unclaimed_files = [file for file in files if file not in claimed_files]
+                if len(unclaimed_files) > 0:
+                    self.packed_files.difference_update(unclaimed_files)
+                    if self.job_ledger is not None and self.job_ledger.get(item["pack_file"]) is not None:
+                        print(f"Pack {item['pack_file']} is not resumed because some of its files are claimed by another worker")
+                        return
+                    item["files"] = claimed_files
+                if len(claimed_files) > 0:
+                    return await self.process_pack(item, session)
+            elif len(claimed_files) > 0:
+                return await self.process_file(item, session)
+            else:
+                print(f"File {item} is claimed by another worker and was skipped")
+        finally:
+            for file in claimed_files:
+                await self.file_claimer.release_async(file)
+
+    def get_file_names(self, file):
+        filename_only = Utils.get_file_name_only(file)
+        file_wo_directory = Utils.strip_directory_name(file)
+        return {
+            "file": file,
+            "filename_only": filename_only,
+            "file_wo_directory": file_wo_directory,
+            "file_extension": Utils.get_file_extension(file_wo_directory),
+            "output_directory_name": self.output_directory+"/"+Utils.append_postfix(filename_only),
+            "error_directory_name": self.error_directory+"/"+Utils.append_postfix(filename_only)
+        }
         
     async def process_file(self,file, session):
         print(f"Processing file {file}")
-        filename_only = Utils.get_file_name_only(file)
-        file_wo_directory = Utils.strip_directory_name(file)
-        file_extension = Utils.get_file_extension(file_wo_directory)
-        output_directory_name = self.output_directory+"/"+Utils.append_postfix(filename_only)
-        error_directory_name = self.error_directory+"/"+Utils.append_postfix(filename_only)
+        file_names = self.get_file_names(file)
+        filename_only = file_names["filename_only"]
+        file_wo_directory = file_names["file_wo_directory"]
+        file_extension = file_names["file_extension"]
+        output_directory_name = file_names["output_directory_name"]
+        error_directory_name = file_names["error_directory_name"]
         #Mark start time
         processing_result = {}
         batch_data = None
+        ledger_entry = self.job_ledger.get(file) if self.job_ledger is not None else None
         try:
-            batch_data = await self.submit_batch_job(file, file_wo_directory, error_directory_name, filename_only, session)
-            if batch_data is None:
-                return
-            self.process_batch_result(batch_data, filename_only, file_extension, file_wo_directory, 
-                                  error_directory_name, output_directory_name)
-            cleanup_status = self.cleanup_batch(file_wo_directory,batch_data["file_id"], batch_data["output_file_id"], batch_data["error_file_id"])
+            if ledger_entry is not None and ledger_entry["stage"] == "results_written":
+                #Results were written before the process stopped; only the cleanup is left
+                batch_data = self.get_ledger_batch_data(ledger_entry)
+            else:
+                if ledger_entry is None and not await self.validate_input_file(file, file_names):
+                    await self.remove_job(file)
+                    return
+                if ledger_entry is not None and "validated_file" in ledger_entry["details"]:
+                    self.validated_files[file] = ledger_entry["details"]["validated_file"]
+                if await self.should_run_realtime(file, ledger_entry):
+                    batch_data = await self.run_realtime_job(file, file_wo_directory, error_directory_name)
+                elif await self.should_shard(file) or (ledger_entry is not None and ledger_entry["kind"] == "sharded"):
+                    batch_data = await self.submit_sharded_batch_jobs(file, file_wo_directory, error_directory_name, 
+                                                                      filename_only, file_extension, session)
+                else:
+                    batch_data = await self.submit_batch_job(file, file_wo_directory, error_directory_name, filename_only, 
+                                                             file_extension, session)
+                if batch_data is None:
+                    await self.remove_job(file)
+                    return
+                if self.request_retrier is not None and self.request_retrier.is_enabled() and "realtime" not in batch_data:
+                    await self.retry_failed_requests(batch_data, session)
+                await self.process_batch_result(batch_data, filename_only, file_extension, file_wo_directory, 
+                                      error_directory_name, output_directory_name)
+                await self.record_job(file, stage="results_written")
+            with self.metrics.span("cleanup"):
+                cleanup_status = await self.cleanup_batch_data(file, batch_data)
             processing_result["cleanup_status"] = cleanup_status
+            await self.remove_job(file)
         except Exception as e:
             #Unexpected exception during processing
             print(f"An error occurred while processing file: {file}. Error: {e}")
             if batch_data is not None:
-                file_write_result = self.error_storage_handler.write_content_to_directory(batch_data["batch_file_data"],error_directory_name,filename_only)
-                cleanup_status = self.cleanup_batch(file_wo_directory,batch_data["file_id"], batch_data["output_file_id"], batch_data["error_file_id"])
+                file_write_result = await self.copy_input_file(file, self.error_storage_handler, error_directory_name, filename_only)
+                cleanup_status = await self.cleanup_batch_data(file, batch_data)
                 processing_result["cleanup_status"] = cleanup_status
+                await self.remove_job(file)
         return processing_result
     
-    async def submit_batch_job(self,file, file_wo_directory, error_directory_name, filename_only, session):
-        batch_storage_path = self.batch_path + file
+    async def process_pack(self, pack, session):
+        print(f"Processing pack {pack['pack_file']} with {len(pack['files'])} file(s)")
+        ledger_entry = self.job_ledger.get(pack["pack_file"]) if self.job_ledger is not None else None
         try:
-            if self.local_download_path is not None:
-                output_path = os.path.join(self.local_download_path, file)
-                batch_file_data = self.input_storage_handler.save_file_to_local(file, 
-                                            self.input_directory_client, output_path)
-                if self.count_tokens:
-                    token_size = Utils.get_tokens_in_file(output_path,"gpt-4")
+            if ledger_entry is not None:
+                #The pack file was already written by a previous run
+                overflow, unpackable = [], []
             else:
-                batch_file_data = self.input_storage_handler.get_file_data(file_wo_directory,self.input_directory_client)
-                batch_file_string = str(batch_file_data)
-                if self.count_tokens:
-                    token_size = Utils.num_tokens_from_string(batch_file_string,"gpt-4")
+                for file in list(pack["files"]):
+                    if not await self.validate_input_file(file, self.get_file_names(file)):
+                        pack["files"].remove(file)
+                        self.packed_files.discard(file)
+                overflow, unpackable = await asyncio.to_thread(self.file_packer.write_pack, pack, self.validated_files)
+                if len(pack["files"]) > 0:
+                    await self.record_job(pack["pack_file"], kind="pack", details={"files": pack["files"]})
         except Exception as e:
-            print(f"Could not download file: {file}. Error: {e}")
+            print(f"An error occurred while creating pack {pack['pack_file']}. Error: {e}")
+            overflow, unpackable = [], list(pack["files"])
+            pack["files"] = []
+        #Files left out of the pack are released and queued again on their own
+        self.packed_files.difference_update(overflow + unpackable)
+        if len(overflow) > 0:
+            await self.submit_files(self.scheduler, overflow)
+        if len(unpackable) > 0:
+            await self.submit_files(self.scheduler, unpackable, allow_packing=False)
+        if len(pack["files"]) == 0:
+            return
+        members = [self.get_file_names(file) for file in pack["files"]]
+        try:
+            if ledger_entry is not None and ledger_entry["stage"] == "results_written":
+                job_data = self.get_ledger_batch_data(ledger_entry)
+            else:
+                job_data = await self.run_batch_job(pack["pack_file"], session, "pack")
+                if job_data["error"] is not None:
+                    for member in members:
+                        file_write_result = await self.copy_input_file(member["file"], self.error_storage_handler, 
+                                                                       member["error_directory_name"], member["file_wo_directory"])
+                else:
+                    await self.process_pack_result(pack, members, job_data)
+                await self.record_job(pack["pack_file"], stage="results_written")
+            await self.delete_batch_files(job_data["file_id"], job_data["output_file_id"], job_data["error_file_id"])
+            for member in members:
+                cleanup_status = await self.cleanup_batch(member["file"], None, None, None)
+            await asyncio.to_thread(self.file_packer.delete_pack, pack)
+            await self.remove_job(pack["pack_file"])
+        except Exception as e:
+            print(f"An error occurred while processing pack: {pack['pack_file']}. Error: {e}")
+            if self.job_ledger is not None:
+                #The pack stays in the ledger and its files stay reserved so it is resumed rather than rebuilt
+                return
+            await asyncio.to_thread(self.file_packer.delete_pack, pack)
+        self.packed_files.difference_update(pack["files"])
+
+    async def process_pack_result(self, pack, members, job_data):
+        output_bytes_written = await self.split_pack_result_file(job_data["output_file_id"], members, 
+                                                                 self.processed_storage_handler, "output_directory_name", "output")
+        error_bytes_written = await self.split_pack_result_file(job_data["error_file_id"], members, 
+                                                                self.error_storage_handler, "error_directory_name", "error")
+        self.metrics.increment("bytes_written", sum(output_bytes_written) + sum(error_bytes_written))
+        for index, member in enumerate(members):
+            metadata_filename = f"{member['filename_only']}_metadata."+member["file_extension"]
+            batch_data = {
+                "file": member["file"],
+                "input_file_id": job_data["input_file_id"],
+                "batch_job_id": job_data["batch_job_id"],
+                "status": job_data["status"],
+                "error_file_id": job_data["error_file_id"],
+                "output_file_id": job_data["output_file_id"],
+                "errors": job_data["errors"],
+                "token_size": await self.get_token_size(member["file"], member["file_wo_directory"]) if self.count_tokens else "N/A",
+                "file_id": job_data["file_id"],
+                "deployment": job_data["deployment"],
+                "pack_file": pack["pack_file"],
+                "pack_file_count": len(members)
+            }
+            batch_metadata = self.create_batch_metadata(batch_data)
+            #The pack's result files are counted as a whole, so members carry the usage of the entire pack
+            batch_metadata["pack_usage"] = self.usage_tracker.get_file_usage()
+            if error_bytes_written[index] == 0 and job_data["error_file_id"] is None and len(job_data["errors"]) > 0:
+                error_file_content = {}
+                for error_index, error in enumerate(job_data["errors"]):
+                    error_file_content["Error "+str(error_index + 1)] = error
+                error_bytes_written[index] = await self.write_result_content(json.dumps(error_file_content), self.error_storage_handler,
+                                                                             member["error_directory_name"], 
+                                                                             f"{member['filename_only']}_error."+member["file_extension"])
+            if error_bytes_written[index] != 0:
+                await asyncio.gather(
+                    self.error_storage_handler.write_content_to_directory_async(json.dumps(batch_metadata),member["error_directory_name"],
+                                                                                metadata_filename),
+                    self.copy_input_file(member["file"], self.error_storage_handler, member["error_directory_name"], member["file_wo_directory"]))
+            if output_bytes_written[index] != 0:
+                batch_metadata["output_file_name"] = f"{member['filename_only']}_output."+member["file_extension"]
+                await asyncio.gather(
+                    self.processed_storage_handler.write_content_to_directory_async(json.dumps(batch_metadata),member["output_directory_name"],
+                                                                                    metadata_filename),
+                    self.copy_input_file(member["file"], self.processed_storage_handler, member["output_directory_name"], member["file_wo_directory"]))
+                print(f"File: {member['file']} has been processed successfully. Results are available in the 'processed' directory.")
+            await self.write_result_store(member["file"], member["filename_only"], member["file_extension"],
+                                          member["output_directory_name"], member["error_directory_name"],
+                                          output_bytes_written[index], error_bytes_written[index])
+
+    async def split_pack_result_file(self, result_file_id, members, storage_handler, directory_key, result_type):
+        #Streams a pack's result file into per-file results, restoring each request's original custom_id
+        bytes_written = [0] * len(members)
+        if result_file_id is None:
+            return bytes_written
+        writers = {}
+        try:
+            async for line in Utils.iter_lines_async(self.stream_tracked_result_file(result_file_id)):
+                member_index, result_line = self.file_packer.split_line(line)
+                if member_index is not None and 0 <= member_index < len(members):
+                    member_indexes = [member_index]
+                else:
+                    #Lines that can't be attributed to one file are written to every file in the pack
+                    member_indexes = range(len(members))
+                for index in member_indexes:
+                    if index not in writers:
+                        member = members[index]
+                        result_filename = f"{member['filename_only']}_{result_type}."+member["file_extension"]
+                        writers[index] = await asyncio.to_thread(storage_handler.get_file_writer, 
+                                                                 member[directory_key] + "/" + result_filename)
+                    writers[index].write(result_line)
+                    bytes_written[index] += len(result_line)
+        finally:
+            for writer in writers.values():
+                await asyncio.to_thread(writer.close)
+        return bytes_written
+
+    async def validate_input_file(self, file, file_names):
+        #Returns False when the file was rejected; its report and a copy of it are then in the error directory. In filter
+        #mode the input is left untouched and its staged valid lines are submitted in its place
+        if self.input_validator is None or not self.input_validator.is_enabled():
+            return True
+        filter_mode = self.input_validator.mode == "filter"
+        try:
+            with self.metrics.span("validation"):
+                report = await self.input_validator.validate_file_async(self.input_storage_handler, file)
+        except Exception as e:
+            if not filter_mode:
+                print(f"An error occurred while validating file: {file}. It will be submitted without validation. Error: {e}")
+                return True
+            #A partly filtered file cannot be submitted, and the unfiltered one would carry the lines meant to be set aside
+            print(f"An error occurred while validating file: {file}. It will be rejected. Error: {e}")
+            report = {"file": file, "mode": self.input_validator.mode, "valid_lines": 0, "invalid_lines": 0, "error_counts": {},
+                      "errors": [], "errors_truncated": False, "valid_file": None, "invalid_file": None}
+            report["valid_file"], report["invalid_file"] = self.input_validator.get_staging_paths(file)
+            reason = f"validation_failed: {e}"
+        else:
+            self.metrics.increment("invalid_lines", report["invalid_lines"])
+            if report["invalid_lines"] == 0:
+                await asyncio.to_thread(self.input_validator.delete_staging_files, self.input_storage_handler, report)
+                return True
+            reason = None
+        error_directory_name = file_names["error_directory_name"]
+        filename_only = file_names["filename_only"]
+        file_extension = file_names["file_extension"]
+        if reason is None and not filter_mode:
+            reason = "invalid_lines"
+        elif reason is None and report["valid_lines"] == 0:
+            #Files without a single valid line are rejected in filter mode too
+            reason = "no_valid_lines"
+        elif reason is None:
+            invalid_lines = self.stream_storage_file(self.input_storage_handler, report["invalid_file"])
+            if await self.error_storage_handler.write_stream_to_directory(invalid_lines, error_directory_name,
+                                                                          f"{filename_only}_invalid."+file_extension) is None:
+                reason = "invalid_lines_not_written"
+        rejected = reason is not None
+        validation_report = {key: value for key, value in report.items() if key not in ("valid_file", "invalid_file")}
+        validation_report["rejected"] = rejected
+        if rejected:
+            validation_report["reason"] = reason
+        await self.error_storage_handler.write_content_to_directory_async(json.dumps(validation_report), error_directory_name,
+                                                                          f"{filename_only}_validation."+file_extension)
+        if rejected:
+            file_write_result = await self.copy_input_file(file, self.error_storage_handler, error_directory_name,
+                                                           file_names["file_wo_directory"])
+            cleanup_status = await self.cleanup_batch(file, None, None, None)
+            await asyncio.to_thread(self.input_validator.delete_staging_files, self.input_storage_handler, report)
+            print(f"File {file} rejected ({reason}) with {report['invalid_lines']} invalid line(s). A validation report was written to the 'error' directory.")
+            return False
+        self.validated_files[file] = report["valid_file"]
+        if file not in self.packed_files:
+            #Pack members are resumed through the pack's own ledger entry
+            await self.record_job(file, details={"validated_file": report["valid_file"]})
+        await asyncio.to_thread(self.input_storage_handler.delete_file, report["invalid_file"])
+        print(f"{report['invalid_lines']} invalid line(s) of file {file} moved to the 'error' directory; the valid lines are submitted.")
+        return True
+
+    async def submit_batch_job(self,file, file_wo_directory, error_directory_name, filename_only, file_extension, session):
+        token_size = await self.get_token_size(file, file_wo_directory)
+        if token_size is None:
             return None
-        if self.count_tokens:
-            print(f"File {file} has {token_size} tokens")
+        cache_result = None
+        submitted_file = self.get_input_file(file)
+        if self.result_cache is not None:
+            cache_result = await self.filter_cached_requests(file)
+        if cache_result is not None:
+            submitted_file = cache_result["uncached_file"]
+        if submitted_file == file:
+            job_data = await self.run_batch_job(file, session)
+        elif submitted_file is not None:
+            #Only the valid requests, or those missing from the cache, are uploaded
+            job_data = await self.run_batch_job(submitted_file, session, "filtered", file)
         else:
-            token_size = "N/A"
-         # Process the file
-        upload_response = await self.aoai_client.upload_batch_input_file_async(file,batch_storage_path, session)
-        if not upload_response:
-            print(f"An error occurred while uploading file {file}. Please check the file and try again.")
-            file_write_result = self.error_storage_handler.write_content_to_directory(batch_file_data,error_directory_name,file_wo_directory)
-            cleanup_status = self.cleanup_batch(file_wo_directory,None, None, None)
+            #Every request was served from the cache so no batch job is needed
+            job_data = {"deployment": None, "file_id": None, "input_file_id": None, "batch_job_id": None, "status": "completed",
+                        "error_file_id": None, "output_file_id": None, "errors": [], "error": None}
+        if job_data["error"] is not None:
+            file_write_result = await self.copy_input_file(file, self.error_storage_handler, error_directory_name, file_wo_directory)
+            if cache_result is not None:
+                await asyncio.to_thread(self.result_cache.delete_staging_files, self.input_storage_handler, file, cache_result)
+            cleanup_status = await self.cleanup_batch(file,job_data["file_id"], None, None)
             return None
-        file_content_json = upload_response
-        if "error" in file_content_json:
-            print(f"An error occurred while uploading file {file}. Please check the file and try again.\n\nCode: "+file_content_json["error"]["code"]+"\n\nMessage: "+file_content_json["error"]["message"])
-            file_write_result = self.error_storage_handler.write_content_to_directory(batch_file_data,error_directory_name,file_wo_directory)
-            cleanup_status = self.cleanup_batch(file_wo_directory,None, None, None)
+        batch_data = {
+            "file": file,
+            "input_file_id": job_data["input_file_id"],
+            "batch_job_id": job_data["batch_job_id"],
+            "status": job_data["status"],
+            "error_file_id": job_data["error_file_id"],
+            "output_file_id": job_data["output_file_id"],
+            "errors": job_data["errors"],
+            "token_size": token_size,
+            "file_id": job_data["file_id"],
+            "deployment": job_data["deployment"]
+        }
+        if cache_result is not None:
+            batch_data["cache"] = cache_result
+        return batch_data
+
+    async def run_realtime_job(self, file, file_wo_directory, error_directory_name):
+        #Sends each request to the chat completions endpoint; results are staged in the batch result file format
+        token_size = await self.get_token_size(file, file_wo_directory)
+        if token_size is None:
+            return None
+        ledger_entry = self.job_ledger.get(file) if self.job_ledger is not None else None
+        if ledger_entry is not None and ledger_entry["stage"] == "finished":
+            #The staged results of a finished run are reused rather than sending every request again
+            realtime_result = ledger_entry["details"]["realtime"]
+        else:
+            await self.record_job(file, kind="realtime", stage="running")
+            try:
+                realtime_result = await self.realtime_executor.run(file, self.get_input_file(file))
+            except Exception as e:
+                print(f"An error occurred while processing file: {file} in real time. Error: {e}")
+                file_write_result = await self.copy_input_file(file, self.error_storage_handler, error_directory_name, file_wo_directory)
+                cleanup_status = await self.cleanup_batch(file, None, None, None)
+                return None
+            await self.record_job(file, stage="finished", status="completed", details={"realtime": realtime_result})
+        return {
+            "file": file,
+            "input_file_id": None,
+            "batch_job_id": None,
+            "status": "completed",
+            "error_file_id": None,
+            "output_file_id": None,
+            "errors": [],
+            "token_size": token_size,
+            "file_id": None,
+            "deployment": self.deployment_router.deployments[0].name,
+            "realtime": realtime_result
+        }
+
+    async def filter_cached_requests(self, file):
+        #The split is recorded in the ledger so a resumed job uploads the same filtered file
+        ledger_entry = self.job_ledger.get(file) if self.job_ledger is not None else None
+        if ledger_entry is not None and "cache" in ledger_entry["details"]:
+            return ledger_entry["details"]["cache"]
+        try:
+            cache_result = await asyncio.to_thread(self.result_cache.filter_input, self.input_storage_handler, file,
+                                                   self.get_input_file(file))
+        except Exception as e:
+            print(f"Could not look up file: {file} in the result cache, all requests will be submitted. Error: {e}")
+            return None
+        await self.record_job(file, details={"cache": cache_result})
+        return cache_result
+
+    async def submit_sharded_batch_jobs(self, file, file_wo_directory, error_directory_name, filename_only, 
+                                        file_extension, session):
+        token_size = await self.get_token_size(file, file_wo_directory)
+        if token_size is None:
             return None
-        file_id = file_content_json['id']
-        print(f"file_id: {file_content_json['id']}")
-        #TODO: Check if the file was uploaded successfully, if not, move to error folder and cleanup
-        await self.aoai_client.wait_for_file_upload(file_id)
+        ledger_entry = self.job_ledger.get(file) if self.job_ledger is not None else None
         try:
-            initial_batch_response = self.aoai_client.create_batch_job(file_id)
+            if ledger_entry is not None and "shards" in ledger_entry["details"]:
+                shards = ledger_entry["details"]["shards"]
+            else:
+                shards = await asyncio.to_thread(self.file_sharder.create_shards, file, self.get_input_file(file))
+                await self.record_job(file, kind="sharded", details={"shards": shards})
         except Exception as e:
-            print(f"An error occurred while creating batch job for file: {file}. Error: {e}")
-            file_write_result = self.error_storage_handler.write_content_to_directory(batch_file_data,error_directory_name,file_wo_directory)
-            cleanup_status = self.cleanup_batch(file_wo_directory,None, None, None)
+            print(f"Could not split file: {file} into shards. Error: {e}")
+            file_write_result = await self.copy_input_file(file, self.error_storage_handler, error_directory_name, file_wo_directory)
+            cleanup_status = await self.cleanup_batch(file, None, None, None)
             return None
-        #This takes start time as a param
-        (finished_batch_response) = await self.aoai_client.wait_for_batch_job(initial_batch_response.id)
+        #Shards run as parallel batch jobs and their results are merged back per original input file
+        shard_jobs = await asyncio.gather(*[self.run_batch_job(shard, session, "shard", file) for shard in shards])
+        errors = []
+        for job_data in shard_jobs:
+            if job_data["error"] is not None:
+                errors.append(f"Shard {job_data['file']}: {job_data['error']}")
+            for error in job_data["errors"]:
+                errors.append(f"Shard {job_data['file']}: {error}")
         batch_data = {
             "file": file,
-            "input_file_id": finished_batch_response.input_file_id,
-            "batch_job_id": initial_batch_response.id,
-            "error_file_id": finished_batch_response.error_file_id,
-            "output_file_id": finished_batch_response.output_file_id,
+            "input_file_id": [job_data["input_file_id"] for job_data in shard_jobs],
+            "batch_job_id": [job_data["batch_job_id"] for job_data in shard_jobs],
+            "status": "completed" if all(job_data["status"] == "completed" for job_data in shard_jobs) else "failed",
+            "error_file_id": [job_data["error_file_id"] for job_data in shard_jobs if job_data["error_file_id"] is not None],
+            "output_file_id": [job_data["output_file_id"] for job_data in shard_jobs if job_data["output_file_id"] is not None],
+            "errors": errors,
             "token_size": token_size,
-            "initial_batch_response": initial_batch_response,
-            "finished_batch_response": finished_batch_response,
-            "file_id": file_id,
-            "batch_file_data": batch_file_data
+            "file_id": [job_data["file_id"] for job_data in shard_jobs],
+            "deployment": [job_data["deployment"] for job_data in shard_jobs],
+            "shards": [{
+                "shard_file": job_data["file"],
+                "file_id": job_data["file_id"],
+                "deployment": job_data["deployment"],
+                "input_file_id": job_data["input_file_id"],
+                "batch_job_id": job_data["batch_job_id"],
+                "status": job_data["status"],
+                "output_file_id": job_data["output_file_id"],
+                "error_file_id": job_data["error_file_id"]
+            } for job_data in shard_jobs]
         }
         return batch_data
+
+    async def run_batch_job(self, file, session, kind="file", parent=None):
+        #Uploads a file from the input filesystem and runs it as one batch job through to a terminal state.
+        #Each stage is recorded in the job ledger so an interrupted job is reattached to rather than resubmitted.
+        #The job runs on the least-loaded deployment and fails over to another one if its deployment misbehaves.
+        ledger_entry = self.job_ledger.get(file) if self.job_ledger is not None else None
+        deployment = None
+        if ledger_entry is not None and ledger_entry["file_id"] is not None:
+            #A job that was already uploaded has to be resumed on the deployment that holds its file
+            deployment = self.deployment_router.get_deployment(ledger_entry["details"].get("deployment"))
+            if deployment is None:
+                deployment = self.deployment_router.deployments[0]
+        tried_deployments = []
+        while True:
+            if deployment is None:
+                deployment = self.deployment_router.select(tried_deployments)
+            job_data = await self.run_batch_job_on_deployment(file, session, kind, parent, deployment, ledger_entry)
+            if not job_data.pop("failover"):
+                return job_data
+            tried_deployments.append(deployment.name)
+            deployment = self.deployment_router.select(tried_deployments)
+            if deployment is None:
+                return job_data
+            #The job starts over on the next deployment; files belong to the endpoint they were uploaded to
+            self.deployment_router.failovers += 1
+            self.metrics.increment("failovers")
+            print(f"Failing over batch job for file {file} to deployment {deployment.name}")
+            ledger_entry = None
+            await self.record_job(file, kind=kind, parent=parent, stage="pending", file_id=None, batch_id=None)
+
+    async def run_batch_job_on_deployment(self, file, session, kind, parent, deployment, ledger_entry):
+        batch_storage_path = self.batch_path + file
+        aoai_client = deployment.client
+        job_data = {
+            "file": file,
+            "deployment": deployment.name,
+            "file_id": None,
+            "input_file_id": None,
+            "batch_job_id": None,
+            "status": None,
+            "error_file_id": None,
+            "output_file_id": None,
+            "errors": [],
+            "error": None,
+            "failover": False
+        }
+        file_id = None
+        batch_id = None
+        if ledger_entry is not None:
+            file_id = ledger_entry["file_id"]
+            batch_id = ledger_entry["batch_id"]
+            if batch_id is None and file_id is not None:
+                #The process may have stopped between creating the batch job and recording it
+                batch_id = await aoai_client.find_batch_for_input_file(file_id)
+            if batch_id is not None:
+                print(f"Reattaching to batch job {batch_id} for file {file}")
+        admission_controller = self.get_admission_controller(deployment)
+        tokens = await self.get_admission_tokens(file)
+        if admission_controller is not None:
+            if batch_id is not None:
+                admission_controller.reserve(file, tokens)
+            else:
+                #Quota is acquired before the upload so a file waiting for room isn't left stored on the service
+                await admission_controller.acquire(file, tokens)
+        if file_id is None:
+            with self.metrics.span("upload"):
+                upload_response = await aoai_client.upload_batch_input_file_async(file,batch_storage_path, session)
+            if not upload_response:
+                print(f"An error occurred while uploading file {file}. Please check the file and try again.")
+                job_data["error"] = "The file could not be uploaded."
+                job_data["failover"] = True
+                self.deployment_router.report_error(deployment, f"upload of file {file} failed")
+                self.release_admission(admission_controller, file)
+                return job_data
+            file_content_json = upload_response
+            if "error" in file_content_json:
+                print(f"An error occurred while uploading file {file}. Please check the file and try again.\n\nCode: "+file_content_json["error"]["code"]+"\n\nMessage: "+file_content_json["error"]["message"])
+                job_data["error"] = file_content_json["error"]["message"]
+                self.release_admission(admission_controller, file)
+                return job_data
+            file_id = file_content_json['id']
+            print(f"file_id: {file_content_json['id']}")
+            await self.record_job(file, kind=kind, parent=parent, stage="uploaded", file_id=file_id,
+                                  details={"deployment": deployment.name})
+        job_data["file_id"] = file_id
+        self.deployment_router.register_files(deployment, file_id)
+        if batch_id is None:
+            with self.metrics.span("file_processing"):
+                file_response = await aoai_client.wait_for_file_upload(file_id)
+            if file_response.status == "error":
+                #The service rejected the file, so it goes to the error directory rather than to another deployment
+                job_data["error"] = f"File {file_id} could not be processed: {getattr(file_response, 'status_details', None)}"
+                self.release_admission(admission_controller, file)
+                await self.delete_batch_files(file_id, None, None)
+                job_data["file_id"] = None
+                return job_data
+        quota_attempt = 0
+        while True:
+            if batch_id is None:
+                try:
+                    initial_batch_response = await aoai_client.create_batch_job_async(file_id)
+                except Exception as e:
+                    self.release_admission(admission_controller, file)
+                    if self.is_quota_exceeded(admission_controller, [getattr(e, "code", None)], quota_attempt):
+                        quota_attempt = await self.wait_for_quota(admission_controller, file, tokens, quota_attempt)
+                        continue
+                    print(f"An error occurred while creating batch job for file: {file}. Error: {e}")
+                    job_data["error"] = str(e)
+                    job_data["failover"] = True
+                    self.deployment_router.report_error(deployment, f"batch job for file {file} could not be created")
+                    await self.delete_batch_files(file_id, None, None)
+                    job_data["file_id"] = None
+                    return job_data
+                batch_id = initial_batch_response.id
+                await self.record_job(file, kind=kind, parent=parent, stage="submitted", batch_id=batch_id)
+            #This takes start time as a param
+            start_time = time.monotonic()
+            self.deployment_router.start_job(deployment, tokens)
+            finished_batch_response = None
+            try:
+                (finished_batch_response) = await self.deployment_router.wait_for_batch_job(deployment, batch_id)
+            finally:
+                #Tokens stop counting against the enqueued quota once the batch reaches a terminal state
+                self.release_admission(admission_controller, file)
+                latency = time.monotonic() - start_time if finished_batch_response is not None else None
+                self.deployment_router.finish_job(deployment, tokens, latency)
+            if finished_batch_response is not None:
+                self.metrics.record("batch_wait", latency)
+                self.metrics.record_batch(finished_batch_response)
+            if finished_batch_response is None:
+                #The batch stalled in validating and was cancelled
+                job_data["error"] = f"Batch job {batch_id} stalled in validating."
+                job_data["failover"] = True
+                await self.delete_batch_files(file_id, None, None)
+                job_data["file_id"] = None
+                return job_data
+            if (finished_batch_response.status == "failed" and
+                self.is_quota_exceeded(admission_controller, self.get_batch_error_codes(finished_batch_response), quota_attempt)):
+                #Quota failures are resubmitted from the uploaded file instead of going to the error directory
+                await self.record_job(file, kind=kind, parent=parent, stage="uploaded", batch_id=None)
+                batch_id = None
+                quota_attempt = await self.wait_for_quota(admission_controller, file, tokens, quota_attempt)
+                continue
+            break
+        self.file_token_counts.pop(file, None)
+        job_data["input_file_id"] = finished_batch_response.input_file_id
+        job_data["batch_job_id"] = batch_id
+        job_data["status"] = finished_batch_response.status
+        job_data["error_file_id"] = finished_batch_response.error_file_id
+        job_data["output_file_id"] = finished_batch_response.output_file_id
+        job_data["errors"] = self.get_batch_errors(finished_batch_response)
+        self.deployment_router.register_files(deployment, job_data["output_file_id"], job_data["error_file_id"])
+        await self.record_job(file, kind=kind, parent=parent, stage="finished", status=job_data["status"],
+                              output_file_id=job_data["output_file_id"], error_file_id=job_data["error_file_id"])
+        return job_data
+
+    async def retry_failed_requests(self, batch_data, session):
+        #Requests that failed with a transient error are resubmitted as smaller follow-up batches. The retried
+        #successes are merged into the output when results are written and only lasting failures reach the error file.
+        file = batch_data["file"]
+        input_file = self.get_input_file(file)
+        if "cache" in batch_data and batch_data["cache"]["uncached_file"] is not None:
+            input_file = batch_data["cache"]["uncached_file"]
+        retries = []
+        recovered_custom_ids = set()
+        error_file_ids = self.get_result_file_ids(batch_data, "error_file_id")
+        custom_ids = await self.get_retryable_custom_ids(error_file_ids)
+        for attempt in range(1, self.request_retrier.max_attempts + 1):
+            if len(custom_ids) == 0:
+                break
+            retry_file = self.request_retrier.get_retry_path(file, attempt)
+            ledger_entry = self.job_ledger.get(retry_file) if self.job_ledger is not None else None
+            if ledger_entry is None or ledger_entry["file_id"] is None:
+                retry_delay = self.request_retrier.get_delay(attempt)
+                print(f"Retrying {len(custom_ids)} failed request(s) of file {file} in {retry_delay}s "
+                      f"(attempt {attempt} of {self.request_retrier.max_attempts})")
+                await asyncio.sleep(retry_delay)
+                await asyncio.to_thread(self.request_retrier.write_retry_file, input_file, custom_ids, retry_file)
+            job_data = await self.run_batch_job(retry_file, session, "retry", file)
+            self.metrics.increment("request_retries", len(custom_ids))
+            retries.append({
+                "retry_file": retry_file,
+                "attempt": attempt,
+                "request_count": len(custom_ids),
+                "deployment": job_data["deployment"],
+                "file_id": job_data["file_id"],
+                "batch_job_id": job_data["batch_job_id"],
+                "status": job_data["status"],
+                "output_file_id": job_data["output_file_id"],
+                "error_file_id": job_data["error_file_id"]
+            })
+            if job_data["error"] is not None:
+                print(f"Retry of failed requests of file {file} could not be submitted. Error: {job_data['error']}")
+                break
+            recovered_custom_ids.update(await self.get_succeeded_custom_ids(job_data["output_file_id"]))
+            custom_ids = await self.get_retryable_custom_ids(self.get_result_file_ids(job_data, "error_file_id"))
+        if len(retries) > 0:
+            print(f"Recovered {len(recovered_custom_ids)} failed request(s) of file {file} in {len(retries)} retry attempt(s)")
+            batch_data["retries"] = retries
+            batch_data["recovered_custom_ids"] = list(recovered_custom_ids)
+
+    async def get_retryable_custom_ids(self, error_file_ids):
+        custom_ids = set()
+        for error_file_id in error_file_ids:
+            chunks = self.stream_result_file(error_file_id)
+            async for line in Utils.iter_lines_async(chunks):
+                custom_id = self.request_retrier.get_retryable_custom_id(line)
+                if custom_id is not None:
+                    custom_ids.add(custom_id)
+        return custom_ids
+
+    async def get_succeeded_custom_ids(self, output_file_id):
+        custom_ids = set()
+        if output_file_id is None:
+            return custom_ids
+        chunks = self.stream_result_file(output_file_id)
+        async for line in Utils.iter_lines_async(chunks):
+            try:
+                result = json.loads(line)
+            except Exception:
+                continue
+            if (result.get("response") or {}).get("status_code") == 200:
+                custom_ids.add(result.get("custom_id"))
+        return custom_ids
+
+    def get_result_file_ids(self, batch_data, key):
+        file_ids = batch_data[key] if isinstance(batch_data[key], list) else [batch_data[key]]
+        retry_file_ids = [retry[key] for retry in batch_data.get("retries", [])]
+        if key == "error_file_id":
+            #The latest failure of a request is kept when error files are merged
+            file_ids = list(reversed(retry_file_ids)) + file_ids
+        else:
+            file_ids = file_ids + retry_file_ids
+        return [file_id for file_id in file_ids if file_id is not None]
+
+    async def get_admission_tokens(self, file):
+        #The prompt tokens of the file, or a byte-based estimate when token counting is not configured
+        if file in self.file_token_counts:
+            return self.file_token_counts[file]
+        tokens = None
+        if self.token_counter is not None:
+            try:
+                tokens = (await self.token_counter.count_file_async(self.input_storage_handler, file))["tokens"]
+            except Exception as e:
+                print(f"Could not count tokens in file: {file}, using an estimate. Error: {e}")
+        if tokens is None:
+            tokens = await asyncio.to_thread(self.input_storage_handler.get_file_size_by_path, file) // 4
+        self.file_token_counts[file] = tokens
+        return tokens
+
+    def get_admission_controller(self, deployment):
+        admission_controller = deployment.admission_controller
+        if admission_controller is not None and admission_controller.is_enabled():
+            return admission_controller
+        return None
+
+    def release_admission(self, admission_controller, file):
+        if admission_controller is not None:
+            admission_controller.release(file)
+
+    def is_quota_exceeded(self, admission_controller, error_codes, quota_attempt):
+        return (admission_controller is not None and quota_attempt < admission_controller.max_retries and
+                admission_controller.is_quota_error(error_codes))
+
+    async def wait_for_quota(self, admission_controller, file, tokens, quota_attempt):
+        #The file's tokens were released when its batch failed, so they are acquired again before it is resubmitted
+        admission_controller.quota_failures += 1
+        self.metrics.increment("quota_retries")
+        retry_delay = admission_controller.get_retry_delay(quota_attempt)
+        print(f"Batch job for file: {file} exceeded the enqueued token quota, requeueing in {retry_delay}s")
+        await asyncio.sleep(retry_delay)
+        await admission_controller.acquire(file, tokens)
+        return quota_attempt + 1
+
+    async def record_job(self, source, **fields):
+        if self.job_ledger is not None:
+            await self.job_ledger.record_async(source, **fields)
+
+    async def remove_job(self, source):
+        if self.job_ledger is not None:
+            await self.job_ledger.remove_async(source)
+
+    def get_ledger_batch_data(self, ledger_entry):
+        #Rebuilds the ids needed for cleanup of a job whose results were written before the process stopped
+        child_entries = self.job_ledger.get_children(ledger_entry["source"])
+        retry_entries = [child_entry for child_entry in child_entries if child_entry["kind"] == "retry"]
+        for retry_entry in retry_entries:
+            self.register_ledger_files(retry_entry)
+        if ledger_entry["kind"] == "realtime":
+            return {"realtime": ledger_entry["details"]["realtime"], "file_id": None, "output_file_id": None, "error_file_id": None}
+        retries = [{
+            "retry_file": retry_entry["source"],
+            "file_id": retry_entry["file_id"],
+            "output_file_id": retry_entry["output_file_id"],
+            "error_file_id": retry_entry["error_file_id"]
+        } for retry_entry in retry_entries]
+        if ledger_entry["kind"] == "sharded":
+            shard_entries = [child_entry for child_entry in child_entries if child_entry["kind"] == "shard"]
+            for shard_entry in shard_entries:
+                self.register_ledger_files(shard_entry)
+            return {"retries": retries, "shards": [{
+                "shard_file": shard_entry["source"],
+                "file_id": shard_entry["file_id"],
+                "output_file_id": shard_entry["output_file_id"],
+                "error_file_id": shard_entry["error_file_id"]
+            } for shard_entry in shard_entries]}
+        if "cache" in ledger_entry["details"] or "validated_file" in ledger_entry["details"]:
+            #The batch job ran on the filtered file, which has its own ledger entry
+            job_entry = next((child_entry for child_entry in child_entries if child_entry["kind"] == "filtered"), ledger_entry)
+            self.register_ledger_files(job_entry)
+            batch_data = {
+                "retries": retries,
+                "file": ledger_entry["source"],
+                "file_id": job_entry["file_id"],
+                "output_file_id": job_entry["output_file_id"],
+                "error_file_id": job_entry["error_file_id"]
+            }
+            if "cache" in ledger_entry["details"]:
+                batch_data["cache"] = ledger_entry["details"]["cache"]
+            return batch_data
+        self.register_ledger_files(ledger_entry)
+        return {
+            "retries": retries,
+            "file_id": ledger_entry["file_id"],
+            "output_file_id": ledger_entry["output_file_id"],
+            "error_file_id": ledger_entry["error_file_id"]
+        }
+
+    def register_ledger_files(self, ledger_entry):
+        deployment = self.deployment_router.get_deployment(ledger_entry["details"].get("deployment"))
+        if deployment is not None:
+            self.deployment_router.register_files(deployment, ledger_entry["file_id"], ledger_entry["output_file_id"],
+                                                  ledger_entry["error_file_id"])
+
+    def resume_jobs(self, scheduler):
+        #Queues every job left unfinished by a previous run ahead of any new input
+        if self.job_ledger is None:
+            return 0
+        resumed = 0
+        for ledger_entry in self.job_ledger.get_incomplete():
+            if ledger_entry["kind"] == "pack":
+                pack = {"pack_file": ledger_entry["source"], "files": ledger_entry["details"]["files"]}
+                if scheduler.submit(pack["pack_file"], pack):
+                    self.packed_files.update(pack["files"])
+                    resumed += 1
+            elif scheduler.submit(ledger_entry["source"]):
+                resumed += 1
+        if resumed > 0:
+            print(f"Resuming {resumed} unfinished job(s) from the job ledger")
+        return resumed
+
+    async def get_token_size(self, file, file_wo_directory):
+        #Only references to the input file are kept for the lifetime of the job; the content is never held in memory.
+        #Token counting streams the file and runs on the token counter's process pool, off the event loop.
+        token_size = "N/A"
+        try:
+            if self.local_download_path is not None:
+                output_path = os.path.join(self.local_download_path, file)
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                with self.metrics.span("download"):
+                    await asyncio.to_thread(self.input_storage_handler.save_file_to_local_by_path, self.get_input_file(file),
+                                            output_path)
+                if self.count_tokens:
+                    with self.metrics.span("token_count"):
+                        token_size = (await self.token_counter.count_local_file_async(output_path))["tokens"]
+            elif self.count_tokens:
+                with self.metrics.span("token_count"):
+                    token_size = (await self.token_counter.count_file_async(self.input_storage_handler,
+                                                                            self.get_input_file(file)))["tokens"]
+            if self.count_tokens:
+                self.file_token_counts[file] = token_size
+                self.metrics.increment("input_tokens", token_size)
+        except Exception as e:
+            print(f"Could not download file: {file}. Error: {e}")
+            return None
+        if self.count_tokens:
+            print(f"File {file} has {token_size} tokens")
+        return token_size
+
+    async def should_shard(self, file):
+        if self.file_sharder is None or not self.file_sharder.is_enabled():
+            return False
+        #Files in subdirectories of the input directory are looked up by their full path
+        return await asyncio.to_thread(self.file_sharder.needs_sharding, self.get_input_file(file))
+
+    def get_queue_wait_time(self, key):
+        #Seconds the file, or the pack it went out in, waited for a scheduler slot
+        return self.scheduler.get_wait_time(key) if self.scheduler is not None else None
+
+    def get_input_file(self, file):
+        #The path the file's requests are read from: its staged valid lines when validation filtered it
+        return self.validated_files.get(file, file)
+
+    def get_batch_errors(self, batch_response):
+        if batch_response.errors is None or batch_response.errors.data is None:
+            return []
+        return [error.message for error in batch_response.errors.data]
+
+    def get_batch_error_codes(self, batch_response):
+        if batch_response.errors is None or batch_response.errors.data is None:
+            return []
+        return [error.code for error in batch_response.errors.data]
+
+    async def copy_input_file(self, file, destination_storage_handler, destination_directory, destination_filename):
+        return await asyncio.to_thread(self.input_storage_handler.copy_file_to_filesystem, file,
+                                       destination_storage_handler.file_system_name, destination_directory, destination_filename)
     
-    def process_batch_result(self,batch_data, filename_only, file_extension, file_wo_directory, 
+    async def process_batch_result(self,batch_data, filename_only, file_extension, file_wo_directory, 
+                             error_directory_name, output_directory_name):
+        #Result files are streamed from the service into storage; the time spent waiting on the service is result_download
+        with self.metrics.span("result_write", exclude="result_download"):
+            await self.write_batch_results(batch_data, filename_only, file_extension, file_wo_directory,
+                                           error_directory_name, output_directory_name)
+
+    async def write_batch_results(self,batch_data, filename_only, file_extension, file_wo_directory, 
                              error_directory_name, output_directory_name):
         batch_metadata = self.create_batch_metadata(batch_data)
         metadata_filename = f"{filename_only}_metadata."+file_extension
-        if batch_data["error_file_id"] is not None:
-            error_file_content = self.aoai_client.aoai_client.files.content(batch_data["error_file_id"])
-            error_file_content_string = str(error_file_content.text)
-        else:
-            errors = batch_data["finished_batch_response"].errors.data
+        filename = batch_data["file"]
+        file_id = batch_data["batch_job_id"]
+        error_filename = f"{filename_only}_error."+file_extension
+        #Each result file is downloaded once; byte counts of 0 mean there was nothing to write and None means the write failed
+        if "realtime" in batch_data:
+            error_bytes_written = await self.write_staged_result_file(batch_data["realtime"]["error_file"], self.error_storage_handler,
+                                                                      error_directory_name, error_filename)
+        elif "shards" in batch_data or "retries" in batch_data:
+            #Requests recovered by a retry are left out of the merged error file
+            error_lines = [json.dumps({"custom_id": None, "error": {"message": error}}).encode() + b"\n" for error in batch_data["errors"]]
+            error_bytes_written = await self.write_merged_result_files(self.get_result_file_ids(batch_data, "error_file_id"),
+                                                                       self.error_storage_handler, error_directory_name, error_filename,
+                                                                       error_lines, batch_data.get("recovered_custom_ids"))
+        elif batch_data["error_file_id"] is not None:
+            error_bytes_written = await self.write_result_file(batch_data["error_file_id"], self.error_storage_handler,
+                                                               error_directory_name, error_filename)
+        elif len(batch_data["errors"]) > 0:
             error_file_content = {}
             error_index = 1
-            for error in errors:
-                error_file_content["Error "+str(error_index)] = error.message
+            for error in batch_data["errors"]:
+                error_file_content["Error "+str(error_index)] = error
+                error_index += 1
             error_file_content_string = json.dumps(error_file_content)
-        if batch_data["output_file_id"] is not None:
-            output_file_content = self.aoai_client.aoai_client.files.content(batch_data["output_file_id"])  
-            output_file_content_string = str(output_file_content.text)
+            error_bytes_written = await self.write_result_content(error_file_content_string, self.error_storage_handler,
+                                                                  error_directory_name, error_filename)
         else:
-            output_file_content = ""
-            output_file_content_string = "" 
-        filename = batch_data["file"]
-        file_id = batch_data["initial_batch_response"].id
-        if not error_file_content_string == "":
-            error_filename = f"{filename_only}_error."+file_extension
+            error_bytes_written = 0
+        self.metrics.increment("bytes_written", error_bytes_written or 0)
+        output_filename = f"{filename_only}_output."+file_extension
+        if "realtime" in batch_data:
+            output_bytes_written = await self.write_staged_result_file(batch_data["realtime"]["output_file"], self.processed_storage_handler,
+                                                                       output_directory_name, output_filename)
+        elif "cache" in batch_data:
+            output_bytes_written = await self.write_cached_result_files(batch_data, self.processed_storage_handler,
+                                                                        output_directory_name, output_filename)
+        elif "shards" in batch_data or "retries" in batch_data:
+            output_bytes_written = await self.write_merged_result_files(self.get_result_file_ids(batch_data, "output_file_id"),
+                                                                        self.processed_storage_handler, output_directory_name,
+                                                                        output_filename)
+        elif batch_data["output_file_id"] is not None:
+            output_bytes_written = await self.write_result_file(batch_data["output_file_id"], self.processed_storage_handler,
+                                                                output_directory_name, output_filename)
+        else:
+            output_bytes_written = 0
+        self.metrics.increment("bytes_written", output_bytes_written or 0)
+        #Metadata is written once both result files are, so it carries the usage counted from them
+        batch_metadata["usage"] = self.usage_tracker.get_file_usage()
+        if error_bytes_written != 0:
             batch_data["error_file_name"] = error_filename
-            error_file_content_json = error_file_content_string
             error_file_metadata = json.dumps(batch_metadata)
-            error_content_write_result = self.error_storage_handler.write_content_to_directory(error_file_content_json,error_directory_name,error_filename)
-            error_metadata_write_result = self.error_storage_handler.write_content_to_directory(error_file_metadata,error_directory_name,metadata_filename)
-            file_write_result = self.error_storage_handler.write_content_to_directory(batch_data["batch_file_data"],error_directory_name,file_wo_directory)
-            if error_content_write_result and error_metadata_write_result:
+            #The metadata and the copy of the input file are independent writes and go out together
+            error_metadata_write_result, file_write_result = await asyncio.gather(
+                self.error_storage_handler.write_content_to_directory_async(error_file_metadata,error_directory_name,metadata_filename),
+                self.copy_input_file(filename, self.error_storage_handler, error_directory_name, file_wo_directory))
+            if error_bytes_written is not None and error_metadata_write_result:
                 print(f"An error file with details written to the 'error' directory.")
             else:
                 print(f"There was a problem processing file: {filename} and details could not be written to storage. Please check {file_id} for more details.")
-        if not output_file_content_string == "":
-            output_filename = f"{filename_only}_output."+file_extension
+        if output_bytes_written != 0:
             batch_metadata["output_file_name"] = output_filename
-            output_file_content = self.aoai_client.aoai_client.files.content(batch_metadata["output_file_id"])   
-            output_file_content_json = output_file_content_string
             output_file_metadata = json.dumps(batch_metadata)
-            output_content_write_result = self.processed_storage_handler.write_content_to_directory(output_file_content_json,output_directory_name,output_filename)
-            output_metadata_write_result = self.processed_storage_handler.write_content_to_directory(output_file_metadata,output_directory_name,metadata_filename)
-            file_write_result = self.processed_storage_handler.write_content_to_directory(batch_data["batch_file_data"],output_directory_name,file_wo_directory)
-            if output_content_write_result and output_metadata_write_result:
+            output_metadata_write_result, file_write_result = await asyncio.gather(
+                self.processed_storage_handler.write_content_to_directory_async(output_file_metadata,output_directory_name,metadata_filename),
+                self.copy_input_file(filename, self.processed_storage_handler, output_directory_name, file_wo_directory))
+            if output_bytes_written is not None and output_metadata_write_result:
                 print(f"File: {filename} has been processed successfully. Results are available in the 'processed' directory.")
             else:
                 print(f"File: {filename} has been processed successfully but could not be written to storage. Please check {file_id} for more details.")  
+        await self.write_result_store(filename, filename_only, file_extension, output_directory_name, error_directory_name,
+                                      output_bytes_written, error_bytes_written)
+
+    async def write_result_store(self, file, filename_only, file_extension, output_directory_name, error_directory_name,
+                                 output_bytes_written, error_bytes_written):
+        #The columnar copy is built from the result files just written and goes next to the output, or next to the errors
+        #when nothing succeeded
+        if self.result_store is None or not self.result_store.is_enabled():
+            return
+        result_files = []
+        if output_bytes_written:
+            result_files.append(("output", self.processed_storage_handler, f"{output_directory_name}/{filename_only}_output.{file_extension}"))
+        if error_bytes_written:
+            result_files.append(("error", self.error_storage_handler, f"{error_directory_name}/{filename_only}_error.{file_extension}"))
+        if len(result_files) == 0:
+            return
+        storage_handler, directory_name = ((self.processed_storage_handler, output_directory_name) if output_bytes_written
+                                           else (self.error_storage_handler, error_directory_name))
+        data_filename, index_filename = self.result_store.get_filenames(filename_only)
+        try:
+            with self.metrics.span("result_store"), tempfile.TemporaryDirectory() as local_directory:
+                data_path = os.path.join(local_directory, data_filename)
+                index_path = os.path.join(local_directory, index_filename)
+                sources = [(source, result_storage_handler.iter_file_lines_by_path(path))
+                           for source, result_storage_handler, path in result_files]
+                row_count = await asyncio.to_thread(self.result_store.write, self.input_storage_handler.iter_file_lines_by_path(file),
+                                                    sources, data_path, index_path)
+                for local_path, result_filename in ((data_path, data_filename), (index_path, index_filename)):
+                    await storage_handler.write_stream_to_directory(self.stream_local_file(local_path), directory_name, result_filename)
+            print(f"Result store {data_filename} with {row_count} row(s) written for file: {file}")
+        except Exception as e:
+            print(f"Could not write the result store for file: {file}. Error: {e}")
+
+    async def stream_local_file(self, local_path, chunk_size=4194304):
+        with open(local_path, "rb") as local_file:
+            while True:
+                chunk = await asyncio.to_thread(local_file.read, chunk_size)
+                if len(chunk) == 0:
+                    break
+                yield chunk
+
+    async def write_result_file(self, result_file_id, storage_handler, directory_name, result_filename):
+        if self.stream_results:
+            #Pipe the response body straight into storage in chunks with bounded memory
+            chunks = self.stream_tracked_result_file(result_file_id)
+            return await storage_handler.write_stream_to_directory(chunks, directory_name, result_filename)
+        result_file_content_string = await self.deployment_router.get_client(result_file_id).get_file_content_async(result_file_id)
+        self.usage_tracker.track_content(result_file_content_string, self.get_deployment_name(result_file_id))
+        return await self.write_result_content(result_file_content_string, storage_handler, directory_name, result_filename)
+
+    async def write_merged_result_files(self, result_file_ids, storage_handler, directory_name, result_filename, extra_lines=None,
+                                        excluded_custom_ids=None):
+        chunks = self.merge_result_files(result_file_ids, extra_lines, excluded_custom_ids)
+        return await storage_handler.write_stream_to_directory(chunks, directory_name, result_filename)
+
+    async def write_staged_result_file(self, staged_file, storage_handler, directory_name, result_filename):
+        if staged_file is None:
+            return 0
+        #Only realtime results are staged; their usage is counted under the realtime deployment
+        chunks = self.usage_tracker.track_chunks(self.stream_storage_file(self.input_storage_handler, staged_file),
+                                                 self.realtime_executor.deployment_name or "realtime")
+        return await storage_handler.write_stream_to_directory(chunks, directory_name, result_filename)
+
+    async def write_cached_result_files(self, batch_data, storage_handler, directory_name, result_filename):
+        #Fresh results are merged with the cached responses, and successful fresh responses are added to the cache
+        cache_result = batch_data["cache"]
+        sources = []
+        collector = None
+        output_file_ids = self.get_result_file_ids(batch_data, "output_file_id")
+        if len(output_file_ids) > 0:
+            request_keys = await asyncio.to_thread(self.result_cache.get_request_keys, self.input_storage_handler,
+                                                   cache_result["uncached_file"])
+            collector = self.result_cache.create_collector(request_keys)
+            for output_file_id in output_file_ids:
+                sources.append((self.stream_result_file(output_file_id), self.get_deployment_name(output_file_id)))
+        if cache_result["cached_file"] is not None:
+            #Cached responses cost nothing and aren't counted for usage
+            sources.append((self.stream_storage_file(self.input_storage_handler, cache_result["cached_file"]), None))
+        async def collect(line):
+            if collector.add(line):
+                await asyncio.to_thread(collector.flush)
+        chunks = self.merge_result_streams(sources, on_line=collect if collector is not None else None)
+        bytes_written = await storage_handler.write_stream_to_directory(chunks, directory_name, result_filename)
+        if collector is not None:
+            try:
+                await asyncio.to_thread(collector.flush)
+                await asyncio.to_thread(self.result_cache.cache_store.evict)
+            except Exception as e:
+                print(f"Could not update the result cache for file: {batch_data['file']}. Error: {e}")
+        return bytes_written
+
+    def stream_result_file(self, result_file_id):
+        chunks = self.deployment_router.get_client(result_file_id).stream_file_content_async(result_file_id)
+        return self.metrics.time_chunks(chunks, "result_download")
+
+    def stream_tracked_result_file(self, result_file_id):
+        #Result files that are written out are counted for usage; reads that only inspect results, such as retry checks, are not
+        return self.usage_tracker.track_chunks(self.stream_result_file(result_file_id), self.get_deployment_name(result_file_id))
+
+    def get_deployment_name(self, file_id):
+        deployment = self.deployment_router.file_owners.get(file_id, self.deployment_router.deployments[0])
+        return deployment.name
+
+    async def stream_storage_file(self, storage_handler, file_path):
+        chunks = iter(await asyncio.to_thread(storage_handler.get_file_chunks_by_path, file_path))
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                break
+            yield chunk
+
+    async def merge_result_files(self, result_file_ids, extra_lines=None, excluded_custom_ids=None, chunk_size=4194304):
+        sources = [(self.stream_result_file(result_file_id), self.get_deployment_name(result_file_id))
+                   for result_file_id in result_file_ids]
+        async for chunk in self.merge_result_streams(sources, extra_lines, excluded_custom_ids=excluded_custom_ids, chunk_size=chunk_size):
+            yield chunk
+
+    async def merge_result_streams(self, sources, extra_lines=None, on_line=None, excluded_custom_ids=None, chunk_size=4194304):
+        #Streams several result files into one, keeping the first line seen for each custom_id and
+        #skipping excluded custom_ids altogether. Sources are (chunks, deployment) pairs; usage is counted on the kept
+        #lines only, so requests that were retried or merged from several files are counted once
+        seen_custom_ids = set(excluded_custom_ids or [])
+        buffer = bytearray()
+        for chunks, deployment in sources:
+            usage_lines = []
+            async for line in Utils.iter_lines_async(chunks):
+                custom_id = Utils.get_custom_id(line)
+                if custom_id is not None:
+                    if custom_id in seen_custom_ids:
+                        continue
+                    seen_custom_ids.add(custom_id)
+                if on_line is not None:
+                    await on_line(line)
+                if deployment is not None:
+                    usage_lines.append(line)
+                buffer += line
+                if len(buffer) >= chunk_size:
+                    await self.usage_tracker.track_lines(usage_lines, deployment)
+                    usage_lines = []
+                    yield bytes(buffer)
+                    buffer = bytearray()
+            await self.usage_tracker.track_lines(usage_lines, deployment)
+        for line in extra_lines or []:
+            buffer += line
+        if len(buffer) > 0:
+            yield bytes(buffer)
+
+    async def write_result_content(self, content, storage_handler, directory_name, result_filename):
+        if content == "":
+            return 0
+        if await storage_handler.write_content_to_directory_async(content, directory_name, result_filename):
+            return len(content)
+        return None
     
     def create_batch_metadata(self,batch_data):
         batch_metadata = {
             "file_name": batch_data["file"],
-            "input_file_id": batch_data["finished_batch_response"].input_file_id,
-            "batch_job_id": batch_data["initial_batch_response"].id,
-            "error_file_id": batch_data["finished_batch_response"].error_file_id,
-            "output_file_id": batch_data["finished_batch_response"].output_file_id,
+            "input_file_id": batch_data["input_file_id"],
+            "batch_job_id": batch_data["batch_job_id"],
+            "error_file_id": batch_data["error_file_id"],
+            "output_file_id": batch_data["output_file_id"],
             "token_size": batch_data["token_size"],
-            "file_id": batch_data["file_id"]
+            "file_id": batch_data["file_id"],
+            "deployment": batch_data.get("deployment"),
+            "correlation_id": self.metrics.get_correlation_id(),
+            "stage_timings": self.metrics.get_file_timings(),
+            "queue_wait_seconds": self.get_queue_wait_time(batch_data.get("pack_file", batch_data["file"]))
         }
+        if "pack_file" in batch_data:
+            batch_metadata["pack_file"] = batch_data["pack_file"]
+            batch_metadata["pack_file_count"] = batch_data["pack_file_count"]
+        if "shards" in batch_data:
+            batch_metadata["shard_count"] = len(batch_data["shards"])
+            batch_metadata["shards"] = batch_data["shards"]
+        if "cache" in batch_data:
+            batch_metadata.update(self.result_cache.get_metadata(batch_data["cache"]))
+        if "realtime" in batch_data:
+            realtime_result = batch_data["realtime"]
+            batch_metadata["realtime"] = True
+            for key in ("request_count", "succeeded", "failed", "throttled", "elapsed_seconds"):
+                batch_metadata[f"realtime_{key}"] = realtime_result[key]
+        if "retries" in batch_data:
+            batch_metadata["retry_attempts"] = len(batch_data["retries"])
+            batch_metadata["recovered_request_count"] = len(batch_data["recovered_custom_ids"])
+            batch_metadata["retries"] = batch_data["retries"]
         return batch_metadata
     
-    def cleanup_batch(self,filename,file_id, output_file_id, error_file_id):
+    async def cleanup_batch_data(self, filename, batch_data):
+        if len(batch_data.get("retries", [])) > 0:
+            for retry in batch_data["retries"]:
+                await self.delete_batch_files(retry["file_id"], retry["output_file_id"], retry["error_file_id"])
+            await asyncio.to_thread(self.request_retrier.delete_retry_files, [retry["retry_file"] for retry in batch_data["retries"]])
+        if "shards" in batch_data:
+            for shard in batch_data["shards"]:
+                await self.delete_batch_files(shard["file_id"], shard["output_file_id"], shard["error_file_id"])
+            await asyncio.to_thread(self.file_sharder.delete_shards, [shard["shard_file"] for shard in batch_data["shards"]])
+            return await self.cleanup_batch(filename, None, None, None)
+        if "realtime" in batch_data:
+            await asyncio.to_thread(self.realtime_executor.delete_staging_files, batch_data["realtime"])
+        if "cache" in batch_data and self.result_cache is not None:
+            await asyncio.to_thread(self.result_cache.delete_staging_files, self.input_storage_handler, batch_data["file"], batch_data["cache"])
+        return await self.cleanup_batch(filename, batch_data["file_id"], batch_data["output_file_id"], batch_data["error_file_id"])
+
+    async def cleanup_batch(self,filename,file_id, output_file_id, error_file_id):
+        #filename is the full path of the input file, which may be in a subdirectory of the input directory
         cleanup_result = {}
-        if file_id is not None:
-            print("Deleting input file from client...")
-            deletion_status = self.aoai_client.delete_single(file_id)     
-        if output_file_id is not None:
-            print("Deleting output file from client...")
-            deletion_status = self.aoai_client.delete_single(output_file_id)
-        if error_file_id is not None:
-            print("Deleting error file from client...")
-            deletion_status = self.aoai_client.delete_single(error_file_id)
+        await self.delete_batch_files(file_id, output_file_id, error_file_id)
         if self.local_download_path is not None:
-            local_filename_with_path = self.local_download_path+"\\"+filename
+            local_filename_with_path = os.path.join(self.local_download_path, filename)
             if os.path.exists(local_filename_with_path):
                 os.remove(local_filename_with_path)
                 print(f"File {local_filename_with_path} deleted successfully.")
                 cleanup_result["local_file_deletion"] = True
-        az_storage_deletion_status = self.input_storage_handler.delete_file_data(filename,self.input_directory_client)
+        validated_file = self.validated_files.pop(filename, None)
+        if validated_file is not None:
+            await asyncio.to_thread(self.input_storage_handler.delete_file, validated_file)
+        az_storage_deletion_status = await asyncio.to_thread(self.input_storage_handler.delete_file, filename)
         if az_storage_deletion_status:
             print(f"File {filename} deleted from storage successfully.")
             cleanup_result["az_storage_file_deletion"] = True
         else:
             print(f"An error occurred while deleting file {filename} from storage.")
             cleanup_result["az_storage_file_deletion"] = False
-        return cleanup_result
\ No newline at end of file
+        return cleanup_result
+
+    async def delete_batch_files(self, file_id, output_file_id, error_file_id):
+        #With a file cleaner the deletes are queued and run in the background, off the job's slot
+        for file_type, deleted_file_id in (("input", file_id), ("output", output_file_id), ("error", error_file_id)):
+            if deleted_file_id is None:
+                continue
+            client = self.deployment_router.get_client(deleted_file_id)
+            if self.file_cleaner is not None and self.file_cleaner.is_running():
+                self.file_cleaner.delete(client, deleted_file_id)
+            else:
+                print(f"Deleting {file_type} file from client...")
+                deletion_status = await client.delete_single_async(deleted_file_id)
+            self.deployment_router.forget_file(deleted_file_id)
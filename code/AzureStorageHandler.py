@@ -3,25 +3,45 @@ from azure.storage.filedatalake import (
     DataLakeDirectoryClient,
     FileSystemClient
 )
+from azure.storage.blob import BlobServiceClient, BlobSasPermissions, generate_blob_sas
+from azure.core.exceptions import ResourceExistsError
+import datetime
 import json
+import time
+from Utilities import Utils
 class StorageHandler:
-    def __init__(self, storage_account_name, storage_account_key, file_system_name=None):
+    #Service clients are shared by every handler for the same account and credential so their connection pools are reused
+    service_clients = {}
+    async_service_clients = {}
+    def __init__(self, storage_account_name, storage_account_key, file_system_name=None, max_concurrency=8):
         self.storage_account_name = storage_account_name
         self.storage_account_key = storage_account_key
         self.service_client = self.get_service_client_account_key(storage_account_name, storage_account_key)
+        self.blob_service_client = None
+        self.max_concurrency = max_concurrency
+        #Directories this handler has seen or created, so writes into them don't check for them again
+        self.known_directories = set()
+        self.file_system_name = file_system_name
         if file_system_name is not None:
             self.file_system_client = self.get_file_system_client(file_system_name)
         else:
             self.file_system_client = None
         self.byte_read_size = 50000
-    def get_directories(self,path):
-        paths = self.file_system_client.get_paths(path=path)
+        #Sizes seen in the most recent listing, so callers can size files without another round trip
+        self.file_sizes = {}
+    def get_directories(self, path, recursive=True, files=None):
+        #With recursive=False only the immediate subdirectories are returned. When a files list is given, the files
+        #of the same listing are added to it, so a walk needs one listing per directory
+        paths = self.file_system_client.get_paths(path=path, recursive=recursive)
         return_paths = []
         for current_path in paths:
             if current_path.is_directory:
                 return_paths.append(current_path.name)
-        #No subdirectories found, return the current directory
-        if len(return_paths) == 0:
+            elif files is not None:
+                files.append(current_path)
+                self.file_sizes[current_path.name] = current_path.content_length
+        #No subdirectories found, return the current directory; a walk collecting files needs the empty list instead
+        if len(return_paths) == 0 and files is None:
             return_paths.append(path)
         return return_paths
     def write_content_to_directory(self, file_content, directory_name, output_filename):
@@ -34,28 +54,72 @@ class StorageHandler:
         else:
             print(f"Error writing file {output_filename} to directory.")
         return write_result
+    async def write_content_to_directory_async(self, file_content, directory_name, output_filename):
+        write_result = False
+        try:
+            await self.create_directory_async(directory_name)
+            file_client = self.get_async_file_client(self.join_path(directory_name, output_filename))
+            await file_client.upload_data(file_content, overwrite=True, max_concurrency=self.max_concurrency)
+            write_result = True
+            print(f"File {output_filename} written to storage directory.")
+        except Exception as e:
+            print(f"Error writing file {output_filename} to directory: {e}")
+        return write_result
+    async def write_stream_to_directory(self, chunks, directory_name, output_filename):
+        #Appends each chunk as it arrives and flushes once at the end; the file is only created if there is content
+        bytes_written = 0
+        try:
+            file_client = None
+            async for chunk in chunks:
+                if len(chunk) == 0:
+                    continue
+                if file_client is None:
+                    await self.create_directory_async(directory_name)
+                    file_client = self.get_async_file_client(self.join_path(directory_name, output_filename))
+                    await file_client.create_file()
+                await file_client.append_data(chunk, bytes_written, len(chunk))
+                bytes_written += len(chunk)
+            if file_client is not None:
+                await file_client.flush_data(bytes_written)
+                print(f"File {output_filename} written to storage directory.")
+        except Exception as e:
+            print(f"Error writing file {output_filename} to directory: {e}")
+            return None
+        return bytes_written
     def get_or_create_directory_client(self,directory_name):
+        if self.get_blob_name(directory_name) in self.known_directories:
+            return self.get_directory_client(directory_name)
         dir_exists = self.check_directory_exists(directory_name)
         if(dir_exists):
             directory_client = self.get_directory_client(directory_name)
+            self.known_directories.add(self.get_blob_name(directory_name))
         else:
             directory_client = self.create_directory(directory_name)
         return directory_client
+    async def create_directory_async(self, directory_name):
+        directory_name = self.get_blob_name(directory_name)
+        if directory_name in self.known_directories:
+            return
+        directory_client = self.get_async_file_system_client().get_directory_client(directory_name)
+        if not await directory_client.exists():
+            try:
+                await directory_client.create_directory()
+            except ResourceExistsError:
+                pass
+        self.known_directories.add(directory_name)
     def write_bytes_to_storage_chunked(self, source_filename,source_directory_client, 
                                        destination_filename,destination_directory_client):
+        #The destination is created once, chunks are appended without flushing and the file is committed by a single flush
         try:
             output_file_stream = destination_directory_client.get_file_client(destination_filename)
             file_content_stream = self.get_file_stream(source_filename,source_directory_client)
-            byte_stream = file_content_stream.read(self.byte_read_size)
+            output_file_stream.create_file()
             offset = 0
-            while len(byte_stream) > 0:
+            for byte_stream in file_content_stream.chunks():
                 size = len(byte_stream)
-                if not output_file_stream.exists():
-                    output_file_stream.upload_data(data=byte_stream, overwrite=True)
-                else:
-                    output_file_stream.append_data(data=byte_stream, offset=offset, length=size, flush=True)
+                output_file_stream.append_data(data=byte_stream, offset=offset, length=size)
                 offset += size
-                byte_stream = file_content_stream.read(self.byte_read_size)
+            output_file_stream.flush_data(offset)
         except Exception as e:
             print(f"Error writing file {source_filename} to destination directory: {e}")
             
@@ -67,6 +131,38 @@ class StorageHandler:
                                             destination_directory_client)
         
         return True
+    def copy_file_to_filesystem(self, source_path, destination_file_system_name, destination_directory, 
+                                destination_filename, timeout=600):
+        #Server-side copy within the storage account; no file content passes through this process
+        copy_result = False
+        try:
+            blob_service_client = self.get_blob_service_client()
+            source_blob_name = self.get_blob_name(source_path)
+            source_blob_client = blob_service_client.get_blob_client(self.file_system_name, source_blob_name)
+            source_sas = generate_blob_sas(self.storage_account_name, self.file_system_name, source_blob_name,
+                                           account_key=self.storage_account_key,
+                                           permission=BlobSasPermissions(read=True),
+                                           expiry=datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1))
+            destination_blob_client = blob_service_client.get_blob_client(destination_file_system_name,
+                                            self.get_blob_name(destination_directory + "/" + destination_filename))
+            copy = destination_blob_client.start_copy_from_url(source_blob_client.url + "?" + source_sas)
+            copy_status = copy["copy_status"]
+            start_time = time.monotonic()
+            while copy_status == "pending" and time.monotonic() - start_time < timeout:
+                time.sleep(1)
+                copy_status = destination_blob_client.get_blob_properties().copy.status
+            if copy_status == "success":
+                copy_result = True
+                print(f"File {source_path} copied to {destination_file_system_name}/{destination_directory}.")
+            else:
+                print(f"Copy of file {source_path} to {destination_file_system_name}/{destination_directory} ended with status {copy_status}.")
+        except Exception as e:
+            print(f"Error copying file {source_path} to {destination_file_system_name}/{destination_directory}: {e}")
+        return copy_result
+    def get_blob_name(self, path):
+        return "/".join([part for part in path.split("/") if part != ""])
+    def join_path(self, directory_name, file_name):
+        return self.get_blob_name(f"{directory_name}/{file_name}")
     def write_json_to_storage(self,output_name,output_data,directory_client):
         return_code = True
         try:
@@ -89,6 +185,7 @@ class StorageHandler:
         return return_status   
     def create_directory(self, directory_name: str) -> DataLakeDirectoryClient:
         directory_client = self.file_system_client.create_directory(directory_name)
+        self.known_directories.add(self.get_blob_name(directory_name))
         return directory_client
     
     def get_directory_client(self, directory_name: str) -> DataLakeDirectoryClient:
@@ -101,6 +198,7 @@ class StorageHandler:
         for path in paths:
             if not path.is_directory:
                 file_list.append(path.name)
+                self.file_sizes[path.name] = path.content_length
         return file_list
     def get_file_stream(self, file_name,directory_client):
         file_client = directory_client.get_file_client(file_name)
@@ -110,6 +208,73 @@ class StorageHandler:
         file_client = directory_client.get_file_client(file_name)
         download = file_client.download_file()
         return download.readall()
+    def iter_file_lines(self, file_name, directory_client):
+        file_client = directory_client.get_file_client(file_name)
+        download = file_client.download_file()
+        return Utils.iter_lines(download.chunks())
+    def get_file_size(self, file_name, directory_client):
+        file_client = directory_client.get_file_client(file_name)
+        return file_client.get_file_properties().size
+    def get_file_size_by_path(self, file_path):
+        if file_path in self.file_sizes:
+            return self.file_sizes[file_path]
+        return self.file_system_client.get_file_client(file_path).get_file_properties().size
+    def iter_file_lines_by_path(self, file_path):
+        download = self.file_system_client.get_file_client(file_path).download_file()
+        return Utils.iter_lines(download.chunks())
+    def get_file_data_by_path(self, file_path):
+        return self.file_system_client.get_file_client(file_path).download_file().readall()
+    def get_file_chunks_by_path(self, file_path):
+        return self.file_system_client.get_file_client(file_path).download_file().chunks()
+    def get_file_metadata(self, file_path):
+        try:
+            return self.file_system_client.get_file_client(file_path).get_file_properties().metadata or {}
+        except Exception as e:
+            print(f"Error reading metadata of file {file_path}: {e}")
+            return {}
+    def get_path_properties(self, path):
+        return [current_path for current_path in self.file_system_client.get_paths(path=path) if not current_path.is_directory]
+    def get_file_writer(self, file_path):
+        file_client = self.file_system_client.get_file_client(self.get_blob_name(file_path))
+        file_client.create_file()
+        return StorageFileWriter(file_client)
+    def file_exists(self, file_path):
+        try:
+            return self.file_system_client.get_file_client(file_path).exists()
+        except Exception as e:
+            return False
+    def acquire_file_lease(self, file_path, lease_duration=60, content=b""):
+        #Creates the file if it doesn't exist and leases it; returns None when another client holds the lease
+        file_client = self.file_system_client.get_file_client(self.get_blob_name(file_path))
+        try:
+            try:
+                file_client.upload_data(content, overwrite=False)
+            except ResourceExistsError:
+                pass
+            return file_client.acquire_lease(lease_duration=lease_duration)
+        except Exception as e:
+            return None
+    def delete_leased_file(self, file_path, lease):
+        return_status = True
+        try:
+            self.file_system_client.get_file_client(self.get_blob_name(file_path)).delete_file(lease=lease)
+        except Exception as e:
+            return_status = False
+        return return_status
+    def delete_file(self, file_path):
+        return_status = True
+        try:
+            self.file_system_client.get_file_client(file_path).delete_file()
+        except Exception as e:
+            return_status = False
+        return return_status
+    async def delete_file_async(self, file_path):
+        return_status = True
+        try:
+            await self.get_async_file_client(file_path).delete_file()
+        except Exception as e:
+            return_status = False
+        return return_status
     def delete_file_data(self, file_name,directory_client):
         return_status = True
         try:
@@ -121,22 +286,76 @@ class StorageHandler:
     def save_file_to_local(self, file_name, directory_client, local_path):
         file_client = directory_client.get_file_client(file_name)
         download = file_client.download_file()
-        data = download.readall()
+        save_result = False
         try:
+            #Stream to disk rather than holding the whole file in memory
             with open(local_path, "wb") as file:
-                file.write(data)
+                download.readinto(file)
             print(f"File {file_name} saved to local path {local_path}")
+            save_result = True
         except Exception as e:
             print(f"An error occurred while saving file {file_name} to local path {local_path}: {e}")
-        return data
+        return save_result
+
+    def save_file_to_local_by_path(self, file_path, local_path):
+        return self.save_file_to_local(self.get_blob_name(file_path), self.file_system_client, local_path)
 
     def get_file_system_client(self, file_system_name: str) -> FileSystemClient:
         file_system_client = self.service_client.get_file_system_client(file_system_name)
         return file_system_client
 
     def get_service_client_account_key(self, account_name, account_key) -> DataLakeServiceClient:
-        account_url = f"https://{account_name}.dfs.core.windows.net"
-        service_client = DataLakeServiceClient(account_url, credential=account_key)
+        client_key = (account_name, account_key)
+        if client_key not in self.service_clients:
+            account_url = f"https://{account_name}.dfs.core.windows.net"
+            self.service_clients[client_key] = DataLakeServiceClient(account_url, credential=account_key)
+        return self.service_clients[client_key]
+
+    def get_async_file_system_client(self):
+        #The async client is created on first use, inside the running event loop, and shared like the sync one
+        client_key = (self.storage_account_name, self.storage_account_key)
+        if client_key not in self.async_service_clients:
+            #The aio clients are only imported once something is written asynchronously
+            from azure.storage.filedatalake.aio import DataLakeServiceClient as AsyncDataLakeServiceClient
+            account_url = f"https://{self.storage_account_name}.dfs.core.windows.net"
+            self.async_service_clients[client_key] = AsyncDataLakeServiceClient(account_url, credential=self.storage_account_key)
+        return self.async_service_clients[client_key].get_file_system_client(self.file_system_name)
+
+    def get_async_file_client(self, file_path):
+        return self.get_async_file_system_client().get_file_client(self.get_blob_name(file_path))
+
+    async def close(self):
+        #Closes the shared async client of this handler's account and credential; it is recreated if used again
+        service_client = self.async_service_clients.pop((self.storage_account_name, self.storage_account_key), None)
+        if service_client is not None:
+            await service_client.close()
+
+    def get_blob_service_client(self) -> BlobServiceClient:
+        if self.blob_service_client is None:
+            account_url = f"https://{self.storage_account_name}.blob.core.windows.net"
+            self.blob_service_client = BlobServiceClient(account_url, credential=self.storage_account_key)
+        return self.blob_service_client
 
-        return service_client
 
+class StorageFileWriter:
+    #Buffers writes and appends them in large blocks, flushing the file once when it is closed
+    def __init__(self, file_client, buffer_size=4194304):
+        self.file_client = file_client
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+        self.offset = 0
+        self.line_count = 0
+    def write(self, data):
+        self.buffer += data
+        self.line_count += 1
+        if len(self.buffer) >= self.buffer_size:
+            self.append_buffer()
+    def append_buffer(self):
+        if len(self.buffer) > 0:
+            self.file_client.append_data(bytes(self.buffer), self.offset, len(self.buffer))
+            self.offset += len(self.buffer)
+            self.buffer = bytearray()
+    def close(self):
+        self.append_buffer()
+        self.file_client.flush_data(self.offset)
+        return self.offset
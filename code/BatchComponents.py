@@ -0,0 +1,22 @@
+class BatchComponents:
+    #The optional feature objects AzureBatch works with. Each one left as None turns its feature off, except the
+    #deployment router, metrics and usage tracker, which AzureBatch creates with their defaults when they are missing.
+    def __init__(self, deployment_router=None, admission_controller=None, token_counter=None, file_sharder=None,
+                 file_packer=None, job_ledger=None, result_cache=None, request_retrier=None, realtime_executor=None,
+                 file_claimer=None, file_cleaner=None, input_validator=None, result_store=None, metrics=None,
+                 usage_tracker=None):
+        self.deployment_router = deployment_router
+        self.admission_controller = admission_controller
+        self.token_counter = token_counter
+        self.file_sharder = file_sharder
+        self.file_packer = file_packer
+        self.job_ledger = job_ledger
+        self.result_cache = result_cache
+        self.request_retrier = request_retrier
+        self.realtime_executor = realtime_executor
+        self.file_claimer = file_claimer
+        self.file_cleaner = file_cleaner
+        self.input_validator = input_validator
+        self.result_store = result_store
+        self.metrics = metrics
+        self.usage_tracker = usage_tracker
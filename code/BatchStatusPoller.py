@@ -0,0 +1,171 @@
+import asyncio
+import datetime
+import time
+
+#The service reports "cancelled"; "canceled" is kept for older API versions
+BATCH_TERMINAL_STATUSES = ("completed", "failed", "cancelled", "canceled", "expired")
+FILE_TERMINAL_STATUSES = ("processed", "error")
+
+class BatchStatusPoller:
+    #Single background poller for every tracked batch job and uploaded file. Statuses are fetched in bulk
+    #through the paginated list endpoints and waiting callers are notified through futures.
+    def __init__(self, load_async_client, batch_status, min_interval=5, max_interval=300, page_size=100, max_pages=10):
+        #Awaited for the client on each poll, so the handler can create it on first use
+        self.load_async_client = load_async_client
+        self.batch_status = batch_status
+        self.file_status = {}
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.batch_waiters = {}
+        self.file_waiters = {}
+        self.wakeup = None
+        self.task = None
+        self.list_calls = 0
+        self.retrieve_calls = 0
+    def ensure_started(self):
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self.run())
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+    def track_batch(self, batch_id, batch_response=None):
+        if batch_id not in self.batch_status:
+            self.batch_status[batch_id] = self.new_entry("validating", batch_response)
+        self.notify()
+    def track_file(self, file_id, file_response=None):
+        if file_id not in self.file_status:
+            self.file_status[file_id] = self.new_entry("uploaded", file_response)
+        self.notify()
+    def new_entry(self, status, response):
+        now = time.monotonic()
+        if response is not None and getattr(response, "status", None) is not None:
+            status = response.status
+        return {
+            "status": status,
+            "response": response,
+            "created_at": getattr(response, "created_at", None),
+            "tracked_at": now,
+            "next_poll": now + self.min_interval,
+            "polls": 0
+        }
+    def notify(self):
+        if self.wakeup is not None:
+            self.wakeup.set()
+    async def wait_for_batch(self, batch_id):
+        self.ensure_started()
+        self.track_batch(batch_id)
+        future = asyncio.get_running_loop().create_future()
+        self.batch_waiters.setdefault(batch_id, []).append(future)
+        return await future
+    async def wait_for_file(self, file_id):
+        self.ensure_started()
+        self.track_file(file_id)
+        future = asyncio.get_running_loop().create_future()
+        self.file_waiters.setdefault(file_id, []).append(future)
+        return await future
+    def get_poll_interval(self, status, age):
+        if status in ("validating", "uploaded", "pending"):
+            return self.min_interval
+        if status in ("finalizing", "cancelling"):
+            return self.min_interval * 3
+        #in_progress jobs run for hours in a 24h window, so back off further the older they get
+        return min(self.max_interval, max(self.min_interval * 6, age / 20))
+    async def run(self):
+        #If the poller can't continue, for example because the client can't be created, its waiters get the error
+        #rather than waiting forever; the next wait starts a new poller
+        try:
+            while True:
+                now = time.monotonic()
+                due_batches = [batch_id for batch_id, entry in self.batch_status.items() if entry["next_poll"] <= now]
+                due_files = [file_id for file_id, entry in self.file_status.items() if entry["next_poll"] <= now]
+                async_client = await self.load_async_client()
+                if len(due_batches) > 0:
+                    await self.poll(due_batches, self.batch_status, self.batch_waiters, BATCH_TERMINAL_STATUSES,
+                                    async_client.batches.list(limit=self.page_size),
+                                    async_client.batches.retrieve, "Batch")
+                if len(due_files) > 0:
+                    await self.poll(due_files, self.file_status, self.file_waiters, FILE_TERMINAL_STATUSES,
+                                    async_client.files.list(purpose="batch", limit=self.page_size),
+                                    async_client.files.retrieve, "File")
+                next_polls = [entry["next_poll"] for entry in list(self.batch_status.values()) + list(self.file_status.values())]
+                timeout = max(0, min(next_polls) - time.monotonic()) if len(next_polls) > 0 else None
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        except Exception as e:
+            print(f"{datetime.datetime.now()} The status poller stopped: {e}")
+            self.fail_waiters(e)
+    async def poll(self, due_ids, status_table, waiters, terminal_statuses, list_request, retrieve, label):
+        remaining = set(due_ids)
+        try:
+            page = await list_request
+            self.list_calls += 1
+            pages = 1
+            while True:
+                for item in page.data:
+                    if item.id in status_table:
+                        self.update_entry(item.id, item, status_table, waiters, terminal_statuses, label)
+                        remaining.discard(item.id)
+                if len(remaining) == 0 or pages >= self.max_pages or not page.has_next_page():
+                    break
+                page = await page.get_next_page()
+                self.list_calls += 1
+                pages += 1
+        except Exception as e:
+            print(f"{datetime.datetime.now()} An error occurred while listing {label.lower()} statuses: {e}")
+        #Anything not found in the listed pages is retrieved individually
+        for item_id in remaining:
+            if item_id not in status_table:
+                continue
+            try:
+                item = await retrieve(item_id)
+                self.retrieve_calls += 1
+                self.update_entry(item_id, item, status_table, waiters, terminal_statuses, label)
+            except Exception as e:
+                print(f"{datetime.datetime.now()} An error occurred while retrieving {label} Id: {item_id}: {e}")
+                if getattr(e, "status_code", None) == 404:
+                    self.resolve(item_id, status_table, waiters, exception=e)
+                else:
+                    status_table[item_id]["next_poll"] = time.monotonic() + self.min_interval
+    def update_entry(self, item_id, item, status_table, waiters, terminal_statuses, label):
+        entry = status_table[item_id]
+        now = time.monotonic()
+        if entry["status"] != item.status:
+            print(f"{datetime.datetime.now()} {label} Id: {item_id}, Status: {item.status}")
+        entry["status"] = item.status
+        entry["response"] = item
+        entry["polls"] += 1
+        if entry["created_at"] is None:
+            entry["created_at"] = getattr(item, "created_at", None)
+        if item.status in terminal_statuses:
+            self.resolve(item_id, status_table, waiters, result=item)
+        else:
+            entry["next_poll"] = now + self.get_poll_interval(item.status, now - entry["tracked_at"])
+    def resolve(self, item_id, status_table, waiters, result=None, exception=None):
+        status_table.pop(item_id, None)
+        for future in waiters.pop(item_id, []):
+            if future.done():
+                continue
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+    def fail_waiters(self, exception):
+        for item_id in list(self.batch_waiters):
+            self.resolve(item_id, self.batch_status, self.batch_waiters, exception=exception)
+        for item_id in list(self.file_waiters):
+            self.resolve(item_id, self.file_status, self.file_waiters, exception=exception)
+    def get_stats(self):
+        return {
+            "tracked_batches": len(self.batch_status),
+            "tracked_files": len(self.file_status),
+            "list_calls": self.list_calls,
+            "retrieve_calls": self.retrieve_calls
+        }
@@ -0,0 +1,200 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import aiohttp
+from AOAIHandler import AOAIHandler
+from AzureBatch import AzureBatch
+from BatchComponents import BatchComponents
+from DeploymentRouter import DeploymentRouter, Deployment
+from FileCleaner import FileCleaner
+from ResultStore import ResultStore
+from LocalStorageHandler import LocalStorageHandler
+
+INPUT_DIRECTORY = "input"
+
+class LoopMonitor:
+    #Samples event-loop lag (how late a short sleep wakes up) and resident memory while a benchmark runs
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.lags = []
+        self.peak_rss_bytes = 0
+        self.task = None
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+    async def stop(self):
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+    async def run(self):
+        while True:
+            start_time = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.monotonic() - start_time - self.interval))
+            self.peak_rss_bytes = max(self.peak_rss_bytes, get_rss_bytes())
+    def get_stats(self):
+        lags = sorted(self.lags)
+        if len(lags) == 0:
+            return {"loop_lag_mean_ms": 0.0, "loop_lag_p99_ms": 0.0, "loop_lag_max_ms": 0.0}
+        return {
+            "loop_lag_mean_ms": round(1000 * sum(lags) / len(lags), 2),
+            "loop_lag_p99_ms": round(1000 * lags[min(len(lags) - 1, int(len(lags) * 0.99))], 2),
+            "loop_lag_max_ms": round(1000 * lags[-1], 2)
+        }
+
+def get_rss_bytes():
+    #Current resident set size where /proc is available, otherwise the process peak
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def create_workload(storage_handler, file_count, requests_per_file, prompt_bytes, model):
+    #Synthetic chat completion requests; prompt_bytes sets the size of each request
+    prompt = ("lorem ipsum " * (prompt_bytes // 12 + 1))[:prompt_bytes]
+    files = []
+    for file_index in range(file_count):
+        file_path = f"{INPUT_DIRECTORY}/file_{file_index:05d}.jsonl"
+        writer = storage_handler.get_file_writer(file_path)
+        for request_index in range(requests_per_file):
+            writer.write(json.dumps({"custom_id": f"request-{request_index}", "method": "POST", "url": "/chat/completions",
+                                     "body": {"model": model, "max_tokens": 50,
+                                              "messages": [{"role": "user", "content": prompt}]}}).encode() + b"\n")
+        writer.close()
+        files.append(file_path)
+    return files
+
+def start_fake_server(args):
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "FakeAOAIServer.py"),
+               "--api-latency", str(args.api_latency), "--file-processing-seconds", str(args.file_processing_seconds),
+               "--validating-seconds", str(args.validating_seconds), "--queue-seconds", str(args.queue_seconds),
+               "--request-seconds", str(args.request_seconds), "--request-failure-rate", str(args.request_failure_rate),
+               "--batch-failure-rate", str(args.batch_failure_rate), "--seed", str(args.seed)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    endpoint = process.stdout.readline().strip().split(" ")[-1]
+    if not endpoint.startswith("http"):
+        process.kill()
+        raise RuntimeError("The fake AOAI server did not start")
+    return process, endpoint
+
+async def call_fake_server(endpoint, method, path):
+    async with aiohttp.ClientSession() as session:
+        async with session.request(method, endpoint + path) as response:
+            return await response.json()
+
+async def run_scenario(args, endpoint, file_count, requests_per_file):
+    await call_fake_server(endpoint, "POST", "fake/reset")
+    with tempfile.TemporaryDirectory() as root_directory:
+        input_storage_handler = LocalStorageHandler(root_directory, "input")
+        error_storage_handler = LocalStorageHandler(root_directory, "error")
+        processed_storage_handler = LocalStorageHandler(root_directory, "processed")
+        files = create_workload(input_storage_handler, file_count, requests_per_file, args.prompt_bytes, args.model)
+        input_bytes = sum(input_storage_handler.get_file_size_by_path(file) for file in files)
+        aoai_client = AOAIHandler({
+            "aoai_endpoint": endpoint,
+            "aoai_key": "benchmark",
+            "aoai_api_version": "2024-10-21",
+            "aoai_deployment_name": args.model,
+            "batch_job_endpoint": "/chat/completions",
+            "completion_window": "24h",
+            "poll_min_interval": args.poll_min_interval,
+            "poll_max_interval": args.poll_min_interval * 10
+        })
+        #The fake server imports input files straight from the local input file system
+        batch_path = "file://" + input_storage_handler.get_local_path("") + "/"
+        deployment_router = DeploymentRouter([Deployment(args.model, aoai_client)])
+        azure_batch = AzureBatch(aoai_client, input_storage_handler, error_storage_handler, processed_storage_handler,
+                                 batch_path, input_storage_handler.get_directory_client(INPUT_DIRECTORY), None, "output", "error",
+                                 stats_interval=3600, components=BatchComponents(
+                                     deployment_router=deployment_router,
+                                     file_cleaner=FileCleaner(deployment_router, max_concurrency=args.cleanup_concurrency),
+                                     result_store=ResultStore(args.result_store_format)))
+        monitor = LoopMonitor()
+        monitor.start()
+        start_time = time.monotonic()
+        log = open(os.devnull, "w") if not args.verbose else sys.stdout
+        try:
+            with contextlib.redirect_stdout(log):
+                scheduler_stats = await azure_batch.process_all_files(files, args.concurrency)
+        finally:
+            elapsed = time.monotonic() - start_time
+            await monitor.stop()
+            with contextlib.redirect_stdout(log):
+                await azure_batch.close()
+            if log is not sys.stdout:
+                log.close()
+        server_stats = await call_fake_server(endpoint, "GET", "fake/stats")
+        output_files = processed_storage_handler.get_file_list("output")
+        result = {
+            "files": file_count,
+            "requests_per_file": requests_per_file,
+            "input_mb": round(input_bytes / 1048576, 2),
+            "concurrency": args.concurrency,
+            "elapsed_seconds": round(elapsed, 2),
+            "files_per_hour": round(file_count * 3600 / elapsed, 1),
+            "completed_files": len([file for file in output_files if file.endswith("_output.jsonl")]),
+            "failed_files": scheduler_stats["failed"],
+            "control_plane_calls": server_stats["total_calls"],
+            "calls_per_file": round(server_stats["total_calls"] / file_count, 2),
+            "calls": server_stats["calls"],
+            "peak_rss_mb": round(monitor.peak_rss_bytes / 1048576, 1),
+            "average_queue_wait_seconds": scheduler_stats["average_wait_seconds"]
+        }
+        result.update(monitor.get_stats())
+        return result
+
+def print_results(results):
+    columns = ("files", "requests_per_file", "input_mb", "elapsed_seconds", "files_per_hour", "completed_files",
+               "calls_per_file", "peak_rss_mb", "loop_lag_p99_ms", "loop_lag_max_ms")
+    print(" ".join(f"{column:>18}" for column in columns))
+    for result in results:
+        print(" ".join(f"{str(result[column]):>18}" for column in columns))
+
+async def run_benchmarks(args):
+    process, endpoint = start_fake_server(args)
+    results = []
+    try:
+        for file_count in args.file_counts:
+            for requests_per_file in args.requests_per_file:
+                print(f"Running {file_count} file(s) of {requests_per_file} request(s)...")
+                results.append(await run_scenario(args, endpoint, file_count, requests_per_file))
+    finally:
+        process.terminate()
+        process.wait()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end throughput benchmark against a local fake AOAI server")
+    parser.add_argument("--file-counts", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--requests-per-file", type=int, nargs="+", default=[10, 1000])
+    parser.add_argument("--prompt-bytes", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--model", default="gpt-4o-batch")
+    parser.add_argument("--cleanup-concurrency", type=int, default=8, help="Background file deletes; 0 deletes inline")
+    parser.add_argument("--result-store-format", default="", choices=["", "parquet", "arrow"])
+    parser.add_argument("--poll-min-interval", type=int, default=1)
+    parser.add_argument("--api-latency", type=float, default=0.01)
+    parser.add_argument("--file-processing-seconds", type=float, default=0.5)
+    parser.add_argument("--validating-seconds", type=float, default=0.5)
+    parser.add_argument("--queue-seconds", type=float, default=1.0)
+    parser.add_argument("--request-seconds", type=float, default=0.0001)
+    parser.add_argument("--request-failure-rate", type=float, default=0.0)
+    parser.add_argument("--batch-failure-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the results as JSON to this file for comparison between runs")
+    parser.add_argument("--verbose", action="store_true", help="Show the accelerator's own output")
+    args = parser.parse_args()
+    results = asyncio.run(run_benchmarks(args))
+    print_results(results)
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import json
+import os
+from Utilities import Utils
+
+CONFIG_CACHE_VERSION = 1
+
+#Settings every configuration must have, with the types they may take
+APP_CONFIG_KEYS = {
+    "storage_config": (str,),
+    "AOAI_config": (str,),
+    "batch_size": (int, str),
+    "count_tokens": (bool, int, str),
+    "download_to_local": (bool,),
+    "continuous_mode": (bool,)
+}
+STORAGE_CONFIG_KEYS = {
+    "input_filesystem_system_name": (str,),
+    "error_filesystem_system_name": (str,),
+    "processed_filesystem_system_name": (str,),
+    "input_directory": (str,),
+    "output_directory": (str,),
+    "error_directory": (str,)
+}
+AZURE_STORAGE_CONFIG_KEYS = {
+    "storage_account_name": (str,),
+    "storage_account_key": (str,)
+}
+#Each deployment may take these from the top level of AOAI_config or set its own
+AOAI_CONFIG_KEYS = {
+    "aoai_key": (str,),
+    "aoai_endpoint": (str,),
+    "aoai_deployment_name": (str,),
+    "aoai_api_version": (str,),
+    "batch_job_endpoint": (str,),
+    "completion_window": (str,)
+}
+
+def check_keys(config, required_keys, name, errors):
+    for key, types in required_keys.items():
+        if key not in config:
+            errors.append(f"{name}: missing {key}")
+        elif not isinstance(config[key], types):
+            errors.append(f"{name}: {key} must be {' or '.join(value_type.__name__ for value_type in types)}")
+
+def parse_bool(value):
+    #Booleans may also be given as 0/1 or as the strings "true"/"false"; returns None for anything else
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, str) and value.strip().lower() in ("true", "false", "1", "0"):
+        return value.strip().lower() in ("true", "1")
+    return None
+
+class ConfigLoader:
+    #Reads app_config and the storage and AOAI configs it points to, and checks them before anything is built so a
+    #bad setting fails at startup rather than partway through a run. With a cache path the validated configs are
+    #kept in a single file along with the size and modification time of each source; later starts read only that
+    #file and skip validation until a source changes. The cache holds the keys in the configs, so it is written
+    #readable by its owner only.
+    def __init__(self, app_config_path, cache_path=""):
+        self.app_config_path = app_config_path
+        self.cache_path = cache_path
+    def load(self):
+        #Returns the app, storage and AOAI configs
+        configs = self.read_cache()
+        if configs is not None:
+            return configs
+        app_config_data = Utils.read_json_data(self.app_config_path)
+        if not isinstance(app_config_data, dict):
+            raise ValueError(f"Invalid configuration: {self.app_config_path} is not a JSON object")
+        errors = []
+        check_keys(app_config_data, {key: APP_CONFIG_KEYS[key] for key in ("storage_config", "AOAI_config")},
+                   "app_config", errors)
+        if len(errors) > 0:
+            raise ValueError("Invalid configuration:\n\t\t" + "\n\t\t".join(errors))
+        storage_config_data = Utils.read_json_data(app_config_data["storage_config"])
+        aoai_config_data = Utils.read_json_data(app_config_data["AOAI_config"])
+        configs = (app_config_data, storage_config_data, aoai_config_data)
+        self.validate(*configs)
+        if self.cache_path != "":
+            self.write_cache(configs)
+        return configs
+    def validate(self, app_config_data, storage_config_data, aoai_config_data):
+        errors = []
+        check_keys(app_config_data, APP_CONFIG_KEYS, "app_config", errors)
+        if "count_tokens" in app_config_data:
+            #Normalised here, so the rest of the run (and the config cache) only ever sees a bool
+            count_tokens = parse_bool(app_config_data["count_tokens"])
+            if count_tokens is None:
+                errors.append("app_config: count_tokens must be true or false")
+            else:
+                app_config_data["count_tokens"] = count_tokens
+        if app_config_data.get("download_to_local") is True and "local_download_path" not in app_config_data:
+            errors.append("app_config: missing local_download_path, which is required when download_to_local is set")
+        if not isinstance(storage_config_data, dict):
+            errors.append("storage_config: not a JSON object")
+        else:
+            check_keys(storage_config_data, STORAGE_CONFIG_KEYS, "storage_config", errors)
+            if storage_config_data.get("storage_type", "adls") == "local":
+                check_keys(storage_config_data, {"local_storage_root": (str,)}, "storage_config", errors)
+            else:
+                check_keys(storage_config_data, AZURE_STORAGE_CONFIG_KEYS, "storage_config", errors)
+        if not isinstance(aoai_config_data, dict):
+            errors.append("AOAI_config: not a JSON object")
+        else:
+            deployments = aoai_config_data.get("deployments") or [{}]
+            if not isinstance(deployments, list):
+                errors.append("AOAI_config: deployments must be a list")
+                deployments = [{}]
+            for index, deployment_config in enumerate(deployments):
+                name = "AOAI_config" if len(deployments) == 1 else f"AOAI_config deployment {index}"
+                handler_config = {key: value for key, value in aoai_config_data.items() if key != "deployments"}
+                handler_config.update(deployment_config)
+                check_keys(handler_config, AOAI_CONFIG_KEYS, name, errors)
+        if len(errors) > 0:
+            raise ValueError("Invalid configuration:\n\t\t" + "\n\t\t".join(errors))
+    def get_sources(self, app_config_data):
+        #Size and modification time of each config file; any change invalidates the cache
+        sources = {}
+        for path in (self.app_config_path, app_config_data["storage_config"], app_config_data["AOAI_config"]):
+            file_stat = os.stat(path)
+            sources[os.path.abspath(path)] = [file_stat.st_size, file_stat.st_mtime_ns]
+        return sources
+    def read_cache(self):
+        if self.cache_path == "" or not os.path.exists(self.cache_path):
+            return None
+        try:
+            with open(self.cache_path, "r") as cache_file:
+                cache = json.load(cache_file)
+            if cache.get("version") != CONFIG_CACHE_VERSION or cache.get("app_config_path") != os.path.abspath(self.app_config_path):
+                return None
+            if cache["sources"] != self.get_sources(cache["app_config"]):
+                return None
+            return cache["app_config"], cache["storage_config"], cache["AOAI_config"]
+        except Exception as e:
+            print(f"Ignoring the config cache {self.cache_path}, the configs will be read again. Error: {e}")
+            return None
+    def write_cache(self, configs):
+        app_config_data, storage_config_data, aoai_config_data = configs
+        cache = {
+            "version": CONFIG_CACHE_VERSION,
+            "app_config_path": os.path.abspath(self.app_config_path),
+            "sources": self.get_sources(app_config_data),
+            "app_config": app_config_data,
+            "storage_config": storage_config_data,
+            "AOAI_config": aoai_config_data
+        }
+        temporary_path = self.cache_path + ".tmp"
+        try:
+            descriptor = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(descriptor, "w") as cache_file:
+                json.dump(cache, cache_file)
+            os.replace(temporary_path, self.cache_path)
+        except Exception as e:
+            print(f"Could not write the config cache {self.cache_path}. Error: {e}")
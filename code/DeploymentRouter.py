@@ -0,0 +1,107 @@
+import asyncio
+import datetime
+import time
+
+class Deployment:
+    #One Azure OpenAI endpoint/deployment and the load it is currently carrying
+    def __init__(self, name, client, admission_controller=None):
+        self.name = name
+        self.client = client
+        self.admission_controller = admission_controller
+        self.in_flight = 0
+        self.enqueued_tokens = 0
+        self.latency = None
+        self.completed = 0
+        self.errors = 0
+        self.unhealthy_until = 0.0
+    def is_healthy(self):
+        return time.monotonic() >= self.unhealthy_until
+
+class DeploymentRouter:
+    #Assigns each batch job to the least-loaded healthy deployment. Load combines in-flight jobs, enqueued tokens and
+    #recent completion latency. Deployments that return errors or leave a batch in validating for too long are
+    #taken out of rotation for a cool-down period so their jobs fail over to another deployment.
+    def __init__(self, deployments, validating_timeout=0, error_cooldown=300, latency_smoothing=0.3):
+        self.deployments = deployments
+        self.validating_timeout = validating_timeout
+        self.error_cooldown = error_cooldown
+        self.latency_smoothing = latency_smoothing
+        #Owning deployment of every uploaded and result file id, so results and cleanup go to the right endpoint
+        self.file_owners = {}
+        self.failovers = 0
+    def get_deployment(self, name):
+        for deployment in self.deployments:
+            if deployment.name == name:
+                return deployment
+        return None
+    def select(self, exclude=()):
+        candidates = [deployment for deployment in self.deployments if deployment.name not in exclude]
+        if len(candidates) == 0:
+            return None
+        #When every deployment is cooling down the least loaded one is still used rather than stalling the job
+        healthy = [deployment for deployment in candidates if deployment.is_healthy()]
+        return min(healthy or candidates, key=self.get_load)
+    def get_load(self, deployment):
+        latencies = [candidate.latency for candidate in self.deployments if candidate.latency is not None]
+        latency_factor = 1.0
+        if deployment.latency is not None and len(latencies) > 0 and min(latencies) > 0:
+            latency_factor = deployment.latency / min(latencies)
+        admission_controller = deployment.admission_controller
+        if admission_controller is not None and admission_controller.is_enabled():
+            token_factor = deployment.enqueued_tokens / admission_controller.max_enqueued_tokens
+        else:
+            token_factor = deployment.enqueued_tokens / max(1, sum(candidate.enqueued_tokens for candidate in self.deployments))
+        return (deployment.in_flight + 1) * latency_factor + token_factor
+    def start_job(self, deployment, tokens):
+        deployment.in_flight += 1
+        deployment.enqueued_tokens += tokens
+    def finish_job(self, deployment, tokens, latency=None):
+        deployment.in_flight -= 1
+        deployment.enqueued_tokens -= tokens
+        if latency is not None:
+            deployment.completed += 1
+            if deployment.latency is None:
+                deployment.latency = latency
+            else:
+                deployment.latency += self.latency_smoothing * (latency - deployment.latency)
+    def report_error(self, deployment, reason):
+        deployment.errors += 1
+        deployment.unhealthy_until = time.monotonic() + self.error_cooldown
+        print(f"{datetime.datetime.now()} Deployment {deployment.name} taken out of rotation for {self.error_cooldown}s: {reason}")
+    def register_files(self, deployment, *file_ids):
+        for file_id in file_ids:
+            if file_id is not None:
+                self.file_owners[file_id] = deployment
+    def get_client(self, file_id):
+        deployment = self.file_owners.get(file_id)
+        return deployment.client if deployment is not None else self.deployments[0].client
+    def forget_file(self, file_id):
+        self.file_owners.pop(file_id, None)
+    async def wait_for_batch_job(self, deployment, batch_id):
+        #Returns None when the batch is still validating after validating_timeout; the batch is cancelled
+        wait_task = asyncio.ensure_future(deployment.client.wait_for_batch_job(batch_id))
+        if self.validating_timeout <= 0:
+            return await wait_task
+        try:
+            done, pending = await asyncio.wait({wait_task}, timeout=self.validating_timeout)
+        except asyncio.CancelledError:
+            wait_task.cancel()
+            raise
+        if len(done) == 0 and deployment.client.get_batch_status(batch_id) == "validating":
+            wait_task.cancel()
+            await deployment.client.cancel_batch_job_async(batch_id)
+            self.report_error(deployment, f"batch {batch_id} was still validating after {self.validating_timeout}s")
+            return None
+        return await wait_task
+    async def close(self):
+        for deployment in self.deployments:
+            await deployment.client.close()
+    def get_stats(self):
+        return {deployment.name: {
+            "in_flight": deployment.in_flight,
+            "enqueued_tokens": deployment.enqueued_tokens,
+            "latency_seconds": round(deployment.latency, 1) if deployment.latency is not None else None,
+            "completed": deployment.completed,
+            "errors": deployment.errors,
+            "healthy": deployment.is_healthy()
+        } for deployment in self.deployments}
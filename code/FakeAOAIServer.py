@@ -0,0 +1,252 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from collections import Counter
+from urllib.parse import urlparse, unquote
+from aiohttp import web
+
+class FakeAOAIServer:
+    #Local stand-in for the Azure OpenAI files and batches endpoints used by the accelerator. Jobs move through
+    #validating, in_progress and completed on a simulated clock, and every call is counted so control-plane
+    #traffic can be measured. Input files are imported from file:// content urls.
+    def __init__(self, api_latency=0.0, file_processing_seconds=1.0, validating_seconds=1.0, queue_seconds=1.0,
+                 request_seconds=0.001, request_failure_rate=0.0, batch_failure_rate=0.0, seed=None):
+        self.api_latency = api_latency
+        self.file_processing_seconds = file_processing_seconds
+        self.validating_seconds = validating_seconds
+        self.queue_seconds = queue_seconds
+        self.request_seconds = request_seconds
+        self.request_failure_rate = request_failure_rate
+        self.batch_failure_rate = batch_failure_rate
+        self.random = random.Random(seed)
+        self.files = {}
+        self.file_contents = {}
+        self.batches = {}
+        self.call_counts = Counter()
+        #Wall-clock time of the first batch job, for measuring time to first job from outside the process
+        self.first_batch_at = None
+        self.app = self.create_app()
+    def create_app(self):
+        app = web.Application(middlewares=[self.count_calls], client_max_size=1024 ** 3)
+        app.router.add_post("/openai/files/import", self.import_file)
+        app.router.add_get("/openai/files", self.list_files)
+        app.router.add_get("/openai/files/{file_id}", self.retrieve_file)
+        app.router.add_get("/openai/files/{file_id}/content", self.get_file_content)
+        app.router.add_delete("/openai/files/{file_id}", self.delete_file)
+        app.router.add_post("/openai/batches", self.create_batch)
+        app.router.add_get("/openai/batches", self.list_batches)
+        app.router.add_get("/openai/batches/{batch_id}", self.retrieve_batch)
+        app.router.add_post("/openai/batches/{batch_id}/cancel", self.cancel_batch)
+        app.router.add_post("/openai/deployments/{deployment}/chat/completions", self.create_chat_completion)
+        app.router.add_get("/fake/stats", self.get_stats)
+        app.router.add_post("/fake/reset", self.reset)
+        return app
+    @web.middleware
+    async def count_calls(self, request, handler):
+        if not request.path.startswith("/fake/"):
+            resource = request.match_info.route.resource
+            self.call_counts[f"{request.method} {resource.canonical if resource is not None else request.path}"] += 1
+            if self.api_latency > 0:
+                await asyncio.sleep(self.api_latency)
+        return await handler(request)
+    def error_response(self, status, code, message):
+        return web.json_response({"error": {"code": code, "message": message}}, status=status)
+    def add_file(self, filename, content, purpose, status):
+        file_id = f"file-{uuid.uuid4().hex}"
+        self.file_contents[file_id] = content
+        self.files[file_id] = {"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                               "filename": filename, "purpose": purpose, "status": status, "ready_at": time.monotonic()}
+        return self.files[file_id]
+    def get_file(self, file_id):
+        file_object = self.files.get(file_id)
+        if file_object is not None and file_object["status"] == "pending" and time.monotonic() >= file_object["ready_at"]:
+            file_object["status"] = "processed"
+        return file_object
+    def to_file_response(self, file_object):
+        return {key: value for key, value in file_object.items() if key != "ready_at"}
+    async def import_file(self, request):
+        payload = await request.json()
+        content_url = urlparse(payload.get("content_url", ""))
+        if content_url.scheme != "file":
+            return self.error_response(400, "invalidContentUrl", "Only file:// content urls are supported.")
+        try:
+            content = await asyncio.to_thread(self.read_local_file, unquote(content_url.path))
+        except OSError as e:
+            return self.error_response(400, "invalidContentUrl", str(e))
+        file_object = self.add_file(payload.get("filename"), content, payload.get("purpose", "batch"), "pending")
+        file_object["ready_at"] = time.monotonic() + self.file_processing_seconds
+        return web.json_response(self.to_file_response(file_object), status=201)
+    def read_local_file(self, path):
+        with open(path, "rb") as input_file:
+            return input_file.read()
+    async def list_files(self, request):
+        file_objects = [self.get_file(file_id) for file_id in list(self.files)]
+        purpose = request.query.get("purpose")
+        if purpose is not None:
+            file_objects = [file_object for file_object in file_objects if file_object["purpose"] == purpose]
+        return self.list_response([self.to_file_response(file_object) for file_object in file_objects], request)
+    async def retrieve_file(self, request):
+        file_object = self.get_file(request.match_info["file_id"])
+        if file_object is None:
+            return self.error_response(404, "notFound", "File not found.")
+        return web.json_response(self.to_file_response(file_object))
+    async def get_file_content(self, request):
+        content = self.file_contents.get(request.match_info["file_id"])
+        if content is None:
+            return self.error_response(404, "notFound", "File not found.")
+        return web.Response(body=content, content_type="application/octet-stream")
+    async def delete_file(self, request):
+        file_id = request.match_info["file_id"]
+        if self.files.pop(file_id, None) is None:
+            return self.error_response(404, "notFound", "File not found.")
+        self.file_contents.pop(file_id, None)
+        return web.json_response({"id": file_id, "object": "file", "deleted": True})
+    async def create_batch(self, request):
+        payload = await request.json()
+        file_object = self.get_file(payload.get("input_file_id"))
+        if file_object is None:
+            return self.error_response(404, "notFound", "Input file not found.")
+        if file_object["status"] != "processed":
+            return self.error_response(400, "invalidInputFile", "Input file is not processed yet.")
+        lines = [line for line in self.file_contents[file_object["id"]].splitlines() if len(line.strip()) > 0]
+        now = time.monotonic()
+        if self.first_batch_at is None:
+            self.first_batch_at = time.time()
+        batch_id = f"batch_{uuid.uuid4()}"
+        self.batches[batch_id] = {
+            "batch": {"id": batch_id, "object": "batch", "endpoint": payload.get("endpoint"), "errors": None,
+                      "input_file_id": file_object["id"], "completion_window": payload.get("completion_window"),
+                      "status": "validating", "output_file_id": None, "error_file_id": None, "created_at": int(time.time()),
+                      "request_counts": {"total": len(lines), "completed": 0, "failed": 0}, "metadata": payload.get("metadata")},
+            "lines": lines,
+            "in_progress_at": now + self.validating_seconds,
+            "completed_at": now + self.validating_seconds + self.queue_seconds + len(lines) * self.request_seconds,
+            "fails": self.random.random() < self.batch_failure_rate
+        }
+        return web.json_response(self.get_batch(batch_id))
+    def get_batch(self, batch_id):
+        entry = self.batches.get(batch_id)
+        if entry is None:
+            return None
+        batch = entry["batch"]
+        now = time.monotonic()
+        if batch["status"] == "validating" and now >= entry["in_progress_at"]:
+            batch["status"] = "in_progress"
+            batch["in_progress_at"] = int(time.time())
+        if batch["status"] == "in_progress" and now >= entry["completed_at"]:
+            self.complete_batch(entry)
+        return batch
+    def complete_batch(self, entry):
+        batch = entry["batch"]
+        if entry["fails"]:
+            batch["status"] = "failed"
+            batch["failed_at"] = int(time.time())
+            batch["errors"] = {"object": "list", "data": [{"code": "internal_error", "message": "Simulated batch failure.",
+                                                           "param": None, "line": None}]}
+            return
+        output_lines = []
+        error_lines = []
+        for line in entry["lines"]:
+            custom_id = json.loads(line).get("custom_id")
+            if self.random.random() < self.request_failure_rate:
+                error_lines.append(self.create_result_line(custom_id, 500, {"error": {"code": "server_error",
+                                                                                      "message": "Simulated request failure."}}))
+            else:
+                output_lines.append(self.create_result_line(custom_id, 200, self.create_completion(batch["endpoint"])))
+        if len(output_lines) > 0:
+            batch["output_file_id"] = self.add_file(f"{batch['id']}_output.jsonl", b"".join(output_lines), "batch_output", "processed")["id"]
+        if len(error_lines) > 0:
+            batch["error_file_id"] = self.add_file(f"{batch['id']}_error.jsonl", b"".join(error_lines), "batch_output", "processed")["id"]
+        batch["status"] = "completed"
+        batch["completed_at"] = int(time.time())
+        batch["request_counts"] = {"total": len(entry["lines"]), "completed": len(output_lines), "failed": len(error_lines)}
+    def create_result_line(self, custom_id, status_code, body):
+        return json.dumps({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": custom_id,
+                           "response": {"status_code": status_code, "request_id": str(uuid.uuid4()), "body": body},
+                           "error": None}).encode() + b"\n"
+    def create_completion(self, model):
+        return {"id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": "This is a simulated response."}}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 7, "total_tokens": 17}}
+    async def list_batches(self, request):
+        return self.list_response([self.get_batch(batch_id) for batch_id in list(self.batches)], request)
+    async def retrieve_batch(self, request):
+        batch = self.get_batch(request.match_info["batch_id"])
+        if batch is None:
+            return self.error_response(404, "notFound", "Batch not found.")
+        return web.json_response(batch)
+    async def cancel_batch(self, request):
+        batch = self.get_batch(request.match_info["batch_id"])
+        if batch is None:
+            return self.error_response(404, "notFound", "Batch not found.")
+        if batch["status"] in ("validating", "in_progress"):
+            batch["status"] = "cancelled"
+            batch["cancelled_at"] = int(time.time())
+        return web.json_response(batch)
+    def list_response(self, items, request):
+        #Newest first with cursor pagination, like the service
+        items = list(reversed(items))
+        after = request.query.get("after")
+        if after is not None:
+            ids = [item["id"] for item in items]
+            items = items[ids.index(after) + 1:] if after in ids else []
+        limit = int(request.query.get("limit", 20))
+        page = items[:limit]
+        return web.json_response({"object": "list", "data": page, "has_more": len(items) > limit,
+                                  "first_id": page[0]["id"] if len(page) > 0 else None,
+                                  "last_id": page[-1]["id"] if len(page) > 0 else None})
+    async def create_chat_completion(self, request):
+        await request.json()
+        await asyncio.sleep(self.request_seconds)
+        if self.random.random() < self.request_failure_rate:
+            return self.error_response(500, "server_error", "Simulated request failure.")
+        return web.json_response(self.create_completion(request.match_info["deployment"]))
+    async def get_stats(self, request):
+        return web.json_response({"calls": dict(self.call_counts), "total_calls": sum(self.call_counts.values()),
+                                  "files": len(self.files), "batches": len(self.batches), "first_batch_at": self.first_batch_at})
+    async def reset(self, request):
+        self.files.clear()
+        self.file_contents.clear()
+        self.batches.clear()
+        self.call_counts.clear()
+        self.first_batch_at = None
+        return web.json_response({"reset": True})
+
+async def serve(server, host, port):
+    runner = web.AppRunner(server.app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    #The benchmark reads the bound port from the first line of output
+    print(f"Listening on http://{host}:{runner.addresses[0][1]}/", flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+def main():
+    parser = argparse.ArgumentParser(description="Local fake of the Azure OpenAI files and batches endpoints")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--api-latency", type=float, default=0.0)
+    parser.add_argument("--file-processing-seconds", type=float, default=1.0)
+    parser.add_argument("--validating-seconds", type=float, default=1.0)
+    parser.add_argument("--queue-seconds", type=float, default=1.0)
+    parser.add_argument("--request-seconds", type=float, default=0.001)
+    parser.add_argument("--request-failure-rate", type=float, default=0.0)
+    parser.add_argument("--batch-failure-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    server = FakeAOAIServer(args.api_latency, args.file_processing_seconds, args.validating_seconds, args.queue_seconds,
+                            args.request_seconds, args.request_failure_rate, args.batch_failure_rate, args.seed)
+    try:
+        asyncio.run(serve(server, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
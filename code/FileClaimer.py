@@ -0,0 +1,77 @@
+import asyncio
+import datetime
+import json
+import socket
+
+class FileClaimer:
+    #Lets several workers share one input filesystem. Before a file is processed the worker takes a lease on a
+    #claim marker for it; the lease is renewed while the job runs and released when the file is done. A worker
+    #that stops stops renewing, so its claims expire and the files are taken over by another worker.
+    def __init__(self, storage_handler, claims_directory, worker_id="", lease_duration=60):
+        self.storage_handler = storage_handler
+        self.claims_directory = claims_directory
+        self.worker_id = worker_id or socket.gethostname()
+        #Blob leases last between 15 and 60 seconds
+        self.lease_duration = min(max(int(lease_duration), 15), 60)
+        self.renew_interval = self.lease_duration / 3
+        self.leases = {}
+        #Files another worker was processing; they are offered again in case that worker stops
+        self.deferred_files = set()
+        self.claimed_count = 0
+        self.skipped_count = 0
+        self.lost_count = 0
+    def get_claim_path(self, file):
+        return f"{self.claims_directory}/{self.storage_handler.get_blob_name(file)}.claim"
+    def claim(self, file):
+        if file in self.leases:
+            return True
+        if not self.storage_handler.file_exists(file):
+            #Already processed and removed by another worker
+            self.deferred_files.discard(file)
+            return False
+        claim_path = self.get_claim_path(file)
+        content = json.dumps({"worker_id": self.worker_id, "claimed_at": str(datetime.datetime.now())}).encode()
+        lease = self.storage_handler.acquire_file_lease(claim_path, self.lease_duration, content)
+        if lease is None:
+            self.deferred_files.add(file)
+            self.skipped_count += 1
+            return False
+        if not self.storage_handler.file_exists(file):
+            #The previous owner finished between the check and the lease
+            self.storage_handler.delete_leased_file(claim_path, lease)
+            self.deferred_files.discard(file)
+            return False
+        self.leases[file] = lease
+        self.deferred_files.discard(file)
+        self.claimed_count += 1
+        return True
+    def release(self, file):
+        lease = self.leases.pop(file, None)
+        if lease is not None:
+            self.storage_handler.delete_leased_file(self.get_claim_path(file), lease)
+    async def claim_async(self, file):
+        return await asyncio.to_thread(self.claim, file)
+    async def release_async(self, file):
+        await asyncio.to_thread(self.release, file)
+    def get_deferred_files(self):
+        return list(self.deferred_files)
+    async def renew_claims(self):
+        while True:
+            await asyncio.sleep(self.renew_interval)
+            for file, lease in list(self.leases.items()):
+                try:
+                    await asyncio.to_thread(lease.renew)
+                except Exception as e:
+                    #The job keeps running, but another worker may now take the file over
+                    if self.leases.pop(file, None) is not None:
+                        self.lost_count += 1
+                        print(f"{datetime.datetime.now()} Claim on file {file} was lost. Error: {e}")
+    def get_stats(self):
+        return {
+            "worker_id": self.worker_id,
+            "claimed_files": len(self.leases),
+            "claimed_total": self.claimed_count,
+            "skipped_total": self.skipped_count,
+            "deferred_files": len(self.deferred_files),
+            "lost_claims": self.lost_count
+        }
@@ -0,0 +1,117 @@
+import asyncio
+import datetime
+import time
+from RateLimiter import RateLimiter
+
+class FileCleaner:
+    #Deletes files from the AOAI Files store in the background so a finished job's slot is freed without waiting
+    #for its deletes. Deletes run on a bounded number of workers under a requests-per-minute limit. The sweeper
+    #pages through the files list and removes batch files older than a threshold that no live job references,
+    #such as files left behind by a crashed run or by deletes still queued when the process stopped. Only files this
+    #accelerator uploaded, recognised by their filename prefix, and the results of batch jobs run on them are swept.
+    def __init__(self, deployment_router, job_ledger=None, max_concurrency=8, requests_per_minute=0,
+                 sweep_interval=0, sweep_min_age=172800, drain_timeout=60):
+        self.deployment_router = deployment_router
+        self.job_ledger = job_ledger
+        self.max_concurrency = max_concurrency
+        self.rate_limiter = RateLimiter(requests_per_minute, 0)
+        self.sweep_interval = sweep_interval
+        self.sweep_min_age = sweep_min_age
+        self.drain_timeout = drain_timeout
+        self.queue = None
+        self.workers = []
+        self.sweep_task = None
+        #Files queued or being deleted, so the sweeper doesn't queue them a second time
+        self.pending_file_ids = set()
+        self.deleted = 0
+        self.failed = 0
+        self.swept = 0
+        self.sweeps = 0
+    def is_enabled(self):
+        return self.max_concurrency > 0
+    def is_running(self):
+        return len(self.workers) > 0
+    def start(self):
+        if not self.is_enabled() or len(self.workers) > 0:
+            return
+        self.queue = asyncio.Queue()
+        self.workers = [asyncio.create_task(self.run_worker()) for index in range(self.max_concurrency)]
+        if self.sweep_interval > 0:
+            self.sweep_task = asyncio.create_task(self.run_sweeper())
+    def delete(self, client, file_id):
+        if file_id is None or file_id in self.pending_file_ids:
+            return
+        self.pending_file_ids.add(file_id)
+        self.queue.put_nowait((client, file_id))
+    async def run_worker(self):
+        while True:
+            client, file_id = await self.queue.get()
+            try:
+                await self.rate_limiter.acquire(0)
+                if await client.delete_single_async(file_id):
+                    self.deleted += 1
+                else:
+                    self.failed += 1
+            except Exception as e:
+                print(f"An error occurred while deleting file {file_id}: {e}")
+                self.failed += 1
+            finally:
+                self.pending_file_ids.discard(file_id)
+                self.queue.task_done()
+    async def run_sweeper(self):
+        while True:
+            await self.sweep()
+            await asyncio.sleep(self.sweep_interval)
+    async def sweep(self):
+        #Live files are those the router still tracks, those in the ledger and those of batch jobs that haven't finished
+        cutoff = time.time() - self.sweep_min_age
+        ledger_file_ids = self.job_ledger.get_file_ids() if self.job_ledger is not None else set()
+        queued = 0
+        for deployment in self.deployment_router.deployments:
+            try:
+                uploaded_file_ids = set()
+                old_file_ids = []
+                async for file_object in deployment.client.list_files_async():
+                    if file_object.purpose == "batch" and deployment.client.is_uploaded_file(file_object):
+                        uploaded_file_ids.add(file_object.id)
+                    if file_object.purpose in ("batch", "batch_output") and file_object.created_at < cutoff:
+                        old_file_ids.append(file_object.id)
+                active_file_ids, result_file_ids = await deployment.client.get_batch_file_ids(uploaded_file_ids)
+                live_file_ids = set(self.deployment_router.file_owners) | ledger_file_ids | active_file_ids
+                own_file_ids = uploaded_file_ids | result_file_ids
+                for file_id in old_file_ids:
+                    if file_id not in own_file_ids or file_id in live_file_ids or file_id in self.pending_file_ids:
+                        continue
+                    self.delete(deployment.client, file_id)
+                    queued += 1
+            except Exception as e:
+                print(f"An error occurred while sweeping files of deployment {deployment.name}: {e}")
+        self.sweeps += 1
+        self.swept += queued
+        if queued > 0:
+            print(f"{datetime.datetime.now()} Queued {queued} orphaned file(s) for deletion.")
+        return queued
+    async def stop(self):
+        #Queued deletes get drain_timeout seconds to finish; any left over are picked up by a later sweep
+        if self.sweep_task is not None:
+            self.sweep_task.cancel()
+            await asyncio.gather(self.sweep_task, return_exceptions=True)
+            self.sweep_task = None
+        if len(self.workers) == 0:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), self.drain_timeout)
+        except asyncio.TimeoutError:
+            print(f"{self.queue.qsize()} file deletion(s) did not finish before shutdown.")
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+    def get_stats(self):
+        return {
+            "pending": len(self.pending_file_ids),
+            "deleted": self.deleted,
+            "failed": self.failed,
+            "swept": self.swept,
+            "sweeps": self.sweeps
+        }
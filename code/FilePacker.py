@@ -0,0 +1,100 @@
+import json
+from datetime import datetime
+
+PACK_ID_SEPARATOR = "|"
+
+class FilePacker:
+    #Combines many small input files into shared batch jobs. Each request's custom_id is prefixed with the
+    #index of the file it came from so results can be split back into per-file outputs.
+    def __init__(self, storage_handler, staging_directory, max_file_bytes=0, max_pack_bytes=100000000,
+                 max_pack_requests=50000, max_pack_files=1000):
+        self.storage_handler = storage_handler
+        self.staging_directory = staging_directory
+        self.max_file_bytes = int(max_file_bytes)
+        self.max_pack_bytes = int(max_pack_bytes)
+        self.max_pack_requests = int(max_pack_requests)
+        self.max_pack_files = int(max_pack_files)
+        self.pack_count = 0
+    def is_enabled(self):
+        return self.max_file_bytes > 0
+    def create_packs(self, files):
+        #Groups small files by size; returns the packs and the files that should be processed on their own
+        packs = []
+        unpacked_files = []
+        current_files = []
+        current_bytes = 0
+        for file in files:
+            file_size = self.storage_handler.get_file_size_by_path(file)
+            if file_size > self.max_file_bytes:
+                unpacked_files.append(file)
+                continue
+            if len(current_files) > 0 and (current_bytes + file_size > self.max_pack_bytes or len(current_files) >= self.max_pack_files):
+                self.add_pack(packs, unpacked_files, current_files)
+                current_files = []
+                current_bytes = 0
+            current_files.append(file)
+            current_bytes += file_size
+        self.add_pack(packs, unpacked_files, current_files)
+        return packs, unpacked_files
+    def add_pack(self, packs, unpacked_files, current_files):
+        #A pack of one file is no cheaper than processing the file on its own
+        if len(current_files) == 1:
+            unpacked_files.append(current_files[0])
+        elif len(current_files) > 1:
+            self.pack_count += 1
+            datetime_string = datetime.today().strftime('%Y-%m-%d_%H_%M_%S')
+            packs.append({
+                "pack_file": f"{self.staging_directory}/packs/pack_{datetime_string}_{self.pack_count:04d}.jsonl",
+                "files": list(current_files)
+            })
+    def write_pack(self, pack, input_files=None):
+        #Writes the pack file. Files that would take the pack over the request limit are returned as overflow,
+        #and files that can't be parsed are returned as unpackable so they can be processed on their own.
+        #input_files maps a file to the path its requests are read from when they were staged elsewhere.
+        input_files = input_files or {}
+        writer = None
+        members = []
+        overflow = []
+        unpackable = []
+        request_count = 0
+        for file in pack["files"]:
+            if len(overflow) > 0:
+                overflow.append(file)
+                continue
+            try:
+                lines = [self.rewrite_line(line, len(members))
+                         for line in self.storage_handler.iter_file_lines_by_path(input_files.get(file, file)) if len(line.strip()) > 0]
+            except Exception as e:
+                print(f"File {file} could not be added to pack {pack['pack_file']}. Error: {e}")
+                unpackable.append(file)
+                continue
+            if len(members) > 0 and request_count + len(lines) > self.max_pack_requests:
+                overflow.append(file)
+                continue
+            if writer is None:
+                writer = self.storage_handler.get_file_writer(pack["pack_file"])
+            for line in lines:
+                writer.write(line)
+            members.append(file)
+            request_count += len(lines)
+        if writer is not None:
+            writer.close()
+        pack["files"] = members
+        pack["request_count"] = request_count
+        print(f"Pack {pack['pack_file']} created with {len(members)} file(s) and {request_count} request(s).")
+        return overflow, unpackable
+    def rewrite_line(self, line, member_index):
+        request = json.loads(line)
+        request["custom_id"] = f"{member_index}{PACK_ID_SEPARATOR}{request.get('custom_id')}"
+        return json.dumps(request).encode() + b"\n"
+    def split_line(self, line):
+        #Returns the index of the file a result line belongs to and the line with its original custom_id
+        try:
+            result = json.loads(line)
+            member_index, custom_id = str(result.get("custom_id")).split(PACK_ID_SEPARATOR, 1)
+            result["custom_id"] = custom_id
+            return int(member_index), json.dumps(result).encode() + b"\n"
+        except Exception:
+            return None, line
+    def delete_pack(self, pack):
+        return self.storage_handler.delete_file(pack["pack_file"])
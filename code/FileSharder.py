@@ -0,0 +1,76 @@
+from Utilities import Utils
+
+class FileSharder:
+    #Splits oversized input files on line boundaries into shards that each fit within the configured
+    #size, request count and token budget. Shards are written to a staging directory in the input filesystem.
+    def __init__(self, storage_handler, staging_directory, max_bytes=0, max_requests=0, max_tokens=0, token_counter=None):
+        self.storage_handler = storage_handler
+        self.staging_directory = staging_directory
+        self.max_bytes = int(max_bytes)
+        self.max_requests = int(max_requests)
+        self.max_tokens = int(max_tokens)
+        self.token_counter = token_counter
+    def is_enabled(self):
+        return self.max_bytes > 0 or self.max_requests > 0 or self.max_tokens > 0
+    def needs_sharding(self, file):
+        #The size is checked first; the file is only read when a request or token limit is set, and only up to the
+        #line that exceeds it
+        if self.max_bytes > 0 and self.storage_handler.get_file_size_by_path(file) > self.max_bytes:
+            return True
+        if self.max_requests == 0 and self.max_tokens == 0:
+            return False
+        file_requests = 0
+        file_tokens = 0
+        for line in self.storage_handler.iter_file_lines_by_path(file):
+            if len(line.strip()) == 0:
+                continue
+            file_requests += 1
+            if self.max_tokens > 0:
+                file_tokens += self.token_counter.count_line(line)
+            if self.is_shard_full(0, file_requests, file_tokens):
+                return True
+        return False
+    def get_shard_path(self, file, shard_index):
+        #Keyed by the full input path so files with the same name in different directories don't collide
+        file_extension = Utils.get_file_extension(Utils.strip_directory_name(file))
+        return f"{self.staging_directory}/shards/{file.lstrip('/')}/shard_{shard_index:04d}.{file_extension}"
+    def create_shards(self, file, input_file=None):
+        #Shards are named after the file; input_file is read in place of it when its requests were staged elsewhere
+        shards = []
+        writer = None
+        shard_bytes = 0
+        shard_requests = 0
+        shard_tokens = 0
+        for line in self.storage_handler.iter_file_lines_by_path(input_file or file):
+            if len(line.strip()) == 0:
+                continue
+            line_tokens = self.token_counter.count_line(line) if self.max_tokens > 0 else 0
+            if writer is not None and self.is_shard_full(shard_bytes + len(line), shard_requests + 1, shard_tokens + line_tokens):
+                writer.close()
+                writer = None
+            if writer is None:
+                shard_path = self.get_shard_path(file, len(shards) + 1)
+                writer = self.storage_handler.get_file_writer(shard_path)
+                shards.append(shard_path)
+                shard_bytes = 0
+                shard_requests = 0
+                shard_tokens = 0
+            writer.write(line)
+            shard_bytes += len(line)
+            shard_requests += 1
+            shard_tokens += line_tokens
+        if writer is not None:
+            writer.close()
+        print(f"File {file} split into {len(shards)} shard(s).")
+        return shards
+    def is_shard_full(self, shard_bytes, shard_requests, shard_tokens):
+        if self.max_bytes > 0 and shard_bytes > self.max_bytes:
+            return True
+        if self.max_requests > 0 and shard_requests > self.max_requests:
+            return True
+        if self.max_tokens > 0 and shard_tokens > self.max_tokens:
+            return True
+        return False
+    def delete_shards(self, shards):
+        for shard_path in shards:
+            self.storage_handler.delete_file(shard_path)
@@ -0,0 +1,113 @@
+import asyncio
+import datetime
+import time
+
+class InputDiscovery:
+    #Incremental discovery of input files. Directories are walked in parallel with one non-recursive listing each,
+    #and only paths that are new since the previous listing, or modified after the last-modified watermark, are
+    #returned. A subdirectory in which nothing has changed is listed less and less often, backing off to once every
+    #full_listing_interval passes; in between, its previous listing and its known subdirectories are reused. The
+    #input directory itself is listed on every pass.
+    def __init__(self, storage_handler, input_directory, exclude_directories=None, max_parallel_listings=8,
+                 full_listing_interval=4):
+        self.storage_handler = storage_handler
+        self.input_directory = input_directory
+        self.exclude_directories = [directory.strip("/") for directory in (exclude_directories or []) if directory]
+        self.listing_semaphore = asyncio.Semaphore(max_parallel_listings)
+        self.full_listing_interval = max(1, int(full_listing_interval))
+        self.watermark = None
+        self.known_paths = set()
+        #Previous listing of each directory, with the number of passes since it last changed or was listed
+        self.directories = {}
+        self.last_listing_seconds = 0.0
+        self.last_directory_count = 0
+        self.last_skipped_count = 0
+        self.listing_calls = 0
+    async def discover(self):
+        start_time = time.monotonic()
+        paths = await self.walk(self.input_directory)
+        new_files = []
+        current_paths = set()
+        watermark = self.watermark
+        for path in paths:
+            #Files that are still being written have no content yet and are picked up on a later pass
+            if path.content_length == 0:
+                continue
+            current_paths.add(path.name)
+            is_new = path.name not in self.known_paths
+            is_modified = self.watermark is not None and path.last_modified > self.watermark
+            if is_new or is_modified:
+                new_files.append(path.name)
+            if watermark is None or path.last_modified > watermark:
+                watermark = path.last_modified
+        self.known_paths = current_paths
+        self.watermark = watermark
+        self.last_listing_seconds = time.monotonic() - start_time
+        if len(new_files) > 0:
+            print(f"{datetime.datetime.now()} Discovered {len(new_files)} new file(s) in {self.last_directory_count} "
+                  f"directories in {self.last_listing_seconds:.2f}s ({self.last_skipped_count} unchanged directories not listed)")
+        return new_files
+    async def walk(self, root_directory):
+        #Breadth-first walk; each level's due directories are listed concurrently
+        files = []
+        directories = [root_directory]
+        reached = {}
+        self.last_directory_count = 0
+        self.last_skipped_count = 0
+        while len(directories) > 0:
+            due_directories = [directory for directory in directories if self.is_listing_due(directory, root_directory)]
+            listings = await asyncio.gather(*[self.list_directory(directory) for directory in due_directories])
+            for directory, listing in zip(due_directories, listings):
+                self.update_directory(directory, listing)
+            self.last_directory_count += len(due_directories)
+            self.last_skipped_count += len(directories) - len(due_directories)
+            subdirectories = []
+            for directory in directories:
+                entry = self.directories[directory]
+                if directory not in due_directories:
+                    entry["skipped_passes"] += 1
+                reached[directory] = entry
+                files.extend(entry["files"])
+                subdirectories.extend([subdirectory for subdirectory in entry["subdirectories"]
+                                       if not self.is_excluded(subdirectory) and subdirectory not in reached])
+            directories = subdirectories
+        #Directories that weren't reached have been removed
+        self.directories = reached
+        return files
+    def is_listing_due(self, directory, root_directory):
+        entry = self.directories.get(directory)
+        if entry is None or directory == root_directory:
+            return True
+        #Backs off to every 2, 4, 8... passes while nothing changes, up to full_listing_interval
+        return entry["skipped_passes"] + 1 >= min(2 ** entry["idle_passes"], self.full_listing_interval)
+    def update_directory(self, directory, listing):
+        files, subdirectories = listing
+        previous = self.directories.get(directory)
+        #New files, files still being written and new subdirectories all count as changes
+        changed = (previous is None or any(path.content_length == 0 for path in files)
+                   or {path.name for path in files} - {path.name for path in previous["files"]}
+                   or set(subdirectories) - set(previous["subdirectories"]))
+        self.directories[directory] = {
+            "files": files,
+            "subdirectories": subdirectories,
+            "idle_passes": 0 if changed else previous["idle_passes"] + 1,
+            "skipped_passes": 0
+        }
+    async def list_directory(self, directory):
+        async with self.listing_semaphore:
+            self.listing_calls += 1
+            files = []
+            subdirectories = await asyncio.to_thread(self.storage_handler.get_directories, directory, False, files)
+            return files, subdirectories
+    def is_excluded(self, directory):
+        directory = directory.strip("/")
+        return any(directory == excluded or directory.startswith(excluded + "/") for excluded in self.exclude_directories)
+    def get_stats(self):
+        return {
+            "known_files": len(self.known_paths),
+            "known_directories": len(self.directories),
+            "listing_calls": self.listing_calls,
+            "last_listed_directories": self.last_directory_count,
+            "last_skipped_directories": self.last_skipped_count,
+            "last_listing_seconds": round(self.last_listing_seconds, 3)
+        }
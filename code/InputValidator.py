@@ -0,0 +1,168 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+def get_rules(template, batch_endpoint, deployment_names):
+    #The template's keys are required on every line; its body and message keys only apply to its own endpoint
+    messages = template.get("body", {}).get("messages") or [{}]
+    return {
+        "keys": list(template.keys()),
+        "method": template.get("method", "POST"),
+        "url": batch_endpoint,
+        "template_url": template.get("url"),
+        "body_keys": list(template.get("body", {}).keys()),
+        "message_keys": list(messages[0].keys()),
+        "models": list(deployment_names)
+    }
+
+def validate_line(line, rules):
+    #Returns (custom_id, errors) for a request line, or None for a blank line
+    if len(line.strip()) == 0:
+        return None
+    try:
+        request = json.loads(line)
+    except ValueError:
+        return (None, ["invalid_json"])
+    if not isinstance(request, dict):
+        return (None, ["not_an_object"])
+    errors = [f"missing_{key}" for key in rules["keys"] if key not in request]
+    custom_id = request.get("custom_id")
+    if "custom_id" in request and (not isinstance(custom_id, str) or custom_id == ""):
+        errors.append("invalid_custom_id")
+        custom_id = None
+    if "method" in request and request["method"] != rules["method"]:
+        errors.append("invalid_method")
+    if "url" in request and request["url"] != rules["url"]:
+        errors.append("url_mismatch")
+    body = request.get("body")
+    if "body" in request and not isinstance(body, dict):
+        errors.append("invalid_body")
+    elif isinstance(body, dict):
+        if len(rules["models"]) > 0 and "model" in body and body["model"] not in rules["models"]:
+            errors.append("model_mismatch")
+        if request.get("url") == rules["template_url"]:
+            errors.extend(f"missing_body_{key}" for key in rules["body_keys"] if key not in body)
+            if "messages" in body:
+                errors.extend(validate_messages(body["messages"], rules))
+    return (custom_id, errors)
+
+def validate_messages(messages, rules):
+    if not isinstance(messages, list) or len(messages) == 0:
+        return ["invalid_messages"]
+    for message in messages:
+        if not isinstance(message, dict) or any(key not in message for key in rules["message_keys"]):
+            return ["invalid_message"]
+    return []
+
+def validate_lines(lines, rules):
+    #Runs in the worker processes
+    return [validate_line(line, rules) for line in lines]
+
+class InputValidator:
+    #Checks input files line by line before anything is uploaded: each line must be a JSON request with the keys of
+    #batch_template.json, the configured batch endpoint, a deployment's model and a custom_id not used earlier in the
+    #file. Files are streamed and blocks of lines are checked on a process pool. In reject mode a file with any bad
+    #line is rejected as a whole; in filter mode the bad lines are set aside and only the valid ones are submitted.
+    def __init__(self, mode="", template=None, batch_endpoint="/chat/completions", deployment_names=(), staging_directory="_staging",
+                 max_workers=1, block_size=2000, max_reported_errors=1000):
+        if mode not in ("", "reject", "filter"):
+            raise ValueError(f"Unsupported input_validation mode: {mode}. Use reject or filter.")
+        self.mode = mode
+        self.rules = get_rules(template or {}, batch_endpoint, deployment_names)
+        self.staging_directory = staging_directory
+        self.max_workers = max_workers
+        self.block_size = block_size
+        self.max_reported_errors = max_reported_errors
+        self.executor = None
+        self.executor_lock = threading.Lock()
+    def is_enabled(self):
+        return self.mode != ""
+    def get_executor(self):
+        #A single worker validates on the calling thread; more than one uses a process pool, created like the token counter's
+        if self.get_worker_count() <= 1:
+            return None
+        with self.executor_lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.get_worker_count(),
+                                                    mp_context=multiprocessing.get_context("spawn"))
+            return self.executor
+    def get_worker_count(self):
+        return self.max_workers or os.cpu_count() or 1
+    def get_staging_paths(self, file):
+        file = file.lstrip("/")
+        return f"{self.staging_directory}/validated/{file}", f"{self.staging_directory}/invalid/{file}"
+    def iter_results(self, lines):
+        #Yields (line, result) in file order while at most two blocks per worker are pending
+        executor = self.get_executor()
+        if executor is None:
+            for line in lines:
+                yield line, validate_line(line, self.rules)
+            return
+        max_pending = 2 * self.get_worker_count()
+        pending = []
+        block = []
+        for line in lines:
+            block.append(line)
+            if len(block) >= self.block_size:
+                pending.append((block, executor.submit(validate_lines, block, self.rules)))
+                block = []
+                if len(pending) >= max_pending:
+                    done_block, future = pending.pop(0)
+                    yield from zip(done_block, future.result())
+        if len(block) > 0:
+            pending.append((block, executor.submit(validate_lines, block, self.rules)))
+        for done_block, future in pending:
+            yield from zip(done_block, future.result())
+    def validate_file(self, storage_handler, file):
+        #In filter mode the valid and invalid lines are written to separate staging files as they are checked
+        report = {"file": file, "mode": self.mode, "valid_lines": 0, "invalid_lines": 0, "error_counts": {}, "errors": [],
+                  "valid_file": None, "invalid_file": None}
+        valid_path, invalid_path = self.get_staging_paths(file)
+        writers = {}
+        seen_custom_ids = set()
+        try:
+            for line_number, (line, result) in enumerate(self.iter_results(storage_handler.iter_file_lines_by_path(file)), 1):
+                if result is None:
+                    continue
+                custom_id, errors = result
+                if custom_id is not None:
+                    if custom_id in seen_custom_ids:
+                        errors = errors + ["duplicate_custom_id"]
+                    seen_custom_ids.add(custom_id)
+                if len(errors) == 0:
+                    report["valid_lines"] += 1
+                    path = valid_path
+                else:
+                    report["invalid_lines"] += 1
+                    path = invalid_path
+                    for error in errors:
+                        report["error_counts"][error] = report["error_counts"].get(error, 0) + 1
+                    if len(report["errors"]) < self.max_reported_errors:
+                        report["errors"].append({"line": line_number, "custom_id": custom_id, "errors": errors})
+                if self.mode == "filter":
+                    if path not in writers:
+                        writers[path] = storage_handler.get_file_writer(path)
+                    writers[path].write(line)
+        finally:
+            for writer in writers.values():
+                writer.close()
+        report["errors_truncated"] = report["invalid_lines"] > len(report["errors"])
+        if valid_path in writers:
+            report["valid_file"] = valid_path
+        if invalid_path in writers:
+            report["invalid_file"] = invalid_path
+        return report
+    async def validate_file_async(self, storage_handler, file):
+        return await asyncio.to_thread(self.validate_file, storage_handler, file)
+    def delete_staging_files(self, storage_handler, report):
+        for path in (report["valid_file"], report["invalid_file"]):
+            if path is not None:
+                storage_handler.delete_file(path)
+    def close(self):
+        with self.executor_lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
@@ -0,0 +1,95 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+
+class JobLedger:
+    #Durable record of every batch job's stage so a restarted process can reattach to running batches
+    #instead of resubmitting them. Entries are keyed by the file that was uploaded (input file, shard or pack).
+    #Writes are synced to disk, so the event loop makes them through record_async and remove_async on a worker
+    #thread; reads use their own connection, which WAL lets proceed while a write is in progress.
+    def __init__(self, ledger_path):
+        self.ledger_path = ledger_path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(ledger_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=FULL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            source TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            parent TEXT,
+            stage TEXT NOT NULL,
+            file_id TEXT,
+            batch_id TEXT,
+            status TEXT,
+            output_file_id TEXT,
+            error_file_id TEXT,
+            details TEXT,
+            updated_at REAL NOT NULL
+        )""")
+        self.connection.commit()
+        self.read_connection = sqlite3.connect(ledger_path, check_same_thread=False)
+    def record(self, source, kind=None, parent=None, stage=None, details=None, **fields):
+        with self.lock:
+            return self.write_entry(source, kind, parent, stage, details, fields)
+    async def record_async(self, source, kind=None, parent=None, stage=None, details=None, **fields):
+        return await asyncio.to_thread(self.record, source, kind, parent, stage, details, **fields)
+    def write_entry(self, source, kind, parent, stage, details, fields):
+        #A new entry is a top-level file unless told otherwise; kind and parent are updated whenever they are given
+        entry = self.to_entry(self.connection.execute("SELECT * FROM jobs WHERE source = ?", (source,)).fetchone())
+        if entry is None:
+            entry = {"source": source, "kind": "file", "parent": None, "stage": "pending", "file_id": None, "batch_id": None,
+                     "status": None, "output_file_id": None, "error_file_id": None, "details": {}}
+        if kind is not None:
+            entry["kind"] = kind
+        if parent is not None:
+            entry["parent"] = parent
+        if stage is not None:
+            entry["stage"] = stage
+        if details is not None:
+            entry["details"].update(details)
+        for key in ("file_id", "batch_id", "status", "output_file_id", "error_file_id"):
+            if key in fields:
+                entry[key] = fields[key]
+        self.connection.execute("""INSERT OR REPLACE INTO jobs
+            (source, kind, parent, stage, file_id, batch_id, status, output_file_id, error_file_id, details, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (entry["source"], entry["kind"], entry["parent"], entry["stage"], entry["file_id"], entry["batch_id"],
+             entry["status"], entry["output_file_id"], entry["error_file_id"], json.dumps(entry["details"]), time.time()))
+        self.connection.commit()
+        return entry
+    def get(self, source):
+        row = self.read_connection.execute("SELECT * FROM jobs WHERE source = ?", (source,)).fetchone()
+        return self.to_entry(row)
+    def get_incomplete(self, kind=None):
+        if kind is None:
+            rows = self.read_connection.execute("SELECT * FROM jobs WHERE parent IS NULL ORDER BY updated_at").fetchall()
+        else:
+            rows = self.read_connection.execute("SELECT * FROM jobs WHERE parent IS NULL AND kind = ? ORDER BY updated_at", (kind,)).fetchall()
+        return [self.to_entry(row) for row in rows]
+    def get_children(self, parent):
+        rows = self.read_connection.execute("SELECT * FROM jobs WHERE parent = ?", (parent,)).fetchall()
+        return [self.to_entry(row) for row in rows]
+    def get_file_ids(self):
+        rows = self.read_connection.execute("SELECT file_id, output_file_id, error_file_id FROM jobs").fetchall()
+        return set(file_id for row in rows for file_id in row if file_id is not None)
+    def remove(self, source):
+        with self.lock:
+            self.connection.execute("DELETE FROM jobs WHERE source = ? OR parent = ?", (source, source))
+            self.connection.commit()
+    async def remove_async(self, source):
+        await asyncio.to_thread(self.remove, source)
+    def to_entry(self, row):
+        if row is None:
+            return None
+        columns = ("source", "kind", "parent", "stage", "file_id", "batch_id", "status", "output_file_id",
+                   "error_file_id", "details", "updated_at")
+        entry = dict(zip(columns, row))
+        entry["details"] = json.loads(entry["details"]) if entry["details"] else {}
+        return entry
+    def close(self):
+        with self.lock:
+            self.read_connection.close()
+            self.connection.commit()
+            self.connection.close()
@@ -0,0 +1,103 @@
+import asyncio
+import datetime
+import itertools
+import time
+from collections import OrderedDict, deque
+
+class JobScheduler:
+    #Sliding-window scheduler: a fixed number of slots pull work from a shared queue so the
+    #next file starts as soon as any in-flight file finishes, and new files can join at any time.
+    #Queued work is started lowest priority first, and in submission order for equal priorities.
+    def __init__(self, process_function, max_concurrency, wait_history_size=1000):
+        self.process_function = process_function
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.queue = asyncio.PriorityQueue()
+        self.sequence = itertools.count()
+        self.pending = set()
+        self.active_slots = 0
+        self.submitted_count = 0
+        self.completed_count = 0
+        self.failed_count = 0
+        self.wait_history_size = wait_history_size
+        self.wait_times = deque(maxlen=wait_history_size)
+        #Queue wait of the most recently started keys, oldest first
+        self.key_wait_times = OrderedDict()
+        self.workers = []
+        self.accepting = True
+    def start(self):
+        if len(self.workers) == 0:
+            for slot in range(self.max_concurrency):
+                self.workers.append(asyncio.create_task(self.worker(slot)))
+    def submit(self, key, item=None, priority=0):
+        #Files already queued or in flight are ignored so repeated listings don't double submit
+        if key in self.pending or not self.accepting:
+            return False
+        self.pending.add(key)
+        self.submitted_count += 1
+        self.queue.put_nowait((priority, next(self.sequence), key, key if item is None else item, time.monotonic()))
+        return True
+    def stop_admitting(self):
+        self.accepting = False
+    def is_pending(self, key):
+        return key in self.pending
+    def get_wait_time(self, key):
+        return self.key_wait_times.get(key)
+    async def worker(self, slot):
+        while True:
+            priority, sequence, key, item, enqueued_time = await self.queue.get()
+            if not self.accepting:
+                #Queued work is dropped once admission stops; it is picked up again on the next run
+                self.pending.discard(key)
+                self.queue.task_done()
+                continue
+            wait_time = time.monotonic() - enqueued_time
+            self.wait_times.append(wait_time)
+            self.key_wait_times.pop(key, None)
+            self.key_wait_times[key] = round(wait_time, 3)
+            if len(self.key_wait_times) > self.wait_history_size:
+                self.key_wait_times.popitem(last=False)
+            self.active_slots += 1
+            print(f"{datetime.datetime.now()} Slot {slot} starting {key} after waiting {wait_time:.1f}s in queue")
+            try:
+                await self.process_function(item)
+                self.completed_count += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed_count += 1
+                print(f"An error occurred while processing {key} in slot {slot}. Error: {e}")
+            finally:
+                self.active_slots -= 1
+                self.pending.discard(key)
+                self.queue.task_done()
+    async def join(self):
+        await self.queue.join()
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+    def get_stats(self):
+        wait_times = list(self.wait_times)
+        average_wait = sum(wait_times) / len(wait_times) if len(wait_times) > 0 else 0.0
+        return {
+            "queue_depth": self.queue.qsize(),
+            "active_slots": self.active_slots,
+            "max_slots": self.max_concurrency,
+            "slot_utilization": self.active_slots / self.max_concurrency,
+            "submitted": self.submitted_count,
+            "completed": self.completed_count,
+            "failed": self.failed_count,
+            "average_wait_seconds": round(average_wait, 3),
+            "max_wait_seconds": round(max(wait_times), 3) if len(wait_times) > 0 else 0.0,
+            "last_wait_seconds": round(wait_times[-1], 3) if len(wait_times) > 0 else 0.0,
+            "wait_seconds_by_key": dict(self.key_wait_times)
+        }
+    async def report_stats(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            stats = self.get_stats()
+            print(f"{datetime.datetime.now()} Scheduler stats: queue depth {stats['queue_depth']}, "
+                  f"slots in use {stats['active_slots']}/{stats['max_slots']}, "
+                  f"completed {stats['completed']}, failed {stats['failed']}, "
+                  f"avg wait {stats['average_wait_seconds']}s, max wait {stats['max_wait_seconds']}s")
@@ -0,0 +1,238 @@
+import asyncio
+import datetime
+import os
+import shutil
+import threading
+import time
+from types import SimpleNamespace
+from Utilities import Utils
+
+class LocalStorageHandler:
+    #Stand-in for StorageHandler backed by a local directory, with one subdirectory per file system. Directory
+    #clients are paths relative to the file system, so the accelerator and benchmarks run without a storage account.
+    #Leases are shared by every handler in the process so several workers can be simulated side by side.
+    leases = {}
+    lease_lock = threading.Lock()
+    def __init__(self, root_directory, file_system_name, chunk_size=4194304):
+        self.root_directory = root_directory
+        self.file_system_name = file_system_name
+        #The file system itself is the empty directory path
+        self.file_system_client = ""
+        self.chunk_size = chunk_size
+        self.byte_read_size = 50000
+        self.file_sizes = {}
+        self.file_metadata = {}
+        os.makedirs(self.get_local_path(""), exist_ok=True)
+    def get_local_path(self, path, file_system_name=None):
+        parts = [part for part in path.replace("\\", "/").split("/") if part != ""]
+        return os.path.join(self.root_directory, file_system_name or self.file_system_name, *parts)
+    def get_blob_name(self, path):
+        return "/".join([part for part in path.split("/") if part != ""])
+    def join_path(self, directory_name, file_name):
+        return self.get_blob_name(f"{directory_name}/{file_name}")
+    def get_path_entry(self, path, local_path):
+        stat = os.stat(local_path)
+        return SimpleNamespace(name=self.get_blob_name(path), is_directory=os.path.isdir(local_path), content_length=stat.st_size,
+                               last_modified=datetime.datetime.fromtimestamp(stat.st_mtime, datetime.timezone.utc))
+    def walk(self, path, recursive=True):
+        local_path = self.get_local_path(path)
+        if not os.path.isdir(local_path):
+            return []
+        entries = []
+        for name in sorted(os.listdir(local_path)):
+            entry = self.get_path_entry(self.join_path(path, name), os.path.join(local_path, name))
+            entries.append(entry)
+            if recursive and entry.is_directory:
+                entries.extend(self.walk(entry.name))
+        return entries
+    def get_directories(self, path, recursive=True, files=None):
+        return_paths = []
+        for entry in self.walk(path, recursive):
+            if entry.is_directory:
+                return_paths.append(entry.name)
+            elif files is not None:
+                files.append(entry)
+                self.file_sizes[entry.name] = entry.content_length
+        if len(return_paths) == 0 and files is None:
+            return_paths.append(path)
+        return return_paths
+    def get_file_list(self, path):
+        file_list = []
+        for entry in self.walk(path):
+            if not entry.is_directory:
+                file_list.append(entry.name)
+                self.file_sizes[entry.name] = entry.content_length
+        return file_list
+    def get_path_properties(self, path):
+        return [entry for entry in self.walk(path) if not entry.is_directory]
+    def write_content_to_directory(self, file_content, directory_name, output_filename):
+        directory_client = self.get_or_create_directory_client(directory_name)
+        if self.write_json_to_storage(output_filename, file_content, directory_client):
+            print(f"File {output_filename} written to storage directory.")
+            return True
+        print(f"Error writing file {output_filename} to directory.")
+        return False
+    async def write_content_to_directory_async(self, file_content, directory_name, output_filename):
+        return await asyncio.to_thread(self.write_content_to_directory, file_content, directory_name, output_filename)
+    async def write_stream_to_directory(self, chunks, directory_name, output_filename):
+        bytes_written = 0
+        writer = None
+        try:
+            async for chunk in chunks:
+                if len(chunk) == 0:
+                    continue
+                if writer is None:
+                    writer = await asyncio.to_thread(self.get_file_writer, self.join_path(directory_name, output_filename))
+                await asyncio.to_thread(writer.write, chunk)
+                bytes_written += len(chunk)
+            if writer is not None:
+                await asyncio.to_thread(writer.close)
+                print(f"File {output_filename} written to storage directory.")
+        except Exception as e:
+            print(f"Error writing file {output_filename} to directory: {e}")
+            return None
+        return bytes_written
+    def get_or_create_directory_client(self, directory_name):
+        if not self.check_directory_exists(directory_name):
+            return self.create_directory(directory_name)
+        return self.get_directory_client(directory_name)
+    def check_directory_exists(self, directory_name):
+        return os.path.isdir(self.get_local_path(directory_name))
+    def create_directory(self, directory_name):
+        os.makedirs(self.get_local_path(directory_name), exist_ok=True)
+        return self.get_blob_name(directory_name)
+    def get_directory_client(self, directory_name):
+        return self.get_blob_name(directory_name)
+    def write_json_to_storage(self, output_name, output_data, directory_client):
+        try:
+            local_path = self.get_local_path(self.join_path(directory_client, output_name))
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            with open(local_path, "wb") as output_file:
+                output_file.write(output_data.encode() if isinstance(output_data, str) else output_data)
+            return True
+        except Exception as e:
+            return False
+    def copy_file_to_filesystem(self, source_path, destination_file_system_name, destination_directory,
+                                destination_filename, timeout=600):
+        try:
+            destination_path = self.get_local_path(self.join_path(destination_directory, destination_filename),
+                                                   destination_file_system_name)
+            os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+            shutil.copyfile(self.get_local_path(source_path), destination_path)
+            print(f"File {source_path} copied to {destination_file_system_name}/{destination_directory}.")
+            return True
+        except Exception as e:
+            print(f"Error copying file {source_path} to {destination_file_system_name}/{destination_directory}: {e}")
+            return False
+    def read_chunks(self, file_path):
+        with open(self.get_local_path(file_path), "rb") as input_file:
+            while True:
+                chunk = input_file.read(self.chunk_size)
+                if len(chunk) == 0:
+                    break
+                yield chunk
+    def get_file_stream(self, file_name, directory_client):
+        return open(self.get_local_path(self.join_path(directory_client, file_name)), "rb")
+    def get_file_data(self, file_name, directory_client):
+        return self.get_file_data_by_path(self.join_path(directory_client, file_name))
+    def iter_file_lines(self, file_name, directory_client):
+        return self.iter_file_lines_by_path(self.join_path(directory_client, file_name))
+    def get_file_size(self, file_name, directory_client):
+        return os.path.getsize(self.get_local_path(self.join_path(directory_client, file_name)))
+    def get_file_size_by_path(self, file_path):
+        if file_path in self.file_sizes:
+            return self.file_sizes[file_path]
+        return os.path.getsize(self.get_local_path(file_path))
+    def iter_file_lines_by_path(self, file_path):
+        return Utils.iter_lines(self.read_chunks(file_path))
+    def get_file_data_by_path(self, file_path):
+        with open(self.get_local_path(file_path), "rb") as input_file:
+            return input_file.read()
+    def get_file_chunks_by_path(self, file_path):
+        return self.read_chunks(file_path)
+    def get_file_metadata(self, file_path):
+        return self.file_metadata.get(self.get_blob_name(file_path), {})
+    def set_file_metadata(self, file_path, metadata):
+        self.file_metadata[self.get_blob_name(file_path)] = metadata
+    def file_exists(self, file_path):
+        return os.path.isfile(self.get_local_path(file_path))
+    def acquire_file_lease(self, file_path, lease_duration=60, content=b""):
+        local_path = self.get_local_path(file_path)
+        with self.lease_lock:
+            lease = self.leases.get(local_path)
+            if lease is not None and not lease.is_expired():
+                return None
+            if not os.path.isfile(local_path):
+                self.write_json_to_storage(self.get_blob_name(file_path), content, "")
+            lease = LocalLease(self, local_path, lease_duration)
+            self.leases[local_path] = lease
+            return lease
+    def delete_leased_file(self, file_path, lease):
+        local_path = self.get_local_path(file_path)
+        with self.lease_lock:
+            if self.leases.get(local_path) is not lease:
+                return False
+            self.leases.pop(local_path)
+        return self.delete_file(file_path)
+    def get_file_writer(self, file_path):
+        local_path = self.get_local_path(file_path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        return LocalFileWriter(local_path)
+    def delete_file(self, file_path):
+        try:
+            os.remove(self.get_local_path(file_path))
+            self.file_sizes.pop(self.get_blob_name(file_path), None)
+            return True
+        except Exception as e:
+            return False
+    async def delete_file_async(self, file_path):
+        return await asyncio.to_thread(self.delete_file, file_path)
+    def delete_file_data(self, file_name, directory_client):
+        return self.delete_file(self.join_path(directory_client, file_name))
+    def save_file_to_local(self, file_name, directory_client, local_path):
+        try:
+            shutil.copyfile(self.get_local_path(self.join_path(directory_client, file_name)), local_path)
+            print(f"File {file_name} saved to local path {local_path}")
+            return True
+        except Exception as e:
+            print(f"An error occurred while saving file {file_name} to local path {local_path}: {e}")
+            return False
+    def save_file_to_local_by_path(self, file_path, local_path):
+        return self.save_file_to_local(self.get_blob_name(file_path), "", local_path)
+    async def close(self):
+        pass
+
+class LocalLease:
+    def __init__(self, storage_handler, local_path, lease_duration):
+        self.storage_handler = storage_handler
+        self.local_path = local_path
+        self.lease_duration = lease_duration
+        self.expires_at = time.monotonic() + lease_duration
+    def is_expired(self):
+        return time.monotonic() >= self.expires_at
+    def renew(self):
+        with self.storage_handler.lease_lock:
+            if self.storage_handler.leases.get(self.local_path) is not self:
+                raise RuntimeError(f"The lease on {self.local_path} is held by another client")
+            self.expires_at = time.monotonic() + self.lease_duration
+    def release(self):
+        with self.storage_handler.lease_lock:
+            if self.storage_handler.leases.get(self.local_path) is self:
+                self.storage_handler.leases.pop(self.local_path)
+
+class LocalFileWriter:
+    #Same interface as StorageFileWriter; the file only becomes visible under its name when it is closed
+    def __init__(self, local_path):
+        self.local_path = local_path
+        self.temporary_path = local_path + ".partial"
+        self.file = open(self.temporary_path, "wb")
+        self.offset = 0
+        self.line_count = 0
+    def write(self, data):
+        self.file.write(data)
+        self.offset += len(data)
+        self.line_count += 1
+    def close(self):
+        self.file.close()
+        os.replace(self.temporary_path, self.local_path)
+        return self.offset
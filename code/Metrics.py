@@ -0,0 +1,229 @@
+import asyncio
+import contextlib
+import contextvars
+import datetime
+import json
+import re
+import time
+import uuid
+from collections import defaultdict
+
+STAGE_BUCKETS = (0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600, 14400, 86400)
+
+#The file whose work is running in the current task; shards and retries started from it share its context
+current_file = contextvars.ContextVar("current_file", default=None)
+
+class Metrics:
+    #Per-file stage timings and process-wide counters. Each file gets a correlation id that is attached to its
+    #structured log lines and metadata. Snapshots combine these with the get_stats() of registered components and
+    #are served in Prometheus text format and as JSON, and/or written to a file periodically.
+    def __init__(self, port=0, snapshot_path="", snapshot_interval=60, structured_logs=False, prefix="aoai_batch"):
+        self.port = int(port)
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.structured_logs = structured_logs
+        self.prefix = prefix
+        self.counters = defaultdict(float)
+        self.stage_counts = defaultdict(int)
+        self.stage_sums = defaultdict(float)
+        self.stage_max = defaultdict(float)
+        self.stage_buckets = defaultdict(lambda: [0] * len(STAGE_BUCKETS))
+        self.files = {}
+        self.sources = {}
+    def is_exported(self):
+        return self.port > 0 or self.snapshot_path != ""
+    def add_source(self, name, get_stats):
+        self.sources[name] = get_stats
+    def start_file(self, file):
+        context = {"file": file, "correlation_id": uuid.uuid4().hex[:16], "stages": {}, "started_at": time.monotonic()}
+        self.files[file] = context
+        current_file.set(context)
+        self.log("file_started")
+        return context
+    def finish_file(self):
+        context = current_file.get()
+        if context is None:
+            return
+        seconds = time.monotonic() - context["started_at"]
+        self.observe("total", seconds)
+        self.log("file_finished", seconds=round(seconds, 3))
+        self.files.pop(context["file"], None)
+        current_file.set(None)
+    @contextlib.contextmanager
+    def span(self, stage, exclude=None):
+        #Time spent in the excluded stage while the span is open is not counted twice
+        context = current_file.get()
+        excluded_before = self.get_stage_seconds(exclude, context)
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            seconds = time.monotonic() - start_time
+            if exclude is not None:
+                seconds -= self.get_stage_seconds(exclude, context) - excluded_before
+            self.record(stage, max(0.0, seconds), context)
+    def record(self, stage, seconds, context=None):
+        context = context or current_file.get()
+        self.observe(stage, seconds)
+        if context is not None:
+            #Stages that run more than once for a file, such as shard uploads, add up
+            context["stages"][stage] = context["stages"].get(stage, 0.0) + seconds
+        self.log("stage_completed", context, stage=stage, seconds=round(seconds, 3))
+    def observe(self, stage, seconds):
+        self.stage_counts[stage] += 1
+        self.stage_sums[stage] += seconds
+        self.stage_max[stage] = max(self.stage_max[stage], seconds)
+        buckets = self.stage_buckets[stage]
+        for index, bound in enumerate(STAGE_BUCKETS):
+            if seconds <= bound:
+                buckets[index] += 1
+    def record_batch(self, batch_response):
+        #Validation and in-progress time come from the service's own timestamps for the batch
+        created_at = getattr(batch_response, "created_at", None)
+        in_progress_at = getattr(batch_response, "in_progress_at", None)
+        finalizing_at = getattr(batch_response, "finalizing_at", None)
+        ended_at = (getattr(batch_response, "completed_at", None) or getattr(batch_response, "failed_at", None)
+                    or getattr(batch_response, "cancelled_at", None) or getattr(batch_response, "expired_at", None))
+        if created_at is not None and in_progress_at is not None:
+            self.record("batch_validation", max(0, in_progress_at - created_at))
+            if finalizing_at is not None or ended_at is not None:
+                self.record("batch_in_progress", max(0, (finalizing_at or ended_at) - in_progress_at))
+        if finalizing_at is not None and ended_at is not None:
+            self.record("batch_finalizing", max(0, ended_at - finalizing_at))
+    async def time_chunks(self, chunks, stage):
+        #Wraps a chunk stream and records the time spent waiting on it and the bytes it delivered
+        context = current_file.get()
+        seconds = 0.0
+        try:
+            while True:
+                start_time = time.monotonic()
+                try:
+                    chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    seconds += time.monotonic() - start_time
+                self.increment("bytes_downloaded", len(chunk))
+                yield chunk
+        finally:
+            self.record(stage, seconds, context)
+    def increment(self, name, value=1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += value
+    def get_stage_seconds(self, stage, context=None):
+        context = context or current_file.get()
+        if stage is None or context is None:
+            return 0.0
+        return context["stages"].get(stage, 0.0)
+    def get_file_timings(self):
+        context = current_file.get()
+        if context is None:
+            return {}
+        return {stage: round(seconds, 3) for stage, seconds in context["stages"].items()}
+    def get_correlation_id(self):
+        context = current_file.get()
+        return context["correlation_id"] if context is not None else None
+    def log(self, event, context=None, **fields):
+        if not self.structured_logs:
+            return
+        context = context or current_file.get()
+        entry = {"time": datetime.datetime.now().isoformat(), "event": event}
+        if context is not None:
+            entry["correlation_id"] = context["correlation_id"]
+            entry["file"] = context["file"]
+        entry.update(fields)
+        print(json.dumps(entry))
+    def get_snapshot(self):
+        sources = {}
+        for name, get_stats in self.sources.items():
+            try:
+                sources[name] = get_stats()
+            except Exception as e:
+                sources[name] = {"error": str(e)}
+        return {
+            "time": datetime.datetime.now().isoformat(),
+            "active_files": len(self.files),
+            "counters": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in self.counters.items()],
+            "stages": {stage: {"count": self.stage_counts[stage], "sum_seconds": round(self.stage_sums[stage], 3),
+                               "max_seconds": round(self.stage_max[stage], 3)} for stage in self.stage_counts},
+            "sources": sources
+        }
+    def to_prometheus(self):
+        snapshot = self.get_snapshot()
+        lines = [f"# TYPE {self.prefix}_active_files gauge", f"{self.prefix}_active_files {snapshot['active_files']}"]
+        counter_names = sorted(set(counter["name"] for counter in snapshot["counters"]))
+        for name in counter_names:
+            metric = self.get_metric_name(name) + "_total"
+            lines.append(f"# TYPE {metric} counter")
+            for counter in snapshot["counters"]:
+                if counter["name"] == name:
+                    lines.append(f"{metric}{self.format_labels(counter['labels'])} {counter['value']}")
+        metric = f"{self.prefix}_stage_seconds"
+        lines.append(f"# TYPE {metric} histogram")
+        for stage in sorted(self.stage_counts):
+            for bound, count in zip(STAGE_BUCKETS, self.stage_buckets[stage]):
+                lines.append(f"{metric}_bucket{self.format_labels({'stage': stage, 'le': bound})} {count}")
+            lines.append(f"{metric}_bucket{self.format_labels({'stage': stage, 'le': '+Inf'})} {self.stage_counts[stage]}")
+            lines.append(f"{metric}_sum{self.format_labels({'stage': stage})} {self.stage_sums[stage]}")
+            lines.append(f"{metric}_count{self.format_labels({'stage': stage})} {self.stage_counts[stage]}")
+        for name, stats in snapshot["sources"].items():
+            self.add_gauges(lines, self.get_metric_name(name), stats, {})
+        return "\n".join(lines) + "\n"
+    def add_gauges(self, lines, metric, stats, labels):
+        #Numeric stats become gauges; a dict of dicts, such as per-deployment stats, becomes one series per key
+        if "name" not in labels and len(stats) > 0 and all(isinstance(value, dict) for value in stats.values()):
+            for name, value in stats.items():
+                self.add_gauges(lines, metric, value, {**labels, "name": name})
+            return
+        for key, value in stats.items():
+            if isinstance(value, bool):
+                value = int(value)
+            if isinstance(value, (int, float)):
+                lines.append(f"{metric}_{self.get_name_part(key)}{self.format_labels(labels)} {value}")
+            elif isinstance(value, dict):
+                self.add_gauges(lines, f"{metric}_{self.get_name_part(key)}", value, labels)
+    def get_metric_name(self, name):
+        return f"{self.prefix}_{self.get_name_part(name)}"
+    def get_name_part(self, name):
+        return re.sub(r"[^a-zA-Z0-9_]", "_", str(name))
+    def format_labels(self, labels):
+        if len(labels) == 0:
+            return ""
+        label_text = ",".join(f'{key}="{str(value)}"' for key, value in labels.items())
+        return "{" + label_text + "}"
+    def start(self):
+        if not self.is_exported():
+            return None
+        return asyncio.create_task(self.run())
+    async def run(self):
+        runner = None
+        try:
+            if self.port > 0:
+                from aiohttp import web
+                app = web.Application()
+                app.router.add_get("/metrics", self.serve_prometheus)
+                app.router.add_get("/metrics.json", self.serve_json)
+                runner = web.AppRunner(app)
+                await runner.setup()
+                await web.TCPSite(runner, port=self.port).start()
+                print(f"Metrics available on port {self.port} at /metrics and /metrics.json")
+            while True:
+                await asyncio.sleep(self.snapshot_interval)
+                if self.snapshot_path != "":
+                    await asyncio.to_thread(self.write_snapshot)
+        finally:
+            if self.snapshot_path != "":
+                self.write_snapshot()
+            if runner is not None:
+                await runner.cleanup()
+    def write_snapshot(self):
+        try:
+            with open(self.snapshot_path, "w") as snapshot_file:
+                json.dump(self.get_snapshot(), snapshot_file, indent=2, default=str)
+        except Exception as e:
+            print(f"Could not write metrics snapshot to {self.snapshot_path}. Error: {e}")
+    async def serve_prometheus(self, request):
+        from aiohttp import web
+        return web.Response(text=self.to_prometheus(), content_type="text/plain")
+    async def serve_json(self, request):
+        from aiohttp import web
+        return web.json_response(self.get_snapshot(), dumps=lambda data: json.dumps(data, default=str))
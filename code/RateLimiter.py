@@ -0,0 +1,40 @@
+import asyncio
+import time
+
+class RateLimiter:
+    #Token buckets for requests and tokens per minute. A 429 pauses every caller until its Retry-After has passed.
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.request_allowance = requests_per_minute
+        self.token_allowance = tokens_per_minute
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+    def refill(self, now):
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        self.request_allowance = min(self.requests_per_minute, self.request_allowance + elapsed * self.requests_per_minute / 60)
+        self.token_allowance = min(self.tokens_per_minute, self.token_allowance + elapsed * self.tokens_per_minute / 60)
+    async def acquire(self, tokens):
+        #Requests larger than the whole token budget only wait for a full bucket
+        tokens = min(tokens, self.tokens_per_minute)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.refill(now)
+                wait_time = 0.0
+                if self.requests_per_minute > 0 and self.request_allowance < 1:
+                    wait_time = (1 - self.request_allowance) * 60 / self.requests_per_minute
+                if self.tokens_per_minute > 0 and self.token_allowance < tokens:
+                    wait_time = max(wait_time, (tokens - self.token_allowance) * 60 / self.tokens_per_minute)
+                if wait_time <= 0:
+                    self.request_allowance -= 1
+                    self.token_allowance -= tokens
+                    return
+                await asyncio.sleep(wait_time)
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
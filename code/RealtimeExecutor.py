@@ -0,0 +1,184 @@
+import asyncio
+import datetime
+import json
+import time
+import uuid
+from RateLimiter import RateLimiter
+from RequestRetrier import RETRYABLE_STATUS_CODES
+
+class RealtimeExecutor:
+    #Runs small or urgent files request by request against the chat completions endpoint instead of the Batch API.
+    #Results are written to staging files in the same line format as batch output and error files.
+    def __init__(self, aoai_client, storage_handler, staging_directory, max_file_bytes=0, urgent_directories=None,
+                 urgent_metadata_key="", max_concurrency=20, requests_per_minute=0, tokens_per_minute=0, max_retries=5,
+                 deployment_name=""):
+        self.aoai_client = aoai_client
+        self.storage_handler = storage_handler
+        self.staging_directory = staging_directory
+        self.max_file_bytes = int(max_file_bytes)
+        self.urgent_directories = [directory.strip("/") for directory in (urgent_directories or []) if directory]
+        self.urgent_metadata_key = urgent_metadata_key
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.rate_limiter = RateLimiter(int(requests_per_minute), int(tokens_per_minute))
+        self.max_retries = max_retries
+        #Batch deployments don't serve real-time calls, so requests can be sent to a standard deployment instead
+        self.deployment_name = deployment_name
+        self.client = None
+        self.throttled_count = 0
+    def get_client(self):
+        if self.client is None:
+            self.client = self.aoai_client.get_async_client().with_options(max_retries=0)
+        return self.client
+    def is_enabled(self):
+        return self.max_file_bytes > 0 or len(self.urgent_directories) > 0 or self.urgent_metadata_key != ""
+    def is_urgent_directory(self, file):
+        file = file.strip("/")
+        return any(file.startswith(directory + "/") for directory in self.urgent_directories)
+    def is_small(self, file):
+        return self.max_file_bytes > 0 and self.storage_handler.get_file_size_by_path(file) <= self.max_file_bytes
+    def should_run(self, file):
+        if self.is_urgent_directory(file) or self.is_small(file):
+            return True
+        if self.urgent_metadata_key != "":
+            metadata = self.storage_handler.get_file_metadata(file)
+            return str(metadata.get(self.urgent_metadata_key, "")).lower() == "true"
+        return False
+    def get_staging_paths(self, file):
+        #Keyed by the full input path so files with the same name in different directories don't collide
+        file = file.lstrip("/")
+        return f"{self.staging_directory}/realtime/output/{file}", f"{self.staging_directory}/realtime/error/{file}"
+    async def run(self, file, input_file=None):
+        #input_file is read in place of the file when its requests were staged elsewhere
+        start_time = time.monotonic()
+        await self.aoai_client.load_clients()
+        throttled_count = self.throttled_count
+        output_file, error_file = self.get_staging_paths(file)
+        writers = {"output": ResultWriter(self.storage_handler, output_file), "error": ResultWriter(self.storage_handler, error_file)}
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        tasks = []
+        lines = iter(await asyncio.to_thread(self.storage_handler.iter_file_lines_by_path, input_file or file))
+        while True:
+            line = await asyncio.to_thread(next, lines, None)
+            if line is None:
+                break
+            if len(line.strip()) == 0:
+                continue
+            await semaphore.acquire()
+            tasks.append(asyncio.create_task(self.run_request(line, writers, semaphore)))
+        if len(tasks) > 0:
+            await asyncio.gather(*tasks)
+        for writer in writers.values():
+            await writer.close()
+        result = {
+            "output_file": output_file if writers["output"].line_count > 0 else None,
+            "error_file": error_file if writers["error"].line_count > 0 else None,
+            "request_count": writers["output"].line_count + writers["error"].line_count,
+            "succeeded": writers["output"].line_count,
+            "failed": writers["error"].line_count,
+            "throttled": self.throttled_count - throttled_count,
+            "elapsed_seconds": round(time.monotonic() - start_time, 3)
+        }
+        print(f"{datetime.datetime.now()} File {file} processed in real time: {result['succeeded']} succeeded, "
+              f"{result['failed']} failed in {result['elapsed_seconds']}s")
+        return result
+    async def run_request(self, line, writers, semaphore):
+        try:
+            try:
+                request = json.loads(line)
+            except Exception as e:
+                await writers["error"].write(self.create_result_line(None, None, None, {"code": "invalid_json", "message": str(e)}))
+                return
+            status_code, request_id, body, error = await self.call(request)
+            writer = writers["output"] if status_code == 200 else writers["error"]
+            await writer.write(self.create_result_line(request.get("custom_id"), status_code, request_id, error, body))
+        finally:
+            semaphore.release()
+    async def call(self, request):
+        body = dict(request.get("body") or {})
+        if self.deployment_name:
+            body["model"] = self.deployment_name
+        #Prompt size is estimated from the request size; the completion budget counts against TPM as well
+        tokens = len(json.dumps(body.get("messages", ""))) // 4 + int(body.get("max_tokens") or body.get("max_completion_tokens") or 0)
+        attempt = 0
+        client = self.get_client()
+        #Only imported here, as the package is already loaded by the client
+        import openai
+        while True:
+            await self.rate_limiter.acquire(tokens)
+            try:
+                raw_response = await client.chat.completions.with_raw_response.create(**body)
+                completion = raw_response.parse()
+                return 200, self.get_request_id(raw_response.headers), json.loads(completion.model_dump_json()), None
+            except openai.APIStatusError as e:
+                if e.status_code in RETRYABLE_STATUS_CODES and attempt < self.max_retries:
+                    retry_after = self.get_retry_after(e.response.headers, attempt)
+                    if e.status_code == 429:
+                        self.throttled_count += 1
+                        self.rate_limiter.pause(retry_after)
+                    else:
+                        await asyncio.sleep(retry_after)
+                    attempt += 1
+                    continue
+                error_body = e.body if isinstance(e.body, dict) else {"message": str(e)}
+                return e.status_code, self.get_request_id(e.response.headers), {"error": error_body.get("error", error_body)}, None
+            except openai.APIConnectionError as e:
+                if attempt < self.max_retries:
+                    await asyncio.sleep(self.get_retry_after({}, attempt))
+                    attempt += 1
+                    continue
+                return None, None, None, {"code": "connection_error", "message": str(e)}
+            except TypeError as e:
+                #The body has a parameter the chat completions client does not accept
+                return None, None, None, {"code": "invalid_request", "message": str(e)}
+            except Exception as e:
+                return None, None, None, {"code": "request_failed", "message": str(e)}
+    def get_retry_after(self, headers, attempt):
+        try:
+            if headers.get("retry-after-ms") is not None:
+                return float(headers.get("retry-after-ms")) / 1000
+            if headers.get("retry-after") is not None:
+                return float(headers.get("retry-after"))
+        except ValueError:
+            pass
+        return min(2 ** attempt, 60)
+    def get_request_id(self, headers):
+        return headers.get("x-request-id") or headers.get("apim-request-id")
+    def create_result_line(self, custom_id, status_code, request_id, error, body=None):
+        #Same shape as a line of a batch output or error file
+        result = {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": custom_id, "response": None, "error": error}
+        if status_code is not None:
+            result["response"] = {"status_code": status_code, "request_id": request_id, "body": body}
+        return json.dumps(result).encode() + b"\n"
+    def delete_staging_files(self, realtime_result):
+        for staging_file in (realtime_result["output_file"], realtime_result["error_file"]):
+            if staging_file is not None:
+                self.storage_handler.delete_file(staging_file)
+
+class ResultWriter:
+    #Buffers result lines and appends them to a staging file off the event loop; the file is only created if written to
+    def __init__(self, storage_handler, file_path, buffer_size=4194304):
+        self.storage_handler = storage_handler
+        self.file_path = file_path
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+        self.writer = None
+        self.line_count = 0
+        self.lock = asyncio.Lock()
+    async def write(self, line):
+        self.buffer += line
+        self.line_count += 1
+        if len(self.buffer) >= self.buffer_size:
+            await self.flush()
+    async def flush(self):
+        async with self.lock:
+            if len(self.buffer) == 0:
+                return
+            data = bytes(self.buffer)
+            self.buffer = bytearray()
+            if self.writer is None:
+                self.writer = await asyncio.to_thread(self.storage_handler.get_file_writer, self.file_path)
+            await asyncio.to_thread(self.writer.write, data)
+    async def close(self):
+        await self.flush()
+        if self.writer is not None:
+            await asyncio.to_thread(self.writer.close)
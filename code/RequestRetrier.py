@@ -0,0 +1,57 @@
+import json
+
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+RETRYABLE_ERROR_CODES = ("rate_limit_exceeded", "too_many_requests", "server_error", "internal_error", "timeout",
+                         "service_unavailable")
+
+class RequestRetrier:
+    #Resubmits only the requests of a finished job that failed with a transient error. The failed custom_ids are read
+    #from the batch error file and the matching input lines are written to a smaller retry file in the staging directory.
+    def __init__(self, storage_handler, staging_directory, max_attempts=0, backoff_seconds=60,
+                 retryable_status_codes=RETRYABLE_STATUS_CODES, retryable_error_codes=RETRYABLE_ERROR_CODES):
+        self.storage_handler = storage_handler
+        self.staging_directory = staging_directory
+        self.max_attempts = int(max_attempts)
+        self.backoff_seconds = backoff_seconds
+        self.retryable_status_codes = tuple(retryable_status_codes)
+        self.retryable_error_codes = tuple(retryable_error_codes)
+    def is_enabled(self):
+        return self.max_attempts > 0
+    def get_retry_path(self, file, attempt):
+        #Keyed by the full input path so files with the same name in different directories don't collide
+        return f"{self.staging_directory}/retries/{attempt}/{file.lstrip('/')}"
+    def get_delay(self, attempt):
+        return self.backoff_seconds * (2 ** (attempt - 1))
+    def get_retryable_custom_id(self, line):
+        #Returns the custom_id of an error line whose failure is transient, otherwise None
+        try:
+            result = json.loads(line)
+        except Exception:
+            return None
+        response = result.get("response") or {}
+        error = result.get("error") or ((response.get("body") or {}).get("error")) or {}
+        if response.get("status_code") in self.retryable_status_codes or error.get("code") in self.retryable_error_codes:
+            return result.get("custom_id")
+        return None
+    def write_retry_file(self, input_file, custom_ids, retry_file):
+        writer = None
+        request_count = 0
+        for line in self.storage_handler.iter_file_lines_by_path(input_file):
+            if len(line.strip()) == 0:
+                continue
+            try:
+                custom_id = json.loads(line).get("custom_id")
+            except Exception:
+                continue
+            if custom_id not in custom_ids:
+                continue
+            if writer is None:
+                writer = self.storage_handler.get_file_writer(retry_file)
+            writer.write(line)
+            request_count += 1
+        if writer is not None:
+            writer.close()
+        return request_count
+    def delete_retry_files(self, retry_files):
+        for retry_file in retry_files:
+            self.storage_handler.delete_file(retry_file)
@@ -0,0 +1,295 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+class ResultCache:
+    #Content-addressed cache of successful responses, keyed by a hash of each request's url and body
+    #(model, messages and parameters). Cached requests are removed from a file before upload and their
+    #responses are merged back into the output under the original custom_id.
+    def __init__(self, cache_store, staging_directory, lookup_batch_size=500):
+        self.cache_store = cache_store
+        self.staging_directory = staging_directory
+        self.lookup_batch_size = lookup_batch_size
+    @staticmethod
+    def get_request_key(request):
+        canonical_request = json.dumps({"url": request.get("url"), "body": request.get("body")}, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical_request.encode()).hexdigest()
+    def get_staging_paths(self, file):
+        #Keyed by the full input path so files with the same name in different directories don't collide
+        file = file.lstrip("/")
+        return f"{self.staging_directory}/cache/uncached/{file}", f"{self.staging_directory}/cache/cached/{file}"
+    def filter_input(self, storage_handler, file, input_file=None):
+        #First pass looks every request up; the second pass, only needed when something was cached, splits the
+        #file into the requests still to run and the cached responses. input_file is read in place of the file
+        #when its requests were staged elsewhere, such as the valid lines kept by input validation.
+        input_file = input_file or file
+        lookups = 0
+        hits = {}
+        batch_keys = []
+        for line in storage_handler.iter_file_lines_by_path(input_file):
+            if len(line.strip()) == 0:
+                continue
+            lookups += 1
+            batch_keys.append(self.get_request_key(json.loads(line)))
+            if len(batch_keys) >= self.lookup_batch_size:
+                hits.update(self.cache_store.get_many(batch_keys))
+                batch_keys = []
+        if len(batch_keys) > 0:
+            hits.update(self.cache_store.get_many(batch_keys))
+        cache_result = {"lookups": lookups, "hits": 0, "tokens_saved": 0, "uncached_file": input_file, "cached_file": None}
+        if len(hits) == 0:
+            return cache_result
+        uncached_file, cached_file = self.get_staging_paths(file)
+        uncached_writer = None
+        cached_writer = storage_handler.get_file_writer(cached_file)
+        for line in storage_handler.iter_file_lines_by_path(input_file):
+            if len(line.strip()) == 0:
+                continue
+            request = json.loads(line)
+            cached_response = hits.get(self.get_request_key(request))
+            if cached_response is None:
+                if uncached_writer is None:
+                    uncached_writer = storage_handler.get_file_writer(uncached_file)
+                uncached_writer.write(line)
+                continue
+            response, tokens = cached_response
+            result = {"custom_id": request.get("custom_id"), "response": json.loads(response), "error": None, "cached": True}
+            cached_writer.write(json.dumps(result).encode() + b"\n")
+            cache_result["hits"] += 1
+            cache_result["tokens_saved"] += tokens
+        cached_writer.close()
+        cache_result["cached_file"] = cached_file
+        cache_result["uncached_file"] = None
+        if uncached_writer is not None:
+            uncached_writer.close()
+            cache_result["uncached_file"] = uncached_file
+        print(f"File {file}: {cache_result['hits']} of {lookups} request(s) served from the result cache.")
+        return cache_result
+    def get_request_keys(self, storage_handler, file):
+        request_keys = {}
+        for line in storage_handler.iter_file_lines_by_path(file):
+            if len(line.strip()) > 0:
+                request = json.loads(line)
+                request_keys[request.get("custom_id")] = self.get_request_key(request)
+        return request_keys
+    def delete_staging_files(self, storage_handler, file, cache_result):
+        for staging_file in (cache_result["uncached_file"], cache_result["cached_file"]):
+            if staging_file is not None and staging_file != file:
+                storage_handler.delete_file(staging_file)
+    def create_collector(self, request_keys):
+        return ResultCollector(self.cache_store, request_keys)
+    @staticmethod
+    def get_metadata(cache_result):
+        return {
+            "cache_lookups": cache_result["lookups"],
+            "cache_hits": cache_result["hits"],
+            "cache_hit_rate": round(cache_result["hits"] / cache_result["lookups"], 4) if cache_result["lookups"] > 0 else 0.0,
+            "cache_tokens_saved": cache_result["tokens_saved"]
+        }
+
+class ResultCollector:
+    #Picks successful responses out of an output stream and stores them in the cache in batches
+    def __init__(self, cache_store, request_keys, batch_size=500):
+        self.cache_store = cache_store
+        self.request_keys = request_keys
+        self.batch_size = batch_size
+        self.items = []
+    def add(self, line):
+        try:
+            result = json.loads(line)
+        except Exception:
+            return False
+        response = result.get("response")
+        request_key = self.request_keys.get(result.get("custom_id"))
+        if request_key is None or response is None or response.get("status_code") != 200:
+            return False
+        usage = (response.get("body") or {}).get("usage") or {}
+        self.items.append((request_key, json.dumps(response), usage.get("total_tokens", 0)))
+        #Returns True once a batch is ready so the caller can flush it off the event loop
+        return len(self.items) >= self.batch_size
+    def flush(self):
+        if len(self.items) > 0:
+            self.cache_store.put_many(self.items)
+            self.items = []
+
+class LocalCacheStore:
+    #SQLite-backed store with TTL expiry and least-recently-used eviction once max_bytes is exceeded
+    def __init__(self, cache_path, ttl_seconds=604800, max_bytes=1000000000):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        #Lookups run on worker threads, so access to the shared connection is serialized
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(cache_path, check_same_thread=False)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS results (
+            request_key TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            tokens INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            accessed_at REAL NOT NULL
+        )""")
+        self.connection.commit()
+    def get_many(self, request_keys):
+        now = time.time()
+        placeholders = ",".join("?" * len(request_keys))
+        with self.lock:
+            rows = self.connection.execute(f"SELECT request_key, response, tokens FROM results WHERE request_key IN ({placeholders}) AND created_at > ?",
+                                           list(request_keys) + [now - self.ttl_seconds]).fetchall()
+            hit_placeholders = ",".join("?" * len(rows))
+            self.connection.execute(f"UPDATE results SET accessed_at = ? WHERE request_key IN ({hit_placeholders})", [now] + [row[0] for row in rows])
+            self.connection.commit()
+        return {row[0]: (row[1], row[2]) for row in rows}
+    def put_many(self, items):
+        now = time.time()
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                                        [(request_key, response, tokens, len(response), now, now) for request_key, response, tokens in items])
+            self.connection.commit()
+    def evict(self):
+        with self.lock:
+            self.evict_expired_and_oldest()
+    def evict_expired_and_oldest(self):
+        self.connection.execute("DELETE FROM results WHERE created_at <= ?", (time.time() - self.ttl_seconds,))
+        total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total_bytes > self.max_bytes:
+            excess_bytes = total_bytes - self.max_bytes
+            removed_bytes = 0
+            request_keys = []
+            for request_key, size in self.connection.execute("SELECT request_key, size FROM results ORDER BY accessed_at"):
+                if removed_bytes >= excess_bytes:
+                    break
+                request_keys.append((request_key,))
+                removed_bytes += size
+            self.connection.executemany("DELETE FROM results WHERE request_key = ?", request_keys)
+        self.connection.commit()
+    def close(self):
+        self.connection.close()
+
+class StorageCacheStore:
+    #Data Lake-backed store shared between workers. Each batch of responses is written as one segment file under
+    #segments/, followed by a manifest of its request keys under manifests/. Lookups read the manifests of segments
+    #they haven't seen into an in-memory index and then read each segment holding a hit once, so a batch of lookups
+    #costs one listing and one read per segment instead of one read per request. Segments are never modified;
+    #expired segments, and the oldest ones once max_bytes is exceeded, are deleted whole at most every evict_interval
+    #seconds.
+    def __init__(self, storage_handler, cache_directory, ttl_seconds=604800, max_bytes=1000000000, max_workers=16,
+                 evict_interval=3600):
+        self.storage_handler = storage_handler
+        self.cache_directory = cache_directory.strip("/")
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.evict_interval = evict_interval
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        #Lookups and writes run on worker threads, so updates to the index are serialized
+        self.lock = threading.Lock()
+        #Request key to the newest segment holding it, and each known segment's request keys
+        self.index = {}
+        self.segments = {}
+        self.last_evicted_at = None
+    def get_segment_path(self, segment):
+        return f"{self.cache_directory}/segments/{segment}.jsonl"
+    def get_manifest_path(self, segment):
+        return f"{self.cache_directory}/manifests/{segment}.json"
+    @staticmethod
+    def get_segment_name(path):
+        return path.name.split("/")[-1].split(".")[0]
+    @staticmethod
+    def get_created_at(segment):
+        #Segment names start with their creation time in milliseconds, so they also sort oldest first
+        return int(segment.split("_")[0]) / 1000
+    def list_segments(self, directory):
+        try:
+            return self.storage_handler.get_path_properties(f"{self.cache_directory}/{directory}")
+        except Exception:
+            return []
+    def read_manifest(self, segment):
+        try:
+            return json.loads(self.storage_handler.get_file_data_by_path(self.get_manifest_path(segment)))
+        except Exception:
+            return None
+    def add_segment(self, segment, request_keys):
+        self.segments[segment] = request_keys
+        for request_key in request_keys:
+            current_segment = self.index.get(request_key)
+            if current_segment is None or current_segment < segment:
+                self.index[request_key] = segment
+    def remove_segment(self, segment):
+        for request_key in self.segments.pop(segment, []):
+            if self.index.get(request_key) == segment:
+                del self.index[request_key]
+    def refresh_index(self):
+        #Segments written by other workers are added and segments they evicted are dropped
+        with self.lock:
+            listed_segments = sorted(self.get_segment_name(path) for path in self.list_segments("manifests"))
+            new_segments = [segment for segment in listed_segments if segment not in self.segments]
+            for segment, request_keys in zip(new_segments, self.executor.map(self.read_manifest, new_segments)):
+                if request_keys is not None:
+                    self.add_segment(segment, request_keys)
+            listed_segments = set(listed_segments)
+            for segment in [segment for segment in self.segments if segment not in listed_segments]:
+                self.remove_segment(segment)
+    def read_segment(self, item):
+        segment, request_keys = item
+        entries = {}
+        try:
+            for line in self.storage_handler.iter_file_lines_by_path(self.get_segment_path(segment)):
+                entry = json.loads(line)
+                if entry["request_key"] in request_keys:
+                    entries[entry["request_key"]] = (entry["response"], entry["tokens"])
+        except Exception:
+            return {}
+        return entries
+    def get_many(self, request_keys):
+        self.refresh_index()
+        expiry = time.time() - self.ttl_seconds
+        segment_keys = {}
+        with self.lock:
+            for request_key in request_keys:
+                segment = self.index.get(request_key)
+                if segment is not None and self.get_created_at(segment) > expiry:
+                    segment_keys.setdefault(segment, set()).add(request_key)
+        hits = {}
+        for entries in self.executor.map(self.read_segment, segment_keys.items()):
+            hits.update(entries)
+        return hits
+    def put_many(self, items):
+        if len(items) == 0:
+            return
+        segment = f"{int(time.time() * 1000):013d}_{uuid.uuid4().hex}"
+        segment_data = "".join(json.dumps({"request_key": request_key, "response": response, "tokens": tokens}) + "\n"
+                               for request_key, response, tokens in items)
+        request_keys = [request_key for request_key, response, tokens in items]
+        #The manifest is written last so other workers only see complete segments
+        if not self.storage_handler.write_json_to_storage(self.get_segment_path(segment), segment_data,
+                                                          self.storage_handler.file_system_client):
+            return
+        if not self.storage_handler.write_json_to_storage(self.get_manifest_path(segment), json.dumps(request_keys),
+                                                          self.storage_handler.file_system_client):
+            self.storage_handler.delete_file(self.get_segment_path(segment))
+            return
+        with self.lock:
+            self.add_segment(segment, request_keys)
+    def evict(self):
+        #Called after every file whose results were cached; listing the whole cache is only worth it now and then
+        if self.last_evicted_at is not None and time.monotonic() - self.last_evicted_at < self.evict_interval:
+            return
+        self.last_evicted_at = time.monotonic()
+        expiry = time.time() - self.ttl_seconds
+        paths = sorted(self.list_segments("segments"), key=lambda path: path.name)
+        total_bytes = sum(path.content_length for path in paths)
+        for path in paths:
+            segment = self.get_segment_name(path)
+            if self.get_created_at(segment) > expiry and total_bytes <= self.max_bytes:
+                break
+            #The manifest goes first so lookups are never directed at a deleted segment
+            self.storage_handler.delete_file(self.get_manifest_path(segment))
+            if self.storage_handler.delete_file(path.name):
+                total_bytes -= path.content_length
+            with self.lock:
+                self.remove_segment(segment)
+    def close(self):
+        self.executor.shutdown()
@@ -0,0 +1,164 @@
+import bisect
+import json
+from Utilities import Utils
+
+#Only imported once a result store is configured
+pyarrow = None
+
+RESULT_SCHEMA_FIELDS = (
+    ("custom_id", "string"),
+    ("source", "string"),
+    ("status_code", "int32"),
+    ("content", "string"),
+    ("finish_reason", "string"),
+    ("prompt_tokens", "int64"),
+    ("completion_tokens", "int64"),
+    ("total_tokens", "int64"),
+    ("error_code", "string"),
+    ("error_message", "string"),
+    ("input_offset", "int64"),
+    ("input_length", "int64")
+)
+
+def load_pyarrow():
+    global pyarrow
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+class ResultStore:
+    #Writes a compressed columnar copy of a file's output and error lines, in Parquet or Arrow IPC format, with one
+    #row per request. input_offset and input_length locate the matching request line in the input file, which is
+    #copied next to the results. A separate index of sorted custom_ids with their row group and position in it lets
+    #a single result be read from one row group without scanning the whole file.
+    def __init__(self, file_format="", compression="zstd", row_group_size=10000):
+        self.file_format = file_format
+        self.compression = compression
+        self.row_group_size = row_group_size
+        if file_format not in ("", "parquet", "arrow"):
+            raise ValueError(f"Unsupported result_store_format: {file_format}. Use parquet or arrow.")
+        if self.is_enabled():
+            try:
+                load_pyarrow()
+            except ImportError:
+                raise ImportError("pyarrow is required for result_store_format, install it with: pip install pyarrow")
+    def is_enabled(self):
+        return self.file_format != ""
+    def get_filenames(self, filename_only):
+        extension = "parquet" if self.file_format == "parquet" else "arrow"
+        return f"{filename_only}_results.{extension}", f"{filename_only}_results_index.{extension}"
+    def get_schema(self):
+        return pyarrow.schema([(name, getattr(pyarrow, type_name)()) for name, type_name in RESULT_SCHEMA_FIELDS])
+    def get_input_offsets(self, input_lines):
+        #Offset and length of each request line by custom_id, read in one pass over the input
+        offsets = {}
+        offset = 0
+        for line in input_lines:
+            custom_id = Utils.get_custom_id(line)
+            if custom_id is not None and custom_id not in offsets:
+                offsets[custom_id] = (offset, len(line))
+            offset += len(line)
+        return offsets
+    def write(self, input_lines, result_sources, data_path, index_path):
+        #result_sources are (source name, line iterator) pairs; rows are written a row group at a time
+        input_offsets = self.get_input_offsets(input_lines)
+        schema = self.get_schema()
+        writer = self.open_writer(data_path, schema)
+        columns = {name: [] for name, type_name in RESULT_SCHEMA_FIELDS}
+        index = []
+        row_count = 0
+        row_group = 0
+        try:
+            for source, lines in result_sources:
+                for line in lines:
+                    row = self.parse_result_line(line, source)
+                    if row is None:
+                        continue
+                    if row["custom_id"] is not None:
+                        row["input_offset"], row["input_length"] = input_offsets.get(row["custom_id"], (None, None))
+                        index.append((row["custom_id"], row_group, len(columns["custom_id"])))
+                    for name in columns:
+                        columns[name].append(row.get(name))
+                    row_count += 1
+                    if len(columns["custom_id"]) >= self.row_group_size:
+                        self.write_row_group(writer, schema, columns)
+                        row_group += 1
+            if len(columns["custom_id"]) > 0:
+                self.write_row_group(writer, schema, columns)
+        finally:
+            writer.close()
+        self.write_index(index, index_path)
+        return row_count
+    def open_writer(self, path, schema):
+        if self.file_format == "parquet":
+            return pyarrow.parquet.ParquetWriter(path, schema, compression=self.compression)
+        options = pyarrow.ipc.IpcWriteOptions(compression=self.compression)
+        return pyarrow.ipc.new_file(path, schema, options=options)
+    def write_row_group(self, writer, schema, columns):
+        batch = pyarrow.RecordBatch.from_pydict(columns, schema=schema)
+        if self.file_format == "parquet":
+            writer.write_batch(batch, row_group_size=self.row_group_size)
+        else:
+            writer.write_batch(batch)
+        for values in columns.values():
+            values.clear()
+    def write_index(self, index, index_path):
+        index.sort()
+        table = pyarrow.table({"custom_id": pyarrow.array([entry[0] for entry in index], pyarrow.string()),
+                               "row_group": pyarrow.array([entry[1] for entry in index], pyarrow.int32()),
+                               "row": pyarrow.array([entry[2] for entry in index], pyarrow.int32())})
+        if self.file_format == "parquet":
+            pyarrow.parquet.write_table(table, index_path, compression=self.compression)
+        else:
+            with pyarrow.ipc.new_file(index_path, table.schema,
+                                      options=pyarrow.ipc.IpcWriteOptions(compression=self.compression)) as writer:
+                writer.write_table(table)
+    def parse_result_line(self, line, source):
+        try:
+            result = json.loads(line)
+        except ValueError:
+            return None
+        if not isinstance(result, dict):
+            return None
+        row = {"custom_id": result.get("custom_id"), "source": source}
+        response = result.get("response") or {}
+        body = response.get("body") or {}
+        row["status_code"] = response.get("status_code")
+        choices = body.get("choices") or []
+        if len(choices) > 0:
+            choice = choices[0]
+            message = choice.get("message") or {}
+            row["content"] = message.get("content") if "message" in choice else choice.get("text")
+            row["finish_reason"] = choice.get("finish_reason")
+        usage = body.get("usage") or {}
+        for key in ("prompt_tokens", "completion_tokens", "total_tokens"):
+            row[key] = usage.get(key)
+        error = result.get("error") or body.get("error")
+        if isinstance(error, dict):
+            row["error_code"] = error.get("code")
+            row["error_message"] = error.get("message")
+        elif error is not None:
+            row["error_message"] = str(error)
+        elif "response" not in result and row["custom_id"] is None:
+            #Job-level errors are written as a single object of messages rather than as result lines
+            row["error_message"] = json.dumps(result)
+        return row
+    def lookup(self, data_path, index_path, custom_id):
+        #Reads the index, then only the row group holding the result
+        index = self.read_table(index_path)
+        custom_ids = index.column("custom_id").to_pylist()
+        position = bisect.bisect_left(custom_ids, custom_id)
+        if position == len(custom_ids) or custom_ids[position] != custom_id:
+            return None
+        row_group = index.column("row_group")[position].as_py()
+        if self.file_format == "parquet":
+            batch = pyarrow.parquet.ParquetFile(data_path).read_row_group(row_group)
+        else:
+            with pyarrow.memory_map(data_path) as source:
+                batch = pyarrow.ipc.open_file(source).get_batch(row_group)
+        return batch.slice(index.column("row")[position].as_py(), 1).to_pylist()[0]
+    def read_table(self, path):
+        if self.file_format == "parquet":
+            return pyarrow.parquet.read_table(path)
+        with pyarrow.memory_map(path) as source:
+            return pyarrow.ipc.open_file(source).read_all()
@@ -1,8 +1,25 @@
 from Utilities import Utils
-from AzureStorageHandler import StorageHandler
+from ConfigLoader import ConfigLoader
+from LocalStorageHandler import LocalStorageHandler
 from AOAIHandler import AOAIHandler
 from AzureBatch import AzureBatch
-import time
+from BatchComponents import BatchComponents
+from FileSharder import FileSharder
+from FilePacker import FilePacker
+from JobLedger import JobLedger
+from InputDiscovery import InputDiscovery
+from TokenCounter import TokenCounter
+from AdmissionController import AdmissionController
+from DeploymentRouter import DeploymentRouter, Deployment
+from RequestRetrier import RequestRetrier
+from RealtimeExecutor import RealtimeExecutor
+from FileClaimer import FileClaimer
+from FileCleaner import FileCleaner
+from Metrics import Metrics
+from ResultStore import ResultStore
+from InputValidator import InputValidator
+from UsageTracker import UsageTracker
+from ResultCache import ResultCache, LocalCacheStore, StorageCacheStore
 import asyncio
 import signal
 import sys
@@ -12,53 +29,193 @@ def signal_handler(sig, frame):
     print('Exiting...')
     sys.exit(0)
 
+def install_shutdown_handler(azure_batch):
+    #The first signal stops admitting work and lets the ledger be flushed; a second one exits immediately
+    loop = asyncio.get_running_loop()
+    def shutdown_handler(sig, frame):
+        print('Exiting... press ctrl+c again to force exit.')
+        signal.signal(signal.SIGINT, signal_handler)
+        loop.call_soon_threadsafe(azure_batch.request_shutdown)
+    signal.signal(signal.SIGINT, shutdown_handler)
+    signal.signal(signal.SIGTERM, shutdown_handler)
+
+async def run_on_demand(azure_batch, input_discovery, batch_size):
+    install_shutdown_handler(azure_batch)
+    try:
+        files = await input_discovery.discover()
+        await azure_batch.process_all_files(files, batch_size)
+    finally:
+        await azure_batch.close()
+
+async def run_continuous(azure_batch, list_files, batch_size, poll_interval):
+    install_shutdown_handler(azure_batch)
+    try:
+        await azure_batch.process_continuous(list_files, batch_size, poll_interval)
+    finally:
+        await azure_batch.close()
+
+def create_admission_controller(max_enqueued_tokens, app_config_data):
+    if max_enqueued_tokens <= 0:
+        return None
+    return AdmissionController(max_enqueued_tokens, app_config_data.get("admission_order", "sjf"),
+                               int(app_config_data.get("quota_retry_interval", 60)),
+                               int(app_config_data.get("quota_max_retries", 10)),
+                               int(app_config_data.get("admission_max_wait", 3600)))
+
+def create_deployment_router(aoai_config_data, app_config_data):
+    #Each entry of "deployments" overrides the top-level AOAI settings; without it the single configured deployment is used
+    deployments = []
+    for deployment_config in aoai_config_data.get("deployments") or [{}]:
+        handler_config = {key: value for key, value in aoai_config_data.items() if key != "deployments"}
+        handler_config.update(deployment_config)
+        name = handler_config.get("name", f"{handler_config['aoai_deployment_name']}@{handler_config['aoai_endpoint']}")
+        max_enqueued_tokens = int(handler_config.get("max_enqueued_tokens", app_config_data.get("max_enqueued_tokens", 0)))
+        deployments.append(Deployment(name, AOAIHandler(handler_config),
+                                      create_admission_controller(max_enqueued_tokens, app_config_data)))
+    return DeploymentRouter(deployments, int(aoai_config_data.get("validating_timeout", 0)),
+                            int(aoai_config_data.get("deployment_error_cooldown", 300)))
+
+def create_storage_handler(storage_config_data, file_system_name, max_concurrency=8):
+    #The Azure SDK is only imported for Data Lake storage; local storage is for use with FakeAOAIServer
+    if storage_config_data.get("storage_type", "adls") == "local":
+        return LocalStorageHandler(storage_config_data["local_storage_root"], file_system_name)
+    from AzureStorageHandler import StorageHandler
+    return StorageHandler(storage_config_data["storage_account_name"], storage_config_data["storage_account_key"],
+                          file_system_name, max_concurrency)
+
+def get_batch_path(storage_config_data, input_storage_handler):
+    if storage_config_data.get("storage_type", "adls") == "local":
+        return "file://" + input_storage_handler.get_local_path("") + "/"
+    return ("https://" + storage_config_data["storage_account_name"] + ".blob.core.windows.net/" +
+            storage_config_data["input_filesystem_system_name"] + "/")
+
+def prepare(app_config_data):
+    #Run once when building an image: the configs are validated and cached, and the tokenizer's encoding is loaded
+    #so tiktoken keeps its file in its cache directory instead of downloading it on the first start
+    if app_config_data["count_tokens"] or int(app_config_data.get("shard_max_tokens", 0)) > 0:
+        Utils.get_encoding(app_config_data.get("token_count_model", "gpt-4"))
+    print("Configuration is valid.")
+
 def main():
     signal.signal(signal.SIGINT, signal_handler)
     APP_CONFIG = os.environ.get('APP_CONFIG', r"C:\Users\dade\Desktop\AOAIBatchWorkingFork\aoai-batch-api-accelerator\config\app_config.json")
+    #Validated configs are cached here when set, so later starts skip reading and checking each file
+    CONFIG_CACHE = os.environ.get('CONFIG_CACHE', "")
     try:
-        app_config_data = Utils.read_json_data(APP_CONFIG)
-        storage_config_data = Utils.read_json_data(app_config_data["storage_config"])
-        storage_account_name = storage_config_data["storage_account_name"]
-        storage_account_key = storage_config_data["storage_account_key"]
+        app_config_data, storage_config_data, aoai_config_data = ConfigLoader(APP_CONFIG, CONFIG_CACHE).load()
+        if len(sys.argv) > 1 and sys.argv[1] == "prepare":
+            prepare(app_config_data)
+            return
         input_filesystem_system_name =  storage_config_data["input_filesystem_system_name"]
         error_filesystem_system_name = storage_config_data["error_filesystem_system_name"]
         processed_filesystem_system_name = storage_config_data["processed_filesystem_system_name"]
         input_directory = storage_config_data["input_directory"]
         output_directory = storage_config_data["output_directory"]
         error_directory = storage_config_data["error_directory"]
-        aoai_config_data = Utils.read_json_data(app_config_data["AOAI_config"])
-        BATCH_PATH = "https://"+storage_account_name+".blob.core.windows.net/"+input_filesystem_system_name+"/"
         batch_size = int(app_config_data["batch_size"])
-        count_tokens = int(app_config_data["count_tokens"])
-        aoai_client = AOAIHandler(aoai_config_data)
-        input_storage_handler = StorageHandler(storage_account_name, storage_account_key, input_filesystem_system_name)
-        error_storage_handler = StorageHandler(storage_account_name, storage_account_key, error_filesystem_system_name)
-        processed_storage_handler = StorageHandler(storage_account_name, storage_account_key, processed_filesystem_system_name)
-        files = input_storage_handler.get_file_list(input_directory)
+        count_tokens = app_config_data["count_tokens"]
+        #The handlers share one service client for the account; max concurrency bounds parallel block uploads per write
+        storage_max_concurrency = int(app_config_data.get("storage_max_concurrency", 8))
+        input_storage_handler = create_storage_handler(storage_config_data, input_filesystem_system_name, storage_max_concurrency)
+        error_storage_handler = create_storage_handler(storage_config_data, error_filesystem_system_name, storage_max_concurrency)
+        processed_storage_handler = create_storage_handler(storage_config_data, processed_filesystem_system_name,
+                                                           storage_max_concurrency)
+        BATCH_PATH = get_batch_path(storage_config_data, input_storage_handler)
         input_directory_client = input_storage_handler.get_directory_client(input_directory)
         download_to_local = app_config_data["download_to_local"]
         local_download_path = None
         if download_to_local:
             local_download_path = app_config_data["local_download_path"]
         continuous_mode = app_config_data["continuous_mode"]
+        poll_interval = int(app_config_data.get("poll_interval", 60))
+        stats_interval = int(app_config_data.get("scheduler_stats_interval", 60))
+        stream_results = app_config_data.get("stream_results", True)
+        staging_directory = app_config_data.get("staging_directory", "_staging")
+        #Discovery skips the whole staging directory, including other workers' intermediate files and claims
+        input_discovery_exclusions = [staging_directory]
+        file_claimer = None
+        if app_config_data.get("multi_worker", False):
+            file_claimer = FileClaimer(input_storage_handler, staging_directory + "/claims", app_config_data.get("worker_id", ""),
+                                       int(app_config_data.get("claim_lease_seconds", 60)))
+            #Each worker keeps its intermediate files apart so shard and pack names can't collide
+            staging_directory = staging_directory + "/" + file_claimer.worker_id
+        shard_max_tokens = int(app_config_data.get("shard_max_tokens", 0))
+        token_counter = None
+        if count_tokens or shard_max_tokens > 0:
+            token_counter = TokenCounter(app_config_data.get("token_count_model", "gpt-4"), int(app_config_data.get("token_count_workers", 0)))
+        file_sharder = FileSharder(input_storage_handler, staging_directory, app_config_data.get("shard_max_bytes", 0),
+                                   app_config_data.get("shard_max_requests", 0), shard_max_tokens, token_counter)
+        ledger_path = app_config_data.get("ledger_path", "")
+        job_ledger = JobLedger(ledger_path) if ledger_path else None
+        file_packer = FilePacker(input_storage_handler, staging_directory, app_config_data.get("pack_max_file_bytes", 0),
+                                 app_config_data.get("pack_max_bytes", 100000000), app_config_data.get("pack_max_requests", 50000),
+                                 app_config_data.get("pack_max_files", 1000))
+        input_discovery = InputDiscovery(input_storage_handler, input_directory, input_discovery_exclusions,
+                                         int(app_config_data.get("max_parallel_listings", 8)),
+                                         int(app_config_data.get("full_listing_interval", 4)))
+        result_cache = None
+        cache_backend = app_config_data.get("cache_backend", "")
+        cache_ttl_seconds = int(app_config_data.get("cache_ttl_seconds", 604800))
+        cache_max_bytes = int(app_config_data.get("cache_max_bytes", 1000000000))
+        if cache_backend == "local":
+            cache_store = LocalCacheStore(app_config_data.get("cache_path", "result_cache.db"), cache_ttl_seconds, cache_max_bytes)
+            result_cache = ResultCache(cache_store, staging_directory)
+        elif cache_backend == "storage":
+            cache_storage_handler = create_storage_handler(storage_config_data,
+                                                           app_config_data.get("cache_filesystem_name", processed_filesystem_system_name))
+            cache_store = StorageCacheStore(cache_storage_handler, app_config_data.get("cache_directory", "cache"),
+                                            cache_ttl_seconds, cache_max_bytes,
+                                            evict_interval=int(app_config_data.get("cache_evict_interval", 3600)))
+            result_cache = ResultCache(cache_store, staging_directory)
+        deployment_router = create_deployment_router(aoai_config_data, app_config_data)
+        aoai_client = deployment_router.deployments[0].client
+        admission_controller = deployment_router.deployments[0].admission_controller
+        request_retrier = RequestRetrier(input_storage_handler, staging_directory, app_config_data.get("retry_max_attempts", 0),
+                                         int(app_config_data.get("retry_backoff_seconds", 60)))
+        realtime_executor = RealtimeExecutor(aoai_client, input_storage_handler, staging_directory,
+                                             app_config_data.get("realtime_max_file_bytes", 0),
+                                             app_config_data.get("realtime_urgent_directories", []),
+                                             app_config_data.get("realtime_urgent_metadata_key", ""),
+                                             app_config_data.get("realtime_max_concurrency", 20),
+                                             app_config_data.get("realtime_requests_per_minute", 0),
+                                             app_config_data.get("realtime_tokens_per_minute", 0),
+                                             int(app_config_data.get("realtime_max_retries", 5)),
+                                             app_config_data.get("realtime_deployment_name", ""))
+        metrics = Metrics(app_config_data.get("metrics_port", 0), app_config_data.get("metrics_snapshot_path", ""),
+                          int(app_config_data.get("metrics_snapshot_interval", 60)), app_config_data.get("structured_logs", False))
+        metrics.add_source("discovery", input_discovery.get_stats)
+        file_cleaner = FileCleaner(deployment_router, job_ledger, int(app_config_data.get("cleanup_max_concurrency", 8)),
+                                   app_config_data.get("cleanup_requests_per_minute", 0),
+                                   int(app_config_data.get("orphan_sweep_interval", 0)),
+                                   int(app_config_data.get("orphan_min_age_seconds", 172800)))
+        result_store = ResultStore(app_config_data.get("result_store_format", ""), app_config_data.get("result_store_compression", "zstd"),
+                                   int(app_config_data.get("result_store_row_group_size", 10000)))
+        input_validator = None
+        input_validation = app_config_data.get("input_validation", "")
+        if input_validation:
+            batch_template = Utils.read_json_data(app_config_data.get("batch_template", os.path.join(
+                os.path.dirname(os.path.abspath(__file__)), "..", "templates", "batch_template.json")))
+            input_validator = InputValidator(input_validation, batch_template, aoai_config_data["batch_job_endpoint"],
+                                             [deployment.client.model for deployment in deployment_router.deployments],
+                                             staging_directory, int(app_config_data.get("validation_workers", 1)))
+        usage_tracker = UsageTracker(aoai_config_data.get("price_table", {}), app_config_data.get("usage_summary_path", ""),
+                                     int(app_config_data.get("usage_summary_interval", 300)))
+        components = BatchComponents(deployment_router, admission_controller, token_counter, file_sharder, file_packer,
+                                     job_ledger, result_cache, request_retrier, realtime_executor, file_claimer,
+                                     file_cleaner, input_validator, result_store, metrics, usage_tracker)
         azure_batch = AzureBatch(aoai_client, input_storage_handler, 
                                 error_storage_handler, processed_storage_handler, BATCH_PATH, input_directory_client, 
-                                local_download_path,output_directory, error_directory,count_tokens)
+                                local_download_path,output_directory, error_directory,count_tokens, stats_interval,
+                                stream_results, staging_directory, components)
     except Exception as e:
         print(f"An error occurred while initializing the application, please check the configuration. \n\n\tException:\n\n\t\t{e}\n\n")
         return
     if continuous_mode:
         print("Running in continuous mode")
-        while True:
-            if len(files) > 0:
-                asyncio.run(azure_batch.process_all_files(files, batch_size))
-            else:
-                print("No files found. Sleeping for 60 seconds")
-                time.sleep(60) 
-            files = input_storage_handler.get_file_list(input_directory)
+        asyncio.run(run_continuous(azure_batch, input_discovery.discover, batch_size, poll_interval))
     else:
         print("Running in on-demand mode")
-        asyncio.run(azure_batch.process_all_files(files, batch_size))   
+        asyncio.run(run_on_demand(azure_batch, input_discovery, batch_size))
 
     #TODO: 1) Support blob storage
      
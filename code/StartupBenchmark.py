@@ -0,0 +1,123 @@
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from Benchmark import start_fake_server, call_fake_server, create_workload, INPUT_DIRECTORY
+from LocalStorageHandler import LocalStorageHandler
+
+CODE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+#Modules that are only worth loading when a run needs them
+HEAVY_MODULES = ("openai", "tiktoken", "pyarrow", "requests", "azure.storage.filedatalake", "aiohttp.web")
+IMPORT_SCRIPT = ("import json, sys, time; start_time = time.perf_counter(); import RunBatch; "
+                 "print(json.dumps({'seconds': time.perf_counter() - start_time, "
+                 "'modules': [name for name in %r if name in sys.modules]}))" % (HEAVY_MODULES,))
+
+def measure_import():
+    #Import time of RunBatch in a fresh interpreter, and which heavy modules it loaded
+    output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], cwd=CODE_DIRECTORY, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+def write_configs(config_directory, storage_root, endpoint, args):
+    #An on-demand run of RunBatch.py against the fake server, with local storage and a single slot
+    paths = {name: os.path.join(config_directory, f"{name}.json") for name in ("app_config", "storage_config", "AOAI_config")}
+    configs = {
+        "app_config": {"storage_config": paths["storage_config"], "AOAI_config": paths["AOAI_config"], "batch_size": 1,
+                       "download_to_local": False, "continuous_mode": False, "count_tokens": args.count_tokens,
+                       "ledger_path": os.path.join(config_directory, "batch_ledger.db"), "cleanup_max_concurrency": 1},
+        "storage_config": {"storage_type": "local", "local_storage_root": storage_root,
+                           "input_filesystem_system_name": "input", "error_filesystem_system_name": "error",
+                           "processed_filesystem_system_name": "processed", "input_directory": INPUT_DIRECTORY,
+                           "output_directory": "output", "error_directory": "error"},
+        "AOAI_config": {"aoai_key": "benchmark", "aoai_endpoint": endpoint, "aoai_api_version": "2024-10-21",
+                        "aoai_deployment_name": args.model, "batch_job_endpoint": "/chat/completions",
+                        "completion_window": "24h", "poll_min_interval": 1, "poll_max_interval": 10}
+    }
+    for name, path in paths.items():
+        with open(path, "w") as config_file:
+            json.dump(configs[name], config_file)
+    return paths["app_config"]
+
+async def measure_run(args, endpoint, input_storage_handler, environment):
+    #Time from starting the process to the fake server receiving its first batch job, and to the process exiting
+    await call_fake_server(endpoint, "POST", "fake/reset")
+    create_workload(input_storage_handler, 1, args.requests_per_file, args.prompt_bytes, args.model)
+    output = None if args.verbose else subprocess.DEVNULL
+    start_time = time.time()
+    process = await asyncio.create_subprocess_exec(sys.executable, "RunBatch.py", cwd=CODE_DIRECTORY, env=environment,
+                                                   stdout=output, stderr=output)
+    await process.wait()
+    elapsed = time.time() - start_time
+    server_stats = await call_fake_server(endpoint, "GET", "fake/stats")
+    if server_stats["first_batch_at"] is None:
+        raise RuntimeError("RunBatch.py did not submit a batch job, run with --verbose to see its output")
+    return {"first_job_seconds": server_stats["first_batch_at"] - start_time, "total_seconds": elapsed}
+
+async def run_benchmarks(args):
+    process, endpoint = start_fake_server(args)
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as root_directory:
+            config_directory = os.path.join(root_directory, "config")
+            os.makedirs(config_directory)
+            app_config_path = write_configs(config_directory, os.path.join(root_directory, "storage"), endpoint, args)
+            input_storage_handler = LocalStorageHandler(os.path.join(root_directory, "storage"), "input")
+            config_cache_path = os.path.join(config_directory, "config_cache.json")
+            for mode, cache_path in (("configs", ""), ("config_cache", config_cache_path)):
+                environment = dict(os.environ, APP_CONFIG=app_config_path, CONFIG_CACHE=cache_path)
+                if cache_path != "":
+                    subprocess.run([sys.executable, "RunBatch.py", "prepare"], cwd=CODE_DIRECTORY, env=environment,
+                                   stdout=subprocess.DEVNULL, check=True)
+                print(f"Starting RunBatch.py {args.runs} time(s) with {mode}...")
+                runs = [await measure_run(args, endpoint, input_storage_handler, environment) for index in range(args.runs)]
+                results.append({
+                    "mode": mode,
+                    "runs": args.runs,
+                    "first_job_seconds": round(statistics.median(run["first_job_seconds"] for run in runs), 3),
+                    "total_seconds": round(statistics.median(run["total_seconds"] for run in runs), 3)
+                })
+    finally:
+        process.terminate()
+        process.wait()
+    return results
+
+def print_results(import_results, results):
+    print(f"RunBatch import: {statistics.median(result['seconds'] for result in import_results):.3f} seconds (median), "
+          f"heavy modules loaded: {', '.join(import_results[-1]['modules']) or 'none'}")
+    columns = ("mode", "runs", "first_job_seconds", "total_seconds")
+    print(" ".join(f"{column:>18}" for column in columns))
+    for result in results:
+        print(" ".join(f"{str(result[column]):>18}" for column in columns))
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures how quickly RunBatch.py starts and submits its first job, "
+                                                 "against a local fake AOAI server")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--requests-per-file", type=int, default=10)
+    parser.add_argument("--prompt-bytes", type=int, default=200)
+    parser.add_argument("--model", default="gpt-4o-batch")
+    parser.add_argument("--count-tokens", action="store_true", help="Count tokens, which loads the tokenizer before the first job")
+    parser.add_argument("--api-latency", type=float, default=0.0)
+    parser.add_argument("--file-processing-seconds", type=float, default=0.1)
+    parser.add_argument("--validating-seconds", type=float, default=0.1)
+    parser.add_argument("--queue-seconds", type=float, default=0.1)
+    parser.add_argument("--request-seconds", type=float, default=0.0001)
+    parser.add_argument("--request-failure-rate", type=float, default=0.0)
+    parser.add_argument("--batch-failure-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the results as JSON to this file for comparison between runs")
+    parser.add_argument("--verbose", action="store_true", help="Show the accelerator's own output")
+    args = parser.parse_args()
+    import_results = [measure_import() for index in range(args.runs)]
+    results = asyncio.run(run_benchmarks(args))
+    print_results(import_results, results)
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump({"import": import_results, "runs": results}, output_file, indent=2)
+
+if __name__ == "__main__":
+    main()
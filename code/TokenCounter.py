@@ -0,0 +1,118 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from Utilities import Utils
+
+#Fixed overhead of the chat format: tokens added around every message and to prime the reply
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+TOKENS_PER_REPLY = 3
+
+def count_request_tokens(request, model_name):
+    body = request.get("body") or {}
+    messages = body.get("messages")
+    if messages is None:
+        #Non-chat requests such as completions or embeddings carry their text in prompt or input
+        prompt = body.get("prompt", body.get("input", ""))
+        return count_content_tokens(prompt, model_name)
+    tokens = TOKENS_PER_REPLY
+    for message in messages:
+        tokens += TOKENS_PER_MESSAGE + count_content_tokens(message.get("content"), model_name)
+        if "name" in message:
+            tokens += TOKENS_PER_NAME + count_content_tokens(message["name"], model_name)
+    return tokens
+
+def count_content_tokens(content, model_name):
+    #Content is a string, or a list of parts of which only the text parts are counted
+    if content is None:
+        return 0
+    if isinstance(content, str):
+        return len(Utils.get_encoding(model_name).encode(content, disallowed_special=()))
+    if isinstance(content, list):
+        return sum(count_content_tokens(part.get("text") if isinstance(part, dict) else part, model_name) for part in content)
+    return count_content_tokens(str(content), model_name)
+
+def count_lines(lines, model_name):
+    #Runs in the worker processes; returns (custom_id, tokens) for every request in a block of lines
+    request_tokens = []
+    for line in lines:
+        if len(line.strip()) == 0:
+            continue
+        try:
+            request = json.loads(line)
+        except Exception:
+            request_tokens.append((None, 0))
+            continue
+        request_tokens.append((request.get("custom_id"), count_request_tokens(request, model_name)))
+    return request_tokens
+
+class TokenCounter:
+    #Counts the prompt tokens of batch input files. Files are streamed line by line, only message content is
+    #tokenized, and blocks of lines are counted on a process pool so large files don't hold up the event loop.
+    def __init__(self, model_name="gpt-4", max_workers=0, block_size=2000):
+        self.model_name = model_name
+        self.max_workers = max_workers
+        self.block_size = block_size
+        self.executor = None
+        self.executor_lock = threading.Lock()
+    def get_executor(self):
+        #A single worker counts on the calling thread; more than one uses a process pool. Files are counted on
+        #several threads at once, so the pool is created under a lock, and its workers are spawned rather than
+        #forked because forking a process that runs an event loop and threads can leave a worker deadlocked.
+        if self.get_worker_count() <= 1:
+            return None
+        with self.executor_lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.get_worker_count(),
+                                                    mp_context=multiprocessing.get_context("spawn"))
+            return self.executor
+    def get_worker_count(self):
+        return self.max_workers or os.cpu_count() or 1
+    def count_line(self, line):
+        return sum(tokens for custom_id, tokens in count_lines([line], self.model_name))
+    def count_file(self, storage_handler, file):
+        return self.count_line_stream(storage_handler.iter_file_lines_by_path(file))
+    def count_local_file(self, file_path):
+        with open(file_path, "rb") as local_file:
+            return self.count_line_stream(local_file)
+    def count_line_stream(self, lines):
+        executor = self.get_executor()
+        if executor is None:
+            return self.get_totals(count_lines(lines, self.model_name))
+        #At most two blocks per worker are held in memory at any time
+        max_pending = 2 * self.get_worker_count()
+        pending = []
+        request_tokens = []
+        block = []
+        for line in lines:
+            block.append(line)
+            if len(block) >= self.block_size:
+                pending.append(executor.submit(count_lines, block, self.model_name))
+                block = []
+                if len(pending) >= max_pending:
+                    request_tokens.extend(pending.pop(0).result())
+        if len(block) > 0:
+            pending.append(executor.submit(count_lines, block, self.model_name))
+        for future in pending:
+            request_tokens.extend(future.result())
+        return self.get_totals(request_tokens)
+    async def count_file_async(self, storage_handler, file):
+        return await asyncio.to_thread(self.count_file, storage_handler, file)
+    async def count_local_file_async(self, file_path):
+        return await asyncio.to_thread(self.count_local_file, file_path)
+    def get_totals(self, request_tokens):
+        token_counts = [tokens for custom_id, tokens in request_tokens]
+        return {
+            "requests": len(token_counts),
+            "tokens": sum(token_counts),
+            "max_request_tokens": max(token_counts) if len(token_counts) > 0 else 0,
+            "request_tokens": {custom_id: tokens for custom_id, tokens in request_tokens if custom_id is not None}
+        }
+    def close(self):
+        with self.executor_lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
@@ -0,0 +1,145 @@
+import asyncio
+import contextvars
+import datetime
+import json
+import time
+
+USAGE_FIELDS = ("requests", "succeeded", "failed", "prompt_tokens", "cached_tokens", "completion_tokens", "reasoning_tokens",
+                "total_tokens")
+
+#Usage of the file whose results are being written in the current task
+current_usage = contextvars.ContextVar("current_usage", default=None)
+
+def count_usage(lines):
+    #Totals of a block of result lines by model; runs on a worker thread
+    totals = {}
+    for line in lines:
+        if len(line.strip()) == 0:
+            continue
+        try:
+            result = json.loads(line)
+            response = result.get("response") or {}
+        except Exception:
+            continue
+        body = response.get("body") or {}
+        usage = body.get("usage") or {}
+        model_totals = totals.setdefault(body.get("model"), dict.fromkeys(USAGE_FIELDS, 0))
+        model_totals["requests"] += 1
+        if response.get("status_code") == 200:
+            model_totals["succeeded"] += 1
+        else:
+            model_totals["failed"] += 1
+        model_totals["prompt_tokens"] += usage.get("prompt_tokens") or 0
+        model_totals["completion_tokens"] += usage.get("completion_tokens") or 0
+        model_totals["total_tokens"] += usage.get("total_tokens") or 0
+        model_totals["cached_tokens"] += (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        model_totals["reasoning_tokens"] += (usage.get("completion_tokens_details") or {}).get("reasoning_tokens") or 0
+    return totals
+
+class UsageTracker:
+    #Adds up the usage blocks of batch results as they are streamed into storage, per file, per deployment and for the
+    #run, and prices them from a table keyed by deployment or model name. Merged results are counted after duplicates
+    #are dropped, so a retried request is counted once. Each entry gives the price per million
+    #input, cached input and output tokens. A run summary with throughput is written periodically and at the end.
+    def __init__(self, price_table=None, summary_path="", summary_interval=300):
+        self.price_table = price_table or {}
+        self.summary_path = summary_path
+        self.summary_interval = summary_interval
+        self.started_at = time.monotonic()
+        self.started_at_time = datetime.datetime.now()
+        self.run_usage = self.create_usage()
+        self.deployment_usage = {}
+    def create_usage(self):
+        usage = dict.fromkeys(USAGE_FIELDS, 0)
+        usage["cost"] = 0.0
+        usage["unpriced_requests"] = 0
+        return usage
+    def start_file(self):
+        usage = self.create_usage()
+        current_usage.set(usage)
+        return usage
+    def get_file_usage(self):
+        usage = current_usage.get()
+        if usage is None:
+            return None
+        return dict(usage, cost=round(usage["cost"], 6))
+    async def track_chunks(self, chunks, deployment):
+        #Passes the chunks through unchanged; their lines are counted off the event loop
+        remainder = b""
+        async for chunk in chunks:
+            lines = (remainder + chunk).split(b"\n")
+            remainder = lines.pop()
+            if len(lines) > 0:
+                self.add_totals(await asyncio.to_thread(count_usage, lines), deployment)
+            yield chunk
+        if len(remainder.strip()) > 0:
+            self.add_totals(count_usage([remainder]), deployment)
+    async def track_lines(self, lines, deployment):
+        if len(lines) > 0:
+            self.add_totals(await asyncio.to_thread(count_usage, lines), deployment)
+    def track_content(self, content, deployment):
+        self.add_totals(count_usage(content.encode().split(b"\n")), deployment)
+    def add_totals(self, totals, deployment):
+        file_usage = current_usage.get()
+        if deployment not in self.deployment_usage:
+            self.deployment_usage[deployment] = self.create_usage()
+        for model, model_totals in totals.items():
+            price = self.get_price(deployment, model)
+            for usage in (self.run_usage, self.deployment_usage[deployment], file_usage):
+                if usage is None:
+                    continue
+                for field in USAGE_FIELDS:
+                    usage[field] += model_totals[field]
+                if price is None:
+                    usage["unpriced_requests"] += model_totals["requests"]
+                else:
+                    usage["cost"] += self.get_cost(model_totals, price)
+    def get_price(self, deployment, model):
+        for key in (deployment, model, "default"):
+            if key is not None and key in self.price_table:
+                return self.price_table[key]
+        return None
+    def get_cost(self, totals, price):
+        #Cached prompt tokens are billed at the cached input price when one is given
+        input_price = price.get("input_per_million", 0)
+        cached_price = price.get("cached_input_per_million", input_price)
+        uncached_tokens = totals["prompt_tokens"] - totals["cached_tokens"]
+        return (uncached_tokens * input_price + totals["cached_tokens"] * cached_price
+                + totals["completion_tokens"] * price.get("output_per_million", 0)) / 1000000
+    def get_throughput(self, usage, elapsed_hours):
+        return {"requests_per_hour": round(usage["requests"] / elapsed_hours, 1),
+                "tokens_per_hour": round(usage["total_tokens"] / elapsed_hours, 1)}
+    def get_stats(self):
+        elapsed_hours = max(time.monotonic() - self.started_at, 1) / 3600
+        stats = dict(self.run_usage, cost=round(self.run_usage["cost"], 6))
+        stats.update(self.get_throughput(self.run_usage, elapsed_hours))
+        return stats
+    def get_summary(self):
+        elapsed_hours = max(time.monotonic() - self.started_at, 1) / 3600
+        deployments = {}
+        for deployment, usage in self.deployment_usage.items():
+            deployments[str(deployment)] = dict(usage, cost=round(usage["cost"], 6), **self.get_throughput(usage, elapsed_hours))
+        return {
+            "started_at": self.started_at_time.isoformat(),
+            "updated_at": datetime.datetime.now().isoformat(),
+            "elapsed_hours": round(elapsed_hours, 3),
+            "run": self.get_stats(),
+            "deployments": deployments
+        }
+    def start(self):
+        if self.summary_path == "":
+            return None
+        return asyncio.create_task(self.run())
+    async def run(self):
+        try:
+            while True:
+                await asyncio.sleep(self.summary_interval)
+                await asyncio.to_thread(self.write_summary, self.get_summary())
+        finally:
+            self.write_summary(self.get_summary())
+    def write_summary(self, summary):
+        try:
+            with open(self.summary_path, "w") as summary_file:
+                json.dump(summary, summary_file, indent=2)
+        except Exception as e:
+            print(f"Could not write the usage summary to {self.summary_path}. Error: {e}")
@@ -1,10 +1,8 @@
 import json
-import tiktoken
 import os
-from token_count import TokenCount
+from functools import lru_cache
 from  datetime import datetime
 class Utils:
-    #Add utility to count output tokens and estimate price.
     def __init__(self):
         pass
     @staticmethod
@@ -29,16 +27,21 @@ class Utils:
             file_list.append(file)
         return file_list
     @staticmethod
+    @lru_cache(maxsize=None)
+    def get_encoding(model_name):
+        #Loading an encoding is expensive, so each one is loaded once per process; tiktoken is only imported when
+        #tokens are counted
+        import tiktoken
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            return tiktoken.get_encoding(model_name)
+    @staticmethod
     def num_tokens_from_string(string: str, encoding_name: str) -> int:
-        encoding = tiktoken.encoding_for_model(encoding_name)
-        num_tokens = len(encoding.encode(string))
+        encoding = Utils.get_encoding(encoding_name)
+        num_tokens = len(encoding.encode(string, disallowed_special=()))
         return num_tokens
     @staticmethod
-    def get_tokens_in_file(file, model_family):
-        tc = TokenCount(model_name=model_family)
-        tokens = tc.num_tokens_from_file(file)
-        return tokens
-    @staticmethod
     def append_postfix(file):
         datetime_string = datetime.today().strftime('%Y-%m-%d_%H_%M_%S')
         return f"{file}_{datetime_string}"
@@ -57,6 +60,33 @@ class Utils:
         data_dict = json.loads(data_str_clean)
         return data_dict
     @staticmethod
+    def iter_lines(chunks):
+        #Splits a stream of byte chunks on line boundaries; every line yielded ends with a newline
+        remainder = b""
+        for chunk in chunks:
+            lines = (remainder + chunk).split(b"\n")
+            remainder = lines.pop()
+            for line in lines:
+                yield line + b"\n"
+        if len(remainder.strip()) > 0:
+            yield remainder + b"\n"
+    @staticmethod
+    async def iter_lines_async(chunks):
+        remainder = b""
+        async for chunk in chunks:
+            lines = (remainder + chunk).split(b"\n")
+            remainder = lines.pop()
+            for line in lines:
+                yield line + b"\n"
+        if len(remainder.strip()) > 0:
+            yield remainder + b"\n"
+    @staticmethod
+    def get_custom_id(line):
+        try:
+            return json.loads(line).get("custom_id")
+        except Exception:
+            return None
+    @staticmethod
     def get_file_extension(file_name):
         file_name_split = file_name.split(".")
         #No extension
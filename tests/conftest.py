@@ -0,0 +1,75 @@
+import json
+import os
+import sys
+import types
+import pytest
+
+#The modules in code/ import each other by name, the same way RunBatch.py does
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "code"))
+
+import Benchmark
+from AOAIHandler import AOAIHandler
+from AzureBatch import AzureBatch
+from BatchComponents import BatchComponents
+from LocalStorageHandler import LocalStorageHandler
+
+def get_server_args(request_failure_rate=0.0):
+    #Short simulated stages so a batch job completes within one or two status polls
+    return types.SimpleNamespace(api_latency=0.0, file_processing_seconds=0.05, validating_seconds=0.05, queue_seconds=0.05,
+                                 request_seconds=0.0001, request_failure_rate=request_failure_rate, batch_failure_rate=0.0,
+                                 seed=1)
+
+@pytest.fixture(scope="session")
+def fake_server():
+    process, endpoint = Benchmark.start_fake_server(get_server_args())
+    yield endpoint
+    process.terminate()
+    process.wait()
+
+@pytest.fixture(scope="session")
+def flaky_fake_server():
+    #Fails about a third of the requests in every batch with retryable errors
+    process, endpoint = Benchmark.start_fake_server(get_server_args(request_failure_rate=0.3))
+    yield endpoint
+    process.terminate()
+    process.wait()
+
+@pytest.fixture
+def storage(tmp_path):
+    return types.SimpleNamespace(input=LocalStorageHandler(str(tmp_path), "input"),
+                                 error=LocalStorageHandler(str(tmp_path), "error"),
+                                 processed=LocalStorageHandler(str(tmp_path), "processed"))
+
+def create_request(custom_id, content, model="m"):
+    return {"custom_id": custom_id, "method": "POST", "url": "/chat/completions",
+            "body": {"model": model, "messages": [{"role": "user", "content": content}]}}
+
+def write_lines(storage_handler, path, lines):
+    writer = storage_handler.get_file_writer(path)
+    for line in lines:
+        writer.write(line if isinstance(line, bytes) else json.dumps(line).encode() + b"\n")
+    writer.close()
+    return path
+
+def write_requests(storage_handler, path, count, tag="request"):
+    return write_lines(storage_handler, path, [create_request(f"{tag}-{index}", f"{tag} {index}") for index in range(count)])
+
+def read_lines(storage_handler, path):
+    return [json.loads(line) for line in storage_handler.iter_file_lines_by_path(path) if len(line.strip()) > 0]
+
+def find_files(storage_handler, suffix):
+    return sorted(file for file in storage_handler.get_file_list("") if file.endswith(suffix))
+
+def create_client(endpoint, **config):
+    handler_config = {"aoai_endpoint": endpoint, "aoai_key": "test", "aoai_api_version": "2024-10-21",
+                      "aoai_deployment_name": "m", "batch_job_endpoint": "/chat/completions",
+                      "completion_window": "24h", "poll_min_interval": 1, "poll_max_interval": 1}
+    handler_config.update(config)
+    return AOAIHandler(handler_config)
+
+def create_azure_batch(endpoint, storage, client=None, **components):
+    #The fake server imports input files straight from the local input file system
+    client = client or create_client(endpoint)
+    batch_path = "file://" + storage.input.get_local_path("") + "/"
+    return AzureBatch(client, storage.input, storage.error, storage.processed, batch_path, "", None, "output", "error",
+                      stats_interval=3600, components=BatchComponents(**components))
@@ -0,0 +1,109 @@
+import asyncio
+from AdmissionController import AdmissionController
+
+def test_acquire_admits_jobs_that_fit_straight_away():
+    async def main():
+        controller = AdmissionController(100)
+        await controller.acquire("a", 40)
+        await controller.acquire("b", 60)
+        #Acquiring again for an admitted job doesn't count its tokens twice
+        await controller.acquire("a", 40)
+        return controller.get_stats()
+    stats = asyncio.run(main())
+    assert stats["enqueued_tokens"] == 100
+    assert stats["admitted_jobs"] == 2
+
+def test_acquire_waits_until_enough_tokens_are_released():
+    async def main():
+        controller = AdmissionController(100)
+        await controller.acquire("a", 80)
+        waiter = asyncio.create_task(controller.acquire("b", 30))
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        assert controller.get_stats()["waiting_jobs"] == 1
+        controller.release("a")
+        await asyncio.wait_for(waiter, 1)
+        return controller.get_stats()
+    stats = asyncio.run(main())
+    assert stats["enqueued_tokens"] == 30
+    assert stats["waiting_jobs"] == 0
+
+def test_reserve_counts_running_jobs_even_over_budget():
+    async def main():
+        controller = AdmissionController(100)
+        controller.reserve("running-1", 80)
+        controller.reserve("running-2", 80)
+        waiter = asyncio.create_task(controller.acquire("new", 30))
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        controller.release("running-1")
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        controller.release("running-2")
+        await asyncio.wait_for(waiter, 1)
+        return controller.get_stats()
+    stats = asyncio.run(main())
+    assert stats["enqueued_tokens"] == 30
+
+def test_job_larger_than_the_budget_is_admitted_on_its_own():
+    async def main():
+        controller = AdmissionController(100)
+        await controller.acquire("a", 10)
+        waiter = asyncio.create_task(controller.acquire("huge", 500))
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        controller.release("a")
+        await asyncio.wait_for(waiter, 1)
+    asyncio.run(main())
+
+def admit_in_order(order, jobs, max_wait=3600, wait_before=None):
+    #Queues jobs behind one that fills the budget, frees it and returns the order the queued jobs were admitted in
+    async def main():
+        controller = AdmissionController(100, order, max_wait=max_wait)
+        await controller.acquire("running", 100)
+        admitted = []
+        async def acquire(key, tokens):
+            await controller.acquire(key, tokens)
+            admitted.append(key)
+            controller.release(key)
+        tasks = []
+        for key, tokens in jobs:
+            tasks.append(asyncio.create_task(acquire(key, tokens)))
+            await asyncio.sleep(wait_before.get(key, 0) if wait_before else 0)
+        controller.release("running")
+        await asyncio.wait_for(asyncio.gather(*tasks), 1)
+        return admitted, controller.get_stats()
+    return asyncio.run(main())
+
+def test_sjf_admits_the_smallest_waiting_job_first():
+    admitted, stats = admit_in_order("sjf", [("large", 90), ("small", 10), ("medium", 50)])
+    assert admitted == ["small", "medium", "large"]
+
+def test_fifo_admits_in_arrival_order():
+    admitted, stats = admit_in_order("fifo", [("large", 90), ("small", 10), ("medium", 50)])
+    assert admitted == ["large", "small", "medium"]
+
+def test_sjf_promotes_a_job_that_waited_longer_than_max_wait():
+    admitted, stats = admit_in_order("sjf", [("large", 90), ("small", 10)], max_wait=0.05, wait_before={"large": 0.1})
+    assert admitted == ["large", "small"]
+    assert stats["promoted_jobs"] == 1
+
+def test_cancelled_waiter_is_removed_from_the_queue():
+    async def main():
+        controller = AdmissionController(100)
+        await controller.acquire("a", 100)
+        waiter = asyncio.create_task(controller.acquire("b", 50))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        controller.release("a")
+        return controller.get_stats()
+    stats = asyncio.run(main())
+    assert stats["waiting_jobs"] == 0
+    assert stats["enqueued_tokens"] == 0
+
+def test_quota_errors_and_retry_delay():
+    controller = AdmissionController(100, retry_interval=60)
+    assert controller.is_quota_error(["token_limit_exceeded"])
+    assert not controller.is_quota_error(["invalid_request"])
+    assert [controller.get_retry_delay(attempt) for attempt in range(5)] == [60, 120, 240, 480, 600]
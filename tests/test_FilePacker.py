@@ -0,0 +1,63 @@
+from FilePacker import FilePacker
+from conftest import read_lines, write_lines, write_requests
+
+def test_create_packs_groups_small_files_and_leaves_large_ones_out(storage):
+    small_files = [write_requests(storage.input, f"input/small_{index}.jsonl", 2) for index in range(5)]
+    large_file = write_requests(storage.input, "input/large.jsonl", 200)
+    file_size = storage.input.get_file_size_by_path(small_files[0])
+    packer = FilePacker(storage.input, "_staging", max_file_bytes=file_size * 10, max_pack_files=2)
+    packs, unpacked_files = packer.create_packs(small_files + [large_file])
+    assert [pack["files"] for pack in packs] == [small_files[0:2], small_files[2:4]]
+    #A pack of one file is no cheaper than the file on its own
+    assert unpacked_files == [large_file, small_files[4]]
+    assert len(set(pack["pack_file"] for pack in packs)) == 2
+
+def test_create_packs_splits_on_pack_size(storage):
+    files = [write_requests(storage.input, f"input/file_{index}.jsonl", 3) for index in range(4)]
+    file_size = storage.input.get_file_size_by_path(files[0])
+    packer = FilePacker(storage.input, "_staging", max_file_bytes=file_size, max_pack_bytes=file_size * 2)
+    packs, unpacked_files = packer.create_packs(files)
+    assert [pack["files"] for pack in packs] == [files[0:2], files[2:4]]
+    assert unpacked_files == []
+
+def test_write_pack_prefixes_custom_ids_with_the_member_index(storage):
+    files = [write_requests(storage.input, f"input/{name}/same_name.jsonl", 2, tag=name) for name in ("a", "b")]
+    packer = FilePacker(storage.input, "_staging", max_file_bytes=100000)
+    packs, unpacked_files = packer.create_packs(files)
+    pack = packs[0]
+    overflow, unpackable = packer.write_pack(pack)
+    assert (overflow, unpackable) == ([], [])
+    assert pack["request_count"] == 4
+    lines = read_lines(storage.input, pack["pack_file"])
+    assert [line["custom_id"] for line in lines] == ["0|a-0", "0|a-1", "1|b-0", "1|b-1"]
+    assert lines[2]["body"]["messages"][0]["content"] == "b 0"
+
+def test_split_line_restores_the_original_custom_id(storage):
+    packer = FilePacker(storage.input, "_staging", max_file_bytes=100000)
+    member_index, line = packer.split_line(b'{"custom_id": "1|a|b", "response": {"status_code": 200}}\n')
+    assert member_index == 1
+    assert b'"custom_id": "a|b"' in line
+    #Lines that don't carry a member index are passed through
+    assert packer.split_line(b"not json\n") == (None, b"not json\n")
+
+def test_write_pack_returns_overflow_and_unpackable_files(storage):
+    first = write_requests(storage.input, "input/first.jsonl", 3)
+    broken = write_lines(storage.input, "input/broken.jsonl", [b"{not json\n"])
+    second = write_requests(storage.input, "input/second.jsonl", 3)
+    third = write_requests(storage.input, "input/third.jsonl", 1)
+    packer = FilePacker(storage.input, "_staging", max_file_bytes=100000, max_pack_requests=4)
+    pack = {"pack_file": "_staging/packs/pack.jsonl", "files": [first, broken, second, third]}
+    overflow, unpackable = packer.write_pack(pack)
+    assert pack["files"] == [first]
+    assert unpackable == [broken]
+    #Once a file overflows, every later file is left for another pack so the member order is kept
+    assert overflow == [second, third]
+
+def test_write_pack_reads_staged_input_in_place_of_the_file(storage):
+    files = [write_requests(storage.input, f"input/file_{index}.jsonl", 3) for index in range(2)]
+    staged = write_requests(storage.input, "_staging/validated/input/file_0.jsonl", 1, tag="valid")
+    packer = FilePacker(storage.input, "_staging", max_file_bytes=100000)
+    pack = {"pack_file": "_staging/packs/pack.jsonl", "files": files}
+    packer.write_pack(pack, {files[0]: staged})
+    assert [line["custom_id"] for line in read_lines(storage.input, pack["pack_file"])] == ["0|valid-0", "1|request-0",
+                                                                                           "1|request-1", "1|request-2"]
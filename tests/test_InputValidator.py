@@ -0,0 +1,102 @@
+import asyncio
+import json
+import os
+from InputValidator import InputValidator
+from conftest import create_azure_batch, create_request, find_files, read_lines, write_lines
+
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "templates", "batch_template.json")) as template_file:
+    TEMPLATE = json.load(template_file)
+
+def write_mixed_file(storage_handler, path):
+    #Three valid requests and one of each kind of bad line
+    return write_lines(storage_handler, path, [
+        create_request("a", "first"),
+        create_request("a", "duplicate"),
+        create_request("b", "wrong model", model="other"),
+        b"{not json\n",
+        create_request("c", "second"),
+        b"\n",
+        create_request("d", "third")
+    ])
+
+def create_validator(mode, max_workers=1):
+    return InputValidator(mode, TEMPLATE, "/chat/completions", ["m"], "_staging", max_workers, block_size=2)
+
+def test_reject_mode_reports_every_bad_line_without_staging_files(storage):
+    file = write_mixed_file(storage.input, "input/mixed.jsonl")
+    report = create_validator("reject").validate_file(storage.input, file)
+    assert (report["valid_lines"], report["invalid_lines"]) == (3, 3)
+    assert report["error_counts"] == {"duplicate_custom_id": 1, "model_mismatch": 1, "invalid_json": 1}
+    assert [error["line"] for error in report["errors"]] == [2, 3, 4]
+    assert report["valid_file"] is None and report["invalid_file"] is None
+
+def test_filter_mode_stages_valid_and_invalid_lines(storage):
+    file = write_mixed_file(storage.input, "input/mixed.jsonl")
+    report = create_validator("filter").validate_file(storage.input, file)
+    assert [line["custom_id"] for line in read_lines(storage.input, report["valid_file"])] == ["a", "c", "d"]
+    assert len(list(storage.input.iter_file_lines_by_path(report["invalid_file"]))) == 3
+
+def test_process_pool_gives_the_same_report(storage):
+    file = write_mixed_file(storage.input, "input/mixed.jsonl")
+    validator = create_validator("reject", max_workers=2)
+    try:
+        report = validator.validate_file(storage.input, file)
+    finally:
+        validator.close()
+    assert report["error_counts"] == create_validator("reject").validate_file(storage.input, file)["error_counts"]
+
+def run_batch(endpoint, storage, mode, files):
+    azure_batch = create_azure_batch(endpoint, storage, input_validator=create_validator(mode))
+    async def main():
+        await azure_batch.process_all_files(files, 2)
+        await azure_batch.close()
+    asyncio.run(main())
+
+def read_validation_report(storage):
+    [report_file] = find_files(storage.error, "_validation.jsonl")
+    return json.loads(storage.error.get_file_data_by_path(report_file))
+
+def test_reject_mode_sends_the_file_to_the_error_directory(fake_server, storage):
+    file = write_mixed_file(storage.input, "input/mixed.jsonl")
+    original = storage.input.get_file_data_by_path(file)
+    run_batch(fake_server, storage, "reject", [file])
+    report = read_validation_report(storage)
+    assert report["rejected"]
+    assert report["reason"] == "invalid_lines"
+    [copy] = find_files(storage.error, "mixed.jsonl")
+    assert storage.error.get_file_data_by_path(copy) == original
+    assert find_files(storage.processed, "_output.jsonl") == []
+
+def test_filter_mode_rejects_a_file_without_valid_lines(fake_server, storage):
+    file = write_lines(storage.input, "input/broken.jsonl", [b"{not json\n", create_request("a", "wrong model", model="other")])
+    run_batch(fake_server, storage, "filter", [file])
+    report = read_validation_report(storage)
+    assert report["rejected"]
+    assert report["reason"] == "no_valid_lines"
+    assert find_files(storage.processed, "_output.jsonl") == []
+
+def test_filter_mode_submits_only_the_valid_lines_and_archives_the_original(fake_server, storage):
+    file = write_mixed_file(storage.input, "input/mixed.jsonl")
+    original = storage.input.get_file_data_by_path(file)
+    run_batch(fake_server, storage, "filter", [file])
+    report = read_validation_report(storage)
+    assert not report["rejected"]
+    [invalid_file] = find_files(storage.error, "_invalid.jsonl")
+    assert len(list(storage.error.iter_file_lines_by_path(invalid_file))) == 3
+    [output_file] = find_files(storage.processed, "_output.jsonl")
+    assert sorted(line["custom_id"] for line in read_lines(storage.processed, output_file)) == ["a", "c", "d"]
+    #The input was never rewritten: the archived copy is the original, and nothing is left in staging
+    [archived] = find_files(storage.processed, "mixed.jsonl")
+    assert storage.processed.get_file_data_by_path(archived) == original
+    assert storage.input.get_file_list("") == []
+
+def test_filter_mode_rejects_a_file_whose_invalid_lines_cannot_be_written(fake_server, storage):
+    file = write_mixed_file(storage.input, "input/mixed.jsonl")
+    async def fail_write(chunks, directory_name, output_filename):
+        return None
+    storage.error.write_stream_to_directory = fail_write
+    run_batch(fake_server, storage, "filter", [file])
+    report = read_validation_report(storage)
+    assert report["rejected"]
+    assert report["reason"] == "invalid_lines_not_written"
+    assert find_files(storage.processed, "_output.jsonl") == []
@@ -0,0 +1,101 @@
+import asyncio
+import Benchmark
+from JobLedger import JobLedger
+from conftest import create_azure_batch, create_client, find_files, read_lines, write_requests
+
+def test_record_creates_and_updates_entries(tmp_path):
+    job_ledger = JobLedger(str(tmp_path / "ledger.db"))
+    entry = job_ledger.record("input/a.jsonl")
+    assert (entry["kind"], entry["parent"], entry["stage"]) == ("file", None, "pending")
+    job_ledger.record("input/a.jsonl", stage="uploaded", file_id="file-1", details={"deployment": "m"})
+    job_ledger.record("input/a.jsonl", kind="sharded", stage="submitted", batch_id="batch-1", details={"shards": 2})
+    entry = job_ledger.get("input/a.jsonl")
+    assert (entry["kind"], entry["stage"], entry["file_id"], entry["batch_id"]) == ("sharded", "submitted", "file-1", "batch-1")
+    #Details are merged rather than replaced
+    assert entry["details"] == {"deployment": "m", "shards": 2}
+    job_ledger.close()
+
+def test_entries_survive_a_restart(tmp_path):
+    ledger_path = str(tmp_path / "ledger.db")
+    job_ledger = JobLedger(ledger_path)
+    job_ledger.record("input/a.jsonl", stage="submitted", file_id="file-1", batch_id="batch-1")
+    job_ledger.close()
+    job_ledger = JobLedger(ledger_path)
+    assert job_ledger.get("input/a.jsonl")["batch_id"] == "batch-1"
+    assert job_ledger.get_file_ids() == {"file-1"}
+    job_ledger.close()
+
+def test_incomplete_entries_leave_out_children_and_remove_takes_them_along(tmp_path):
+    job_ledger = JobLedger(str(tmp_path / "ledger.db"))
+    job_ledger.record("input/a.jsonl", kind="sharded")
+    job_ledger.record("_staging/shards/a_0.jsonl", kind="shard", parent="input/a.jsonl", file_id="file-1")
+    job_ledger.record("_staging/packs/pack.jsonl", kind="pack")
+    assert [entry["source"] for entry in job_ledger.get_incomplete()] == ["input/a.jsonl", "_staging/packs/pack.jsonl"]
+    assert [entry["source"] for entry in job_ledger.get_incomplete("pack")] == ["_staging/packs/pack.jsonl"]
+    assert [entry["source"] for entry in job_ledger.get_children("input/a.jsonl")] == ["_staging/shards/a_0.jsonl"]
+    job_ledger.remove("input/a.jsonl")
+    assert job_ledger.get("_staging/shards/a_0.jsonl") is None
+    assert job_ledger.get_file_ids() == set()
+    job_ledger.close()
+
+def test_record_async_writes_off_the_event_loop(tmp_path):
+    job_ledger = JobLedger(str(tmp_path / "ledger.db"))
+    async def main():
+        await asyncio.gather(*[job_ledger.record_async(f"input/{index}.jsonl", stage="pending") for index in range(10)])
+        await job_ledger.remove_async("input/0.jsonl")
+    asyncio.run(main())
+    assert len(job_ledger.get_incomplete()) == 9
+    job_ledger.close()
+
+def get_call_counts(endpoint):
+    return asyncio.run(Benchmark.call_fake_server(endpoint, "GET", "fake/stats"))["calls"]
+
+def start_batch_job(endpoint, storage, file, create_batch=True):
+    #Does what an interrupted run would have done before it stopped
+    client = create_client(endpoint)
+    batch_path = "file://" + storage.input.get_local_path("") + "/"
+    async def main():
+        upload_response = await client.upload_batch_input_file_async(file, batch_path + file, await client.get_session())
+        file_id = upload_response["id"]
+        await client.wait_for_file_upload(file_id)
+        batch_id = (await client.create_batch_job_async(file_id)).id if create_batch else None
+        await client.close()
+        return file_id, batch_id
+    return asyncio.run(main())
+
+def resume(endpoint, storage, job_ledger):
+    azure_batch = create_azure_batch(endpoint, storage, job_ledger=job_ledger)
+    async def main():
+        await azure_batch.process_all_files([], 1)
+        await azure_batch.close()
+    asyncio.run(main())
+
+def test_resume_reattaches_to_a_submitted_batch(fake_server, storage, tmp_path):
+    ledger_path = str(tmp_path / "ledger.db")
+    file = write_requests(storage.input, "input/resumed.jsonl", 5)
+    file_id, batch_id = start_batch_job(fake_server, storage, file)
+    job_ledger = JobLedger(ledger_path)
+    job_ledger.record(file, stage="submitted", file_id=file_id, batch_id=batch_id, details={"deployment": "m"})
+    calls = get_call_counts(fake_server)
+    resume(fake_server, storage, job_ledger)
+    new_calls = get_call_counts(fake_server)
+    for call in ("POST /openai/files/import", "POST /openai/batches"):
+        assert new_calls.get(call) == calls.get(call)
+    [output_file] = find_files(storage.processed, "resumed_output.jsonl")
+    assert len(read_lines(storage.processed, output_file)) == 5
+    #The finished job is dropped from the ledger
+    job_ledger = JobLedger(ledger_path)
+    assert job_ledger.get(file) is None
+    job_ledger.close()
+
+def test_resume_finds_a_batch_created_after_the_last_ledger_write(fake_server, storage, tmp_path):
+    file = write_requests(storage.input, "input/unrecorded.jsonl", 3)
+    file_id, batch_id = start_batch_job(fake_server, storage, file)
+    job_ledger = JobLedger(str(tmp_path / "ledger.db"))
+    #The process stopped after creating the batch job but before recording it
+    job_ledger.record(file, stage="uploaded", file_id=file_id, details={"deployment": "m"})
+    calls = get_call_counts(fake_server)
+    resume(fake_server, storage, job_ledger)
+    assert get_call_counts(fake_server).get("POST /openai/batches") == calls.get("POST /openai/batches")
+    [output_file] = find_files(storage.processed, "unrecorded_output.jsonl")
+    assert len(read_lines(storage.processed, output_file)) == 3
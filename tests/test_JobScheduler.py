@@ -0,0 +1,91 @@
+import asyncio
+from JobScheduler import JobScheduler
+
+def run_scheduler(items, max_concurrency, process_seconds=0.0):
+    #Submits (key, priority) pairs before starting so the order of the queue decides what runs first
+    started = []
+    active = {"current": 0, "max": 0}
+    async def process(key):
+        started.append(key)
+        active["current"] += 1
+        active["max"] = max(active["max"], active["current"])
+        await asyncio.sleep(process_seconds)
+        active["current"] -= 1
+    async def main():
+        scheduler = JobScheduler(process, max_concurrency)
+        for key, priority in items:
+            scheduler.submit(key, priority=priority)
+        scheduler.start()
+        await scheduler.join()
+        await scheduler.stop()
+        return scheduler.get_stats()
+    stats = asyncio.run(main())
+    return started, active["max"], stats
+
+def test_starts_lowest_priority_first_then_in_submission_order():
+    started, max_active, stats = run_scheduler([("c", 2), ("a", 0), ("b", 0), ("d", 1)], 1)
+    assert started == ["a", "b", "d", "c"]
+
+def test_never_runs_more_than_max_concurrency():
+    started, max_active, stats = run_scheduler([(f"file-{index}", 0) for index in range(10)], 3, process_seconds=0.01)
+    assert max_active == 3
+    assert stats["completed"] == 10
+    assert stats["queue_depth"] == 0
+    assert stats["active_slots"] == 0
+
+def test_next_item_starts_as_soon_as_a_slot_frees():
+    #One slow item must not hold up the others, unlike a gathered micro-batch
+    finished = []
+    async def process(key):
+        await asyncio.sleep(0.5 if key == "slow" else 0.01)
+        finished.append(key)
+    async def main():
+        scheduler = JobScheduler(process, 2)
+        scheduler.start()
+        for key in ["slow", "a", "b", "c"]:
+            scheduler.submit(key)
+        await asyncio.sleep(0.2)
+        assert finished == ["a", "b", "c"]
+        await scheduler.join()
+        await scheduler.stop()
+    asyncio.run(main())
+
+def test_ignores_keys_already_queued_and_work_after_admission_stops():
+    async def process(key):
+        await asyncio.sleep(0)
+    async def main():
+        scheduler = JobScheduler(process, 1)
+        assert scheduler.submit("a")
+        assert not scheduler.submit("a")
+        scheduler.stop_admitting()
+        assert not scheduler.submit("b")
+        scheduler.start()
+        await scheduler.join()
+        await scheduler.stop()
+        return scheduler.get_stats()
+    stats = asyncio.run(main())
+    #Work queued before admission stopped is dropped rather than started
+    assert stats["submitted"] == 1
+    assert stats["completed"] == 0
+
+def test_counts_failures_and_keeps_the_slot_running():
+    async def process(key):
+        if key == "bad":
+            raise ValueError("broken file")
+    async def main():
+        scheduler = JobScheduler(process, 1)
+        for key in ["bad", "good"]:
+            scheduler.submit(key)
+        scheduler.start()
+        await scheduler.join()
+        await scheduler.stop()
+        return scheduler.get_stats()
+    stats = asyncio.run(main())
+    assert stats["failed"] == 1
+    assert stats["completed"] == 1
+
+def test_reports_the_queue_wait_of_each_key():
+    started, max_active, stats = run_scheduler([("a", 0), ("b", 0)], 1, process_seconds=0.05)
+    wait_times = stats["wait_seconds_by_key"]
+    assert set(wait_times) == {"a", "b"}
+    assert wait_times["b"] >= 0.05 > wait_times["a"]
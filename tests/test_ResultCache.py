@@ -0,0 +1,102 @@
+import asyncio
+import json
+import Benchmark
+from ResultCache import LocalCacheStore, ResultCache, StorageCacheStore
+from conftest import create_azure_batch, create_request, find_files, read_lines, write_requests
+
+def create_response(content, tokens=15):
+    return json.dumps({"status_code": 200, "body": {"choices": [{"message": {"content": content}}],
+                                                    "usage": {"total_tokens": tokens}}})
+
+def test_local_store_returns_stored_responses(tmp_path):
+    store = LocalCacheStore(str(tmp_path / "cache.db"))
+    store.put_many([("a", create_response("A"), 10), ("b", create_response("B"), 20)])
+    assert store.get_many(["a", "b", "missing"]) == {"a": (create_response("A"), 10), "b": (create_response("B"), 20)}
+    store.close()
+    #The cache outlives the process that filled it
+    store = LocalCacheStore(str(tmp_path / "cache.db"))
+    assert list(store.get_many(["a"])) == ["a"]
+    store.close()
+
+def test_local_store_expires_entries_after_the_ttl(tmp_path, monkeypatch):
+    now = [1000000.0]
+    monkeypatch.setattr("ResultCache.time.time", lambda: now[0])
+    store = LocalCacheStore(str(tmp_path / "cache.db"), ttl_seconds=60)
+    store.put_many([("a", create_response("A"), 10)])
+    now[0] += 59
+    assert list(store.get_many(["a"])) == ["a"]
+    now[0] += 2
+    assert store.get_many(["a"]) == {}
+    store.evict()
+    assert store.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0] == 0
+    store.close()
+
+def test_local_store_evicts_the_least_recently_used_entries_over_max_bytes(tmp_path, monkeypatch):
+    now = [1000000.0]
+    monkeypatch.setattr("ResultCache.time.time", lambda: now[0])
+    size = len(create_response("A"))
+    store = LocalCacheStore(str(tmp_path / "cache.db"), max_bytes=size * 2)
+    for key in ["a", "b", "c"]:
+        store.put_many([(key, create_response(key.upper()), 10)])
+        now[0] += 1
+    #Reading a makes b the least recently used entry
+    store.get_many(["a"])
+    store.evict()
+    assert sorted(store.get_many(["a", "b", "c"])) == ["a", "c"]
+    store.close()
+
+def test_storage_store_is_shared_between_instances_and_expires_segments(storage, monkeypatch):
+    now = [1000000.0]
+    monkeypatch.setattr("ResultCache.time.time", lambda: now[0])
+    writer = StorageCacheStore(storage.processed, "cache", ttl_seconds=60)
+    writer.put_many([("a", create_response("A"), 10)])
+    reader = StorageCacheStore(storage.processed, "cache", ttl_seconds=60)
+    assert reader.get_many(["a", "b"]) == {"a": (create_response("A"), 10)}
+    now[0] += 61
+    assert reader.get_many(["a"]) == {}
+    reader.evict()
+    assert storage.processed.get_file_list("") == []
+    writer.close()
+    reader.close()
+
+def test_filter_input_splits_cached_and_uncached_requests(storage, tmp_path):
+    file = write_requests(storage.input, "input/file.jsonl", 3)
+    store = LocalCacheStore(str(tmp_path / "cache.db"))
+    result_cache = ResultCache(store, "_staging")
+    cached_request = create_request("request-1", "request 1")
+    store.put_many([(result_cache.get_request_key(cached_request), create_response("cached"), 15)])
+    cache_result = result_cache.filter_input(storage.input, file)
+    assert (cache_result["lookups"], cache_result["hits"], cache_result["tokens_saved"]) == (3, 1, 15)
+    assert [line["custom_id"] for line in read_lines(storage.input, cache_result["uncached_file"])] == ["request-0", "request-2"]
+    [cached_line] = read_lines(storage.input, cache_result["cached_file"])
+    assert cached_line["custom_id"] == "request-1" and cached_line["cached"]
+    #The key only depends on the url and body, not on the custom_id
+    assert result_cache.get_request_key(create_request("other", "request 1")) == result_cache.get_request_key(cached_request)
+    store.close()
+
+def test_filter_input_leaves_the_file_alone_without_hits(storage, tmp_path):
+    file = write_requests(storage.input, "input/file.jsonl", 3)
+    store = LocalCacheStore(str(tmp_path / "cache.db"))
+    cache_result = ResultCache(store, "_staging").filter_input(storage.input, file)
+    assert (cache_result["hits"], cache_result["uncached_file"], cache_result["cached_file"]) == (0, file, None)
+    store.close()
+
+def get_call_counts(endpoint):
+    return asyncio.run(Benchmark.call_fake_server(endpoint, "GET", "fake/stats"))["calls"]
+
+def test_second_run_is_served_from_the_cache(fake_server, storage, tmp_path):
+    cache_path = str(tmp_path / "cache.db")
+    async def run(file):
+        azure_batch = create_azure_batch(fake_server, storage, result_cache=ResultCache(LocalCacheStore(cache_path), "_staging"))
+        await azure_batch.process_all_files([file], 1)
+        await azure_batch.close()
+    asyncio.run(run(write_requests(storage.input, "input/first.jsonl", 5)))
+    calls = get_call_counts(fake_server)
+    asyncio.run(run(write_requests(storage.input, "input/second.jsonl", 5)))
+    assert get_call_counts(fake_server).get("POST /openai/batches") == calls.get("POST /openai/batches")
+    [output_file] = find_files(storage.processed, "second_output.jsonl")
+    lines = read_lines(storage.processed, output_file)
+    assert sorted(line["custom_id"] for line in lines) == [f"request-{index}" for index in range(5)]
+    assert all(line["cached"] for line in lines)
+    [metadata_file] = find_files(storage.processed, "second_metadata.jsonl")
+    assert read_lines(storage.processed, metadata_file)[0]["cache_hits"] == 5
@@ -0,0 +1,56 @@
+import asyncio
+import json
+from RequestRetrier import RequestRetrier
+from UsageTracker import UsageTracker
+from conftest import create_azure_batch, find_files, read_lines, write_requests
+
+def create_result(custom_id, status_code=200, content="done"):
+    body = {"model": "m", "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}} if status_code == 200 else {}
+    return json.dumps({"custom_id": custom_id, "response": {"status_code": status_code, "body": body}, "error": None}).encode() + b"\n"
+
+async def iter_chunks(lines, chunk_size=7):
+    #Splits the content mid-line to exercise the line reassembly
+    content = b"".join(lines)
+    for start in range(0, len(content), chunk_size):
+        yield content[start:start + chunk_size]
+
+def merge(azure_batch, sources, **options):
+    async def main():
+        return b"".join([chunk async for chunk in azure_batch.merge_result_streams(
+            [(iter_chunks(lines), deployment) for lines, deployment in sources], **options)])
+    return asyncio.run(main())
+
+def test_merge_keeps_the_first_result_of_each_custom_id(fake_server, storage):
+    usage_tracker = UsageTracker()
+    azure_batch = create_azure_batch(fake_server, storage, usage_tracker=usage_tracker)
+    first = [create_result("a"), create_result("b", 500)]
+    retried = [create_result("b"), create_result("a")]
+    content = merge(azure_batch, [(first, "m"), (retried, "m")])
+    assert content == create_result("a") + create_result("b", 500)
+    #Usage is counted on the kept lines only
+    assert usage_tracker.get_stats()["requests"] == 2
+
+def test_merge_skips_excluded_custom_ids_and_appends_extra_lines(fake_server, storage):
+    azure_batch = create_azure_batch(fake_server, storage)
+    errors = [create_result("a", 429), create_result("b", 400)]
+    content = merge(azure_batch, [(errors, None)], excluded_custom_ids={"a"}, extra_lines=[create_result("c", 429)])
+    assert [json.loads(line)["custom_id"] for line in content.splitlines()] == ["b", "c"]
+
+def test_retried_requests_are_written_and_counted_once(flaky_fake_server, storage):
+    file = write_requests(storage.input, "input/flaky.jsonl", 20)
+    usage_tracker = UsageTracker()
+    azure_batch = create_azure_batch(flaky_fake_server, storage, usage_tracker=usage_tracker,
+                                     request_retrier=RequestRetrier(storage.input, "_staging", 8, 0.05))
+    async def main():
+        await azure_batch.process_all_files([file], 1)
+        await azure_batch.close()
+    asyncio.run(main())
+    [output_file] = find_files(storage.processed, "_output.jsonl")
+    custom_ids = [line["custom_id"] for line in read_lines(storage.processed, output_file)]
+    assert sorted(custom_ids) == sorted(f"request-{index}" for index in range(20))
+    assert find_files(storage.error, "_error.jsonl") == []
+    assert usage_tracker.get_stats()["requests"] == 20
+    [metadata_file] = find_files(storage.processed, "_metadata.jsonl")
+    metadata = read_lines(storage.processed, metadata_file)[0]
+    assert metadata["retry_attempts"] >= 1
+    assert metadata["recovered_request_count"] > 0